@@ -886,6 +886,9 @@ class HubServer(object):
                 tracked=False)
             self.commands["source_reset"] = CommandDefinition(
                 command=self.managers["source_manager"].reset, tracked=True)
+            self.commands["source_metrics"] = CommandDefinition(
+                command=self.managers["source_manager"].get_metrics,
+                tracked=False)
         # dump commands
         if self.managers.get("dump_manager"):
             self.commands["dump"] = self.managers["dump_manager"].dump_src
@@ -1231,6 +1234,11 @@ class HubServer(object):
                 EndpointDefinition(name="source_reset",
                                    method="post",
                                    suffix="reset"))
+        if "source_metrics" in cmdnames:
+            self.api_endpoints["source"].append(
+                EndpointDefinition(name="source_metrics",
+                                   method="get",
+                                   suffix="metrics"))
         if "dump" in cmdnames:
             self.api_endpoints["source"].append(
                 EndpointDefinition(name="dump", method="put", suffix="dump"))
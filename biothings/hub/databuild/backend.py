@@ -344,6 +344,14 @@ def generate_folder(root_folder, old_db_col_names, new_db_col_names):
     return diff_folder
 
 
+def touched_collection_name(target_name):
+    """
+    Collection (in target database) listing _ids re-merged by an incremental
+    build of target_name, as {"_id": ..., "op": "update"|"delete"}
+    """
+    return "%s_touched" % target_name
+
+
 def merge_src_build_metadata(build_docs):
     """
     Merge metadata from src_build documents. A list of docs
@@ -1,5 +1,6 @@
 import asyncio
 import copy
+import heapq
 import json
 import math
 import os
@@ -9,6 +10,7 @@ import sys
 import time
 from datetime import datetime
 from functools import partial
+from itertools import groupby
 from pprint import pformat
 
 import aiocron
@@ -26,10 +28,14 @@ from biothings.utils.hub_db import (get_source_fullname, get_src_build,
                                     get_src_master)
 from biothings.utils.loggers import get_logger
 from biothings.utils.manager import BaseManager
-from biothings.utils.mongo import doc_feeder, id_feeder
+from biothings.utils.mongo import (IdRange, doc_feeder, get_id_ranges,
+                                   id_feeder, id_range_query, id_sort_key,
+                                   ids_query)
 
 from ..databuild.backend import (LinkTargetDocMongoBackend,
-                                 SourceDocMongoBackend, TargetDocMongoBackend)
+                                 SourceDocMongoBackend, TargetDocMongoBackend,
+                                 touched_collection_name)
+from ..dataload.storage import change_collection_name
 from ..dataload.uploader import ResourceNotReady
 from .backend import create_backend
 from .buildconfig import AutoBuildConfig
@@ -57,6 +63,9 @@ class DataBuilder(object):
     """
 
     keep_archive = 10  # number of archived collection to keep. Oldest get dropped first.
+    # give merger jobs _id ranges (see get_id_ranges()) read with one cursor,
+    # instead of lists of _ids
+    partition_by_range = False
 
     def __init__(self,
                  build_name,
@@ -107,6 +116,7 @@ class DataBuilder(object):
         }  # sources involved in this build (includes versions)
         self.stats = {}  # can be customized
         self.mapping = {}  # ES mapping (merged from src_master's docs)
+        self.incremental = None  # when building from previous build (see plan_incremental())
 
         for mapper in mappers + [default_mapper_class()]:
             self.mappers[mapper.name] = mapper
@@ -516,6 +526,7 @@ class DataBuilder(object):
               ids=None,
               steps=["merge", "post", "metadata"],
               job_manager=None,
+              incremental=False,
               *args,
               **kwargs):
         """Merge given sources into a collection named target_name. If sources argument is omitted,
@@ -525,6 +536,9 @@ class DataBuilder(object):
         Optional parameters:
           - force=True will bypass any safety check
           - ids: list of _ids to merge, specifically. If None, all documents are merged.
+          - incremental=True will start from previous build and only re-merge documents changed
+            in sources updated since then (see plan_incremental()), all sources being merged.
+            A full build is done if that's not possible.
           - steps:
              * merge: actual merge step, create merged documents and store them
              * post: once merge, run optional post-merge process
@@ -537,9 +551,20 @@ class DataBuilder(object):
             steps = [steps]
         self.t0 = time.time()
         self.check_ready(force)
+        self.incremental = None
+        if incremental:
+            if sources is not None or ids is not None:
+                raise BuilderException(
+                    "Incremental build merges all sources, can't specify sources or _ids")
+            self.incremental = self.plan_incremental()
+            if self.incremental is None:
+                self.logger.info("Can't build incrementally, running a full build")
         # normalize
         avail_sources = self.build_config['sources']
-        if sources is None:
+        if sources is None and self.incremental:
+            # target is a copy of previous build
+            sources = avail_sources
+        elif sources is None:
             self.target_backend.drop()
             self.target_backend.prepare()
             sources = avail_sources  # merge all
@@ -578,7 +603,13 @@ class DataBuilder(object):
             @asyncio.coroutine
             def do():
                 res = None
-                if "merge" in steps or "post" in steps:
+                if ("merge" in steps or "post" in steps) and self.incremental:
+                    res = yield from self.merge_incremental(source_names=sources,
+                                                            steps=steps,
+                                                            job_manager=job_manager,
+                                                            *args,
+                                                            **kwargs)
+                elif "merge" in steps or "post" in steps:
                     job = self.merge_sources(source_names=sources,
                                              ids=ids,
                                              steps=steps,
@@ -625,13 +656,14 @@ class DataBuilder(object):
                             }
                             # custom
                             _meta.update(self.custom_metadata)
-                            self.register_status('success',
-                                                 build={
-                                                     "merge_stats":
-                                                     self.merge_stats,
-                                                     "mapping": self.mapping,
-                                                     "_meta": _meta,
-                                                 })
+                            build_info = {
+                                "merge_stats": self.merge_stats,
+                                "mapping": self.mapping,
+                                "_meta": _meta,
+                            }
+                            if self.incremental:
+                                build_info["incremental"] = self.incremental
+                            self.register_status('success', build=build_info)
                             self.logger.info("success %s" % strargs,
                                              extra={"notify": True})
                             # set next step
@@ -834,6 +866,206 @@ class DataBuilder(object):
         yield from asyncio.sleep(0.0)
         return self.merge_stats
 
+    def get_previous_build(self):
+        """
+        Return src_build document of the latest successful build (with
+        metadata) for this build configuration, or None
+        """
+        builds = [
+            b for b in self.source_backend.build.find(
+                {"build_config.name": self.build_config["name"]})
+            if b.get("_meta") and not b.get("archived")
+        ]
+        builds = sorted(builds, key=lambda b: str(b["started_at"]))
+        return builds and builds[-1] or None
+
+    def plan_incremental(self):
+        """
+        Determine how to build incrementally from previous build. Return
+        {"from": previous target name, "sources": {sub-source: how}} where sources
+        are the ones which changed since previous build and "how" tells how to
+        find changed _ids: "delta" if changes were recorded by a delta upload
+        (see DeltaSourceUploader), or the archived collection to compare with, the
+        one holding the release merged in previous build.
+        Return None if a full build is needed: no previous build, different
+        build configuration, sources using a mapper or a query (merged _ids
+        aren't source _ids), or no way to find changed _ids.
+        """
+        if not isinstance(self.target_backend, TargetDocMongoBackend):
+            return None
+        previous = self.get_previous_build()
+        if not previous:
+            self.logger.info("No previous build found")
+            return None
+        prev_conf = previous["build_config"]
+        for key in ("sources", self.doc_root_key):
+            if sorted(prev_conf.get(key) or []) != sorted(self.build_config.get(key) or []):
+                self.logger.info("Build configuration '%s' changed since build '%s'" %
+                                 (key, previous["_id"]))
+                return None
+        if previous["_id"] not in self.target_backend.target_db.collection_names():
+            self.logger.info("Collection for build '%s' doesn't exist anymore" % previous["_id"])
+            return None
+        src_db = mongo.get_src_db()
+        src_dump = self.source_backend.dump
+        prev_meta = previous["_meta"].get("src", {})
+        changed = {}
+        for src_name in self.resolve_sources(self.build_config["sources"]):
+            mapper = self.get_mapper_for_source(src_name, init=False)
+            if not isinstance(mapper, TransparentMapper) or self.generate_document_query(src_name):
+                self.logger.info("Source '%s' uses a mapper or a query" % src_name)
+                return None
+            main_name = get_source_fullname(src_name).split(".")[0]
+            src_doc = src_dump.find_one({"_id": main_name}) or {}
+            job = src_doc.get("upload", {}).get("jobs", {}).get(src_name, {})
+            version = prev_meta.get(main_name, {}).get("version")
+            if version is None:
+                self.logger.info("No version found for source '%s' in build '%s'" %
+                                 (main_name, previous["_id"]))
+                return None
+            if job.get("release") == version:
+                continue
+            if job.get("changes") is not None and job.get("changes_from") == version:
+                changed[src_name] = "delta"
+                continue
+            # releases held by source collection and its archives, recorded
+            # when collections were switched (see BaseSourceUploader.switch_collection())
+            releases = src_doc.get("upload", {}).get("archives", {}).get(src_name) or {}
+            cols = src_db.collection_names()
+            archives = sorted(c for c, rel in releases.items()
+                              if rel == version and c != src_name and c in cols)
+            if releases.get(src_name) != job.get("release") or not archives:
+                self.logger.info("Can't find changes for source '%s' since version '%s'" %
+                                 (src_name, version))
+                return None
+            changed[src_name] = archives[-1]
+        self.logger.info("Building from '%s', changed sources: %s" %
+                         (previous["_id"], changed))
+        return {"from": previous["_id"], "sources": changed}
+
+    def get_changed_ids(self, src_name, how, batch_size=10000):
+        """
+        Yield lists of _ids changed in source src_name since previous build
+        (see plan_incremental() for "how")
+        """
+        src_db = mongo.get_src_db()
+        if how == "delta":
+            for docs in doc_feeder(src_db[change_collection_name(src_name)],
+                                   step=batch_size, inbatch=True, fields={"_id": 1},
+                                   logger=self.logger):
+                yield [d["_id"] for d in docs]
+            return
+        new, old = src_db[src_name], src_db[how]
+        # new or updated, compared as whole documents
+        for docs in doc_feeder(new, step=batch_size, inbatch=True, logger=self.logger):
+            olds = {d["_id"]: d for d in old.find({"_id": {"$in": [d["_id"] for d in docs]}})}
+            ids = [d["_id"] for d in docs if olds.get(d["_id"]) != d]
+            if ids:
+                yield ids
+        # deleted
+        for docs in doc_feeder(old, step=batch_size, inbatch=True, fields={"_id": 1},
+                               logger=self.logger):
+            ids = [d["_id"] for d in docs]
+            found = {d["_id"] for d in new.find({"_id": {"$in": ids}}, {"_id": 1})}
+            ids = [_id for _id in ids if _id not in found]
+            if ids:
+                yield ids
+
+    def prepare_incremental(self, batch_size):
+        """
+        Copy previous build into target collection, record _ids changed in
+        sources (touched _ids) and remove them from target collection so they
+        can be merged again. Return touched _ids.
+        """
+        target_db = self.target_backend.target_db
+        self.logger.info("Copying '%s' to '%s'" % (self.incremental["from"], self.target_name))
+        target_db[self.incremental["from"]].aggregate([{"$out": self.target_name}])
+        touched = target_db[touched_collection_name(self.target_name)]
+        touched.drop()
+        for src_name, how in self.incremental["sources"].items():
+            cnt = 0
+            for ids in self.get_changed_ids(src_name, how, batch_size):
+                bob = touched.initialize_unordered_bulk_op()
+                for _id in ids:
+                    bob.find({"_id": _id}).upsert().replace_one({"_id": _id})
+                bob.execute()
+                self.target_backend.target_collection.remove({"_id": {"$in": ids}})
+                cnt += len(ids)
+            self.logger.info("Found %d changed _ids in '%s' (%s)" % (cnt, src_name, how))
+        return [d["_id"] for d in touched.find({}, {"_id": 1})]
+
+    def flag_touched_ids(self, batch_size):
+        """
+        Flag touched _ids as "update" or "delete", depending on whether they're
+        still found in target collection once merged
+        """
+        touched = self.target_backend.target_db[touched_collection_name(self.target_name)]
+        target = self.target_backend.target_collection
+        for ids in iter_n((d["_id"] for d in touched.find({}, {"_id": 1})), batch_size):
+            found = [d["_id"] for d in target.find({"_id": {"$in": ids}}, {"_id": 1})]
+            gone = list(set(ids).difference(found))
+            found and touched.update_many({"_id": {"$in": found}}, {"$set": {"op": "update"}})
+            gone and touched.update_many({"_id": {"$in": gone}}, {"$set": {"op": "delete"}})
+        return touched.count()
+
+    @asyncio.coroutine
+    def merge_incremental(self,
+                          source_names,
+                          steps=["merge", "post"],
+                          batch_size=100000,
+                          job_manager=None):
+        """
+        Build target collection from previous build (see plan_incremental()):
+        touched _ids are merged again, fetching documents from all sources. Touched _ids
+        are kept in a collection (see touched_collection_name()) so later steps
+        can process them only (eg. differ).
+        """
+        if type(steps) == str:
+            steps = [steps]
+        if "merge" not in steps:
+            res = yield from self.merge_sources(source_names,
+                                                steps=steps,
+                                                batch_size=batch_size,
+                                                job_manager=job_manager)
+            return res
+        pinfo = self.get_pinfo()
+        pinfo["step"] = "merge-incremental"
+        self.register_status("building",
+                             transient=True,
+                             init=True,
+                             job={
+                                 "step": "merge-incremental",
+                                 "sources": list(self.incremental["sources"])
+                             })
+        job = yield from job_manager.defer_to_thread(
+            pinfo, partial(self.prepare_incremental, batch_size))
+        ids = yield from job
+        if not ids:
+            self.logger.info("No changed documents since '%s'" % self.incremental["from"])
+            # still run other steps, an empty list of _ids would merge everything
+            steps = [step for step in steps if step != "merge"]
+        yield from self.merge_sources(source_names,
+                                      steps=steps,
+                                      batch_size=batch_size,
+                                      ids=ids,
+                                      job_manager=job_manager)
+        job = yield from job_manager.defer_to_thread(
+            pinfo, partial(self.flag_touched_ids, batch_size))
+        self.incremental["touched"] = yield from job
+        # stats for a full build: merged documents for changed sources, the
+        # same as previous build for others
+        previous = self.source_backend.build.find_one({"_id": self.incremental["from"]})
+        self.merge_stats = dict(previous.get("merge_stats") or {})
+        for src_name in self.incremental["sources"]:
+            self.merge_stats[src_name] = self.source_backend[src_name].count()
+        self.register_status("success",
+                             job={
+                                 "step": "merge-incremental",
+                                 "sources": list(self.incremental["sources"]),
+                                 "touched": self.incremental["touched"]
+                             })
+        return self.merge_stats
+
     def document_cleaner(self, src_name, *args, **kwargs):
         """
         Return a function taking a document as argument, cleaning the doc
@@ -888,7 +1120,21 @@ class DataBuilder(object):
                 "Query/filter involved, but also specific list of _ids. Ignoring query and use _ids"
             )
 
-        if _query and ids is None:
+        id_ranges = None
+        if self.partition_by_range and ids is None:
+            parts = math.ceil(total / batch_size)
+            id_ranges = get_id_ranges([self.source_backend[src_name]], parts)
+            if parts > 1 and len(id_ranges) == 1:
+                self.logger.info("Can't split '%s' in _id ranges (_ids aren't all strings), "
+                                 % src_name + "merging lists of _ids instead")
+                id_ranges = None
+            else:
+                self.logger.info("Split '%s' in %d _id range(s)" % (src_name, len(id_ranges)))
+
+        if id_ranges:
+            # one range per job, combined with _query in workers
+            id_provider = [[id_range] for id_range in id_ranges]
+        elif _query and ids is None:
             self.logger.info(
                 "Query/filter involved, can't use cache to fetch _ids")
             # use doc_feeder but post-process doc to keep only the _id
@@ -918,7 +1164,12 @@ class DataBuilder(object):
                 # try to put some async here to give control back
                 # (but everybody knows it's a blocking call: doc_feeder)
                 yield from asyncio.sleep(0.1)
-                cnt += len(doc_ids)
+                if isinstance(doc_ids[0], IdRange):
+                    # ranges hold about batch_size documents
+                    doc_ids = doc_ids[0]
+                    cnt = min(total, cnt + batch_size)
+                else:
+                    cnt += len(doc_ids)
                 pinfo = self.get_pinfo()
                 pinfo["step"] = src_name
                 pinfo["description"] = "#%d/%d (%.1f%%)" % (bnum, btotal,
@@ -930,7 +1181,8 @@ class DataBuilder(object):
                     partial(merger_worker, self.source_backend[src_name].name,
                             self.target_backend.target_name, doc_ids,
                             self.get_mapper_for_source(src_name, init=False),
-                            doc_cleaner, upsert, merger, bnum))
+                            doc_cleaner, upsert, merger, bnum,
+                            query=_query))
 
                 def batch_merged(f, batch_num):
                     nonlocal got_error
@@ -999,6 +1251,145 @@ class LinkDataBuilder(DataBuilder):
         return {"%s" % src_name: total}
 
 
+class SortedMergeDataBuilder(DataBuilder):
+    """
+    SortedMergeDataBuilder merges all sources in one pass instead of one
+    source after the other: source collections are read in _id order (using
+    _id index) and merged together in memory (k-way merge), and each merged
+    document is inserted once in the target collection, instead of being
+    upserted once per source. The work is split in _id ranges, one job per
+    range.
+
+    Sources using a mapper (documents' _id may change, and so the order) are
+    merged the regular way, once others are merged. The regular merge is also
+    used when merging specific _ids or into a non-empty target collection, or
+    if a root document source uses a mapper.
+    """
+
+    sorted_merge_parts = None  # number of _id ranges, defaults to HUB_MAX_WORKERS
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sorted_merged = {}  # source name => count, once merged in one pass
+
+    def get_sorted_sources(self, source_names):
+        """
+        Return sources from source_names which can be merged in one pass,
+        root document sources first.
+        """
+        if self.target_backend.count():
+            self.logger.info("Target collection isn't empty, use regular merge")
+            return []
+        root_sources = self.get_root_document_sources()
+        sources = []
+        for src_name in source_names:
+            mapper = self.get_mapper_for_source(src_name, init=False)
+            if isinstance(mapper, TransparentMapper):
+                sources.append(src_name)
+            elif src_name in root_sources:
+                self.logger.info("Root document source '%s' uses a mapper, use regular merge" %
+                                 src_name)
+                return []
+        if root_sources and not set(sources).intersection(root_sources):
+            # nothing to merge into
+            return []
+        return sorted(sources, key=lambda name: (name not in root_sources, name))
+
+    @asyncio.coroutine
+    def merge_sources(self,
+                      source_names,
+                      steps=["merge", "post"],
+                      batch_size=100000,
+                      ids=None,
+                      job_manager=None):
+        self.sorted_merged = {}
+        if type(steps) == str:
+            steps = [steps]
+        if "merge" in steps and ids is None:
+            sources = self.get_sorted_sources(source_names)
+            if sources:
+                self.register_status("building",
+                                     transient=True,
+                                     init=True,
+                                     job={
+                                         "step": "merge-sorted",
+                                         "sources": sources
+                                     })
+                self.sorted_merged = yield from self.merge_sorted(
+                    sources, batch_size, job_manager)
+                self.register_status("success",
+                                     job={
+                                         "step": "merge-sorted",
+                                         "sources": sources
+                                     })
+        # sources merged in one pass are skipped (see merge_source())
+        res = yield from super().merge_sources(source_names,
+                                               steps=steps,
+                                               batch_size=batch_size,
+                                               ids=ids,
+                                               job_manager=job_manager)
+        return res
+
+    @asyncio.coroutine
+    def merge_source(self, src_name, *args, **kwargs):
+        if src_name in self.sorted_merged:
+            return {"%s" % src_name: self.sorted_merged[src_name]}
+        res = yield from super().merge_source(src_name, *args, **kwargs)
+        return res
+
+    @asyncio.coroutine
+    def merge_sorted(self, source_names, batch_size, job_manager):
+        """
+        Merge source_names (root document sources first) in one pass,
+        return number of documents read per source
+        """
+        assert job_manager
+        cols = [self.source_backend[src_name] for src_name in source_names]
+        parts = self.sorted_merge_parts or getattr(
+            btconfig, "HUB_MAX_WORKERS", None) or os.cpu_count()
+        id_ranges = get_id_ranges(cols, parts)
+        self.logger.info("Merging %s in one pass, in %d _id range(s)" %
+                         (source_names, len(id_ranges)))
+        src_master = self.source_backend.master
+        mergers = [(src_master.find_one({"_id": src_name}) or {}).get("merger", "upsert")
+                   for src_name in source_names]
+        root_sources = self.get_root_document_sources()
+        jobs = []
+        got_error = False
+        for num, id_range in enumerate(id_ranges, start=1):
+            yield from asyncio.sleep(0.0)
+            pinfo = self.get_pinfo()
+            pinfo["step"] = "merge-sorted"
+            pinfo["description"] = "#%d/%d %s" % (num, len(id_ranges), repr(id_range))
+            job = yield from job_manager.defer_to_process(
+                pinfo,
+                partial(sorted_merger_worker,
+                        [col.name for col in cols],
+                        self.target_backend.target_name,
+                        id_range,
+                        [self.generate_document_query(src_name) for src_name in source_names],
+                        [self.document_cleaner(src_name) for src_name in source_names],
+                        mergers,
+                        [src_name in root_sources for src_name in source_names],
+                        batch_size, num))
+
+            def range_merged(f, num):
+                nonlocal got_error
+                if type(f.result()) != list:
+                    got_error = Exception("Range #%s failed while merging sources [%s]" %
+                                          (num, f.result()))
+
+            job.add_done_callback(partial(range_merged, num=num))
+            jobs.append(job)
+            if got_error:
+                raise got_error
+        results = yield from asyncio.gather(*jobs)
+        if got_error:
+            raise got_error
+        return {src_name: sum(res[i] for res in results)
+                for i, src_name in enumerate(source_names)}
+
+
 def fix_batch_duplicates(docs, fail_if_struct_is_different=False):
     """
     Remove duplicates from docs based on _id. If _id's the same but
@@ -1042,18 +1433,27 @@ def fix_batch_duplicates(docs, fail_if_struct_is_different=False):
 
 
 def merger_worker(col_name, dest_name, ids, mapper, cleaner, upsert, merger,
-                  batch_num):
+                  batch_num, query=None):
+    """
+    Merge documents from col_name into dest_name. "ids" is either a list of
+    _ids or an IdRange (see get_id_ranges()), read with one cursor. In the
+    latter case, documents must also match "query", if any.
+    """
     try:
         src = mongo.get_src_db()
         tgt = mongo.get_target_db()
         col = src[col_name]
         dest = DocMongoBackend(tgt, tgt[dest_name])
-        cur = doc_feeder(col,
-                         step=len(ids),
-                         inbatch=False,
-                         query={'_id': {
-                             '$in': ids
-                         }})
+        if isinstance(ids, IdRange):
+            cur = doc_feeder(col,
+                             step=10000,
+                             inbatch=False,
+                             query=id_range_query(ids, query))
+        else:
+            cur = doc_feeder(col,
+                             step=len(ids),
+                             inbatch=False,
+                             query=ids_query(ids))
         if cleaner:
             cur = map(cleaner, cur)
         mapper.load()
@@ -1095,6 +1495,63 @@ def merger_worker(col_name, dest_name, ids, mapper, cleaner, upsert, merger,
         raise
 
 
+def sorted_merger_worker(col_names, dest_name, id_range, queries, cleaners,
+                         mergers, roots, batch_size, batch_num):
+    """
+    Merge documents from collections col_names within id_range (see
+    get_id_ranges()), reading them in _id order. Documents with the same _id
+    are merged in col_names order and inserted once in dest_name. If any
+    root is set, only _ids found in a root collection are kept. Return the
+    number of documents read from each collection.
+    """
+    try:
+        src = mongo.get_src_db()
+        tgt = mongo.get_target_db()
+        dest = tgt[dest_name]
+        counts = [0] * len(col_names)
+
+        def sorted_docs(i):
+            cur = src[col_names[i]].find(id_range_query(id_range, queries[i]),
+                                         no_cursor_timeout=True)
+            cur = cur.sort("_id", 1).batch_size(batch_size)
+            if cleaners[i]:
+                cur = map(cleaners[i], cur)
+            # source index breaks ties so docs themselves are never compared
+            return ((id_sort_key(doc["_id"]), i, doc) for doc in cur)
+
+        docs = []
+        stored = 0
+        merged = heapq.merge(*[sorted_docs(i) for i in range(len(col_names))])
+        for _, group in groupby(merged, key=lambda e: e[0]):
+            group = list(group)
+            for _, i, _ in group:
+                counts[i] += 1
+            if any(roots) and not any(roots[i] for _, i, _ in group):
+                # no root document to merge into
+                continue
+            doc = {}
+            for _, i, sdoc in group:
+                if mergers[i] == "merge_struct" and doc:
+                    doc = merge_struct(doc, sdoc)
+                else:
+                    doc.update(sdoc)
+            docs.append(doc)
+            if len(docs) >= batch_size:
+                stored += len(dest.insert_many(docs, ordered=False).inserted_ids)
+                docs = []
+        if docs:
+            stored += len(dest.insert_many(docs, ordered=False).inserted_ids)
+        logging.info("Range #%s %s: %d documents stored" % (batch_num, repr(id_range), stored))
+        return counts
+    except Exception as e:
+        logger_name = "build_%s_range_%s" % (dest_name, batch_num)
+        logger, _ = get_logger(logger_name, btconfig.LOG_FOLDER)
+        logger.exception(e)
+        logger.error("col_names: %s, dest_name: %s, id_range: %s, " % (col_names, dest_name, repr(id_range))
+                     + "cleaners: %s, mergers: %s, roots: %s" % (cleaners, mergers, roots))
+        raise
+
+
 def set_pending_to_build(conf_name=None):
     src_build_config = get_src_build_config()
     qfilter = {}
@@ -1230,6 +1687,7 @@ class BuilderManager(BaseManager):
         target_db = mongo.get_target_db()
         col = target_db[merge_name]
         col.drop()
+        target_db[touched_collection_name(merge_name)].drop()
 
     def delete_merge(self, merge_name):
         """Delete merged collections and associated metadata"""
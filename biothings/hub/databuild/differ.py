@@ -10,11 +10,13 @@ import random
 
 from biothings.utils.common import timesofar, get_timestamp, \
     dump, rmdashfr, loadobj, md5sum
-from biothings.utils.mongo import id_feeder, get_target_db, get_previous_collection
+from biothings.utils.mongo import id_feeder, doc_feeder, get_target_db, \
+    get_previous_collection
 from biothings.utils.hub_db import get_src_build
 from biothings.utils.loggers import get_logger
 from biothings.utils.diff import diff_docs_jsonpatch
-from biothings.hub.databuild.backend import generate_folder
+from biothings.hub.databuild.backend import generate_folder, \
+    touched_collection_name
 from biothings import config as btconfig
 from biothings.utils.manager import BaseManager
 from .backend import create_backend, merge_src_build_metadata
@@ -328,7 +330,14 @@ class BaseDiffer(object):
             pinfo["source"] = "%s vs %s" % (content_new.target_name,
                                             content_old.target_name)
             pinfo["step"] = "content: new vs old"
-            data_new = id_feeder(content_new, batch_size=batch_size)
+            touched = self.get_touched_collection(content_old, content_new)
+            if touched:
+                self.logger.info(
+                    "'%s' built incrementally from '%s', comparing touched _ids only"
+                    % (content_new.target_name, content_old.target_name))
+                data_new = touched_id_feeder(touched, "update", batch_size)
+            else:
+                data_new = id_feeder(content_new, batch_size=batch_size)
             selfcontained = "selfcontained" in self.diff_type
             self.register_status("diffing",
                                  transient=True,
@@ -363,7 +372,10 @@ class BaseDiffer(object):
                 "Finished calculating diff for the new collection. Total number of docs updated: {}, added: {}"
                 .format(diff_stats["update"], diff_stats["add"]))
 
-            data_old = id_feeder(content_old, batch_size=batch_size)
+            if touched:
+                data_old = touched_id_feeder(touched, "delete", batch_size)
+            else:
+                data_old = id_feeder(content_old, batch_size=batch_size)
             jobs = []
             pinfo = self.get_pinfo()
             pinfo["source"] = "%s vs %s" % (content_old.target_name,
@@ -553,6 +565,22 @@ class BaseDiffer(object):
                            steps, mode, exclude))
         return job
 
+    def get_touched_collection(self, content_old, content_new):
+        """
+        If new collection was built incrementally from old one, return the
+        collection of touched _ids (only ones which can differ), otherwise None
+        """
+        if not isinstance(content_old, DocMongoBackend) or \
+                not isinstance(content_new, DocMongoBackend):
+            return None
+        new_doc = get_src_build().find_one({"_id": content_new.target_name}) or {}
+        if new_doc.get("incremental", {}).get("from") != content_old.target_name or \
+                content_old.target_collection.database.name != \
+                content_new.target_collection.database.name:
+            return None
+        return content_new.target_collection.database[
+            touched_collection_name(content_new.target_name)]
+
     def get_metadata(self):
         new_doc = get_src_build().find_one(
             {"_id": self.new.target_collection.name})
@@ -764,6 +792,16 @@ class ColdHotSelfContainedJsonDiffer(ColdHotJsonDifferBase,
     diff_type = "coldhot-jsondiff-selfcontained"
 
 
+def touched_id_feeder(col, op, batch_size):
+    """
+    Yield lists of _ids flagged with operation op ("update" or "delete") in
+    col, a touched _ids collection (see DataBuilder.merge_incremental())
+    """
+    for docs in doc_feeder(col, step=batch_size, inbatch=True,
+                           query={"op": op}, fields={"_id": 1}):
+        yield [d["_id"] for d in docs]
+
+
 def diff_worker_new_vs_old(id_list_new,
                            old_db_col_names,
                            new_db_col_names,
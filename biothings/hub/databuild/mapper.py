@@ -1,4 +1,17 @@
+import os
+import mmap
+import datetime
+import fcntl
+import struct
+import tempfile
+from array import array
+
+import dateutil.parser as dtparser
+
+from biothings import config as btconfig
+from biothings.utils.common import iter_n
 from biothings.utils.dataload import alwayslist
+from biothings.utils.hub_db import get_src_dump
 
 
 class BaseMapper(object):
@@ -84,6 +97,206 @@ class IDBaseMapper(BaseMapper):
         return self.map is None
 
 
+class MmapIDMapper(IDBaseMapper):
+    """
+    ID mapper whose mapping is compiled once in a sorted binary table on disk,
+    then memory-mapped by every process using it: the mapping is shared through
+    OS page cache instead of being loaded in each worker's memory.
+
+    Subclass and implement iter_mapping(), yielding (key, value) pairs where
+    value is an ID or a list of IDs. Keys and IDs are stored as strings:
+    unlike IDBaseMapper, keys are compared as strings too, so 123 and "123"
+    are the same key (and translate to the same IDs).
+    The table is compiled by the first process loading the mapper, if
+    missing or older than mapping_timestamp(), by default the date of the
+    last successful upload of mapping_collection (the mapper's name if
+    not specified), by the source mapping_source (mapping_collection if
+    not specified, set it when the collection is a sub-source).
+    """
+
+    MAGIC = b"BTIDMAP1"
+    SEP = "\x00"  # between IDs when a key maps to a list
+
+    def __init__(self, name=None, convert_func=None, mapping_file=None,
+                 mapping_collection=None, mapping_source=None, *args, **kwargs):
+        super(MmapIDMapper, self).__init__(name=name, convert_func=convert_func)
+        self.mapping_collection = mapping_collection or name
+        self.mapping_source = mapping_source or self.mapping_collection
+        self.mapping_file = mapping_file or os.path.join(
+            getattr(btconfig, "CACHE_FOLDER", None) or tempfile.gettempdir(),
+            "%s.idmap" % (name or "mapper"))
+        self.init_table()
+
+    def init_table(self):
+        self._mm = None
+        self._count = 0
+        self._key_offsets = None
+        self._value_offsets = None
+
+    def __getstate__(self):
+        # memory-map is re-opened by each process
+        state = self.__dict__.copy()
+        for k in ["_mm", "_key_offsets", "_value_offsets"]:
+            state[k] = None
+        return state
+
+    def iter_mapping(self):
+        """Yield (key, value) pairs, value being an ID or a list of IDs"""
+        raise NotImplementedError("sub-class and implement me")
+
+    def mapping_timestamp(self):
+        """
+        Return the timestamp of the mapping data, compiled tables older
+        than that are compiled again (None means never). Defaults to
+        when mapping_collection was last uploaded successfully, according
+        to src_dump. Override if the mapping comes from somewhere else.
+        """
+        if not self.mapping_collection:
+            return None
+        src_doc = get_src_dump().find_one({"_id": self.mapping_source}) or {}
+        job = src_doc.get("upload", {}).get("jobs", {}).get(self.mapping_collection, {})
+        started_at = job.get("started_at")
+        if job.get("status") != "success" or not started_at:
+            return None
+        if isinstance(started_at, str):
+            # ISO string from the sqlite hub_db
+            started_at = dtparser.parse(started_at)
+        if started_at.tzinfo is None:
+            # stored as UTC, returned without timezone
+            started_at = started_at.replace(tzinfo=datetime.timezone.utc)
+        return started_at.timestamp()
+
+    def need_compile(self):
+        if not os.path.exists(self.mapping_file):
+            return True
+        ts = self.mapping_timestamp()
+        return ts is not None and os.path.getmtime(self.mapping_file) < ts
+
+    def compile(self):
+        """
+        Compile mapping in mapping_file, unless another process just did.
+        Keys are sorted in memory.
+        """
+        with open(self.mapping_file + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not self.need_compile():
+                return
+            mapping = {}
+            for key, value in self.iter_mapping():
+                if type(value) == list:
+                    value = self.SEP.join([str(v) for v in value])
+                mapping[str(key).encode()] = str(value).encode()
+            keys = sorted(mapping)
+            key_offsets = array("Q")
+            value_offsets = array("Q")
+            pos = 16 + 2 * 8 * (len(keys) + 1)
+            for key in keys:
+                key_offsets.append(pos)
+                pos += len(key)
+            key_offsets.append(pos)
+            for key in keys:
+                value_offsets.append(pos)
+                pos += len(mapping[key])
+            value_offsets.append(pos)
+            tmpfile = self.mapping_file + ".tmp"
+            with open(tmpfile, "wb") as fout:
+                fout.write(struct.pack("<8sQ", self.MAGIC, len(keys)))
+                key_offsets.tofile(fout)
+                value_offsets.tofile(fout)
+                for key in keys:
+                    fout.write(key)
+                for key in keys:
+                    fout.write(mapping[key])
+            os.replace(tmpfile, self.mapping_file)
+
+    def load(self):
+        if not self.need_load():
+            return
+        if self.need_compile():
+            self.compile()
+        with open(self.mapping_file, "rb") as fin:
+            mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = struct.unpack_from("<8sQ", mm, 0)
+        if magic != self.MAGIC:
+            raise ValueError("'%s' isn't a compiled mapping file" % self.mapping_file)
+        view = memoryview(mm)
+        size = 8 * (count + 1)
+        self._key_offsets = view[16:16 + size].cast("Q")
+        self._value_offsets = view[16 + size:16 + 2 * size].cast("Q")
+        self._count = count
+        self._mm = mm
+
+    def need_load(self):
+        return self._mm is None
+
+    def _key(self, i):
+        return self._mm[self._key_offsets[i]:self._key_offsets[i + 1]]
+
+    def _value(self, i):
+        value = self._mm[self._value_offsets[i]:self._value_offsets[i + 1]].decode()
+        if self.SEP in value:
+            return value.split(self.SEP)
+        return value
+
+    def _find(self, key, lo=0):
+        """Index of first key >= key, searching from lo"""
+        hi = self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def translate(self, _id, transparent=False):
+        return self.translate_many([_id], transparent)[0]
+
+    def translate_many(self, ids, transparent=False):
+        """
+        Translate a list of _ids at once, returning the list of translated
+        IDs (same order). Not found _ids are returned as is if transparent,
+        None otherwise.
+        """
+        if self.need_load():
+            self.load()
+        conv = self.convert_func or (lambda x: x)
+        keys = [str(conv(_id)).encode() for _id in ids]
+        # search in key order, each search starting where previous one ended
+        found = {}
+        lo = 0
+        for key in sorted(set(keys)):
+            lo = self._find(key, lo)
+            if lo < self._count and self._key(lo) == key:
+                found[key] = self._value(lo)
+        # None is never a match
+        return [found.get(key, transparent and _id or None) if _id is not None else None
+                for _id, key in zip(ids, keys)]
+
+    def __contains__(self, _id):
+        return self.translate(_id) is not None
+
+    def __len__(self):
+        if self.need_load():
+            self.load()
+        return self._count
+
+    def process(self, docs, key_to_convert="_id", transparent=True, batch_size=10000):
+        """
+        Same as IDBaseMapper.process(), translating documents by batches
+        """
+        for batch in iter_n(docs, batch_size):
+            newids = self.translate_many([doc.get(key_to_convert) for doc in batch],
+                                         transparent)
+            for doc, _newid in zip(batch, newids):
+                if _newid is None and not transparent:
+                    continue
+                for _oneid in alwayslist(_newid):
+                    _oneid = str(_oneid)
+                    doc[key_to_convert] = _oneid
+                    yield doc
+
+
 class TransparentMapper(BaseMapper):
 
     def load(self, *args, **kwargs):
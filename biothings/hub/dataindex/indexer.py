@@ -16,21 +16,25 @@ from biothings.utils.loggers import get_logger
 from biothings.utils.manager import BaseManager
 from biothings.utils.es import ESIndexer
 from biothings import config as btconfig
-from biothings.utils.mongo import doc_feeder, id_feeder
+from biothings.utils.mongo import doc_feeder, id_feeder, get_id_ranges, \
+    ids_query, IdRange
 from config import LOG_FOLDER, logger as logging
-from biothings.hub.databuild.backend import create_backend, merge_src_build_metadata
+from biothings.hub.databuild.backend import create_backend, merge_src_build_metadata, \
+    touched_collection_name
 from biothings.hub import INDEXER_CATEGORY, INDEXMANAGER_CATEGORY
 
 
 def new_index_worker(col_name, ids, pindexer, batch_num):
+    """
+    Index documents from col_name, "ids" being a list of _ids
+    or an IdRange (see get_id_ranges())
+    """
     col = create_backend(col_name).target_collection
     idxer = pindexer()
     cur = doc_feeder(col,
-                     step=len(ids),
+                     step=len(ids) if type(ids) == list else 10000,
                      inbatch=False,
-                     query={'_id': {
-                         '$in': ids
-                     }})
+                     query=ids_query(ids))
     cnt = idxer.index_bulk(cur)
     return cnt
 
@@ -41,11 +45,9 @@ def merge_index_worker(col_name, ids, pindexer, batch_num):
     upd_cnt = 0
     new_cnt = 0
     cur = doc_feeder(col,
-                     step=len(ids),
+                     step=len(ids) if type(ids) == list else 10000,
                      inbatch=False,
-                     query={'_id': {
-                         '$in': ids
-                     }})
+                     query=ids_query(ids))
     docs = [d for d in cur]
     [d.pop("_timestamp", None) for d in docs]
     # dids = dict([(d["_id"], d) for d in docs])
@@ -77,10 +79,13 @@ def indexer_worker(col_name,
                    mode="index",
                    worker=new_index_worker):
     try:
-        if mode in ["index", "merge"]:
+        if mode in ["index", "merge", "update"]:
             return worker(col_name, ids, pindexer, batch_num)
         elif mode == "resume":
             idxr = pindexer()
+            if isinstance(ids, IdRange):
+                col = create_backend(col_name).target_collection
+                ids = [d["_id"] for d in col.find(ids_query(ids), {"_id": 1})]
             es_ids = idxr.mexists(ids)
             missing_ids = [e[0] for e in es_ids if e[1] is False]
             if missing_ids:
@@ -108,6 +113,10 @@ class Indexer(object):
     Basic indexer, reading documents from a mongo collection (target_name)
     and sending documents to ES.
     """
+    # give indexer jobs _id ranges (see get_id_ranges()) read with one cursor,
+    # instead of lists of _ids. _ids aren't checked before indexing then.
+    partition_by_range = False
+
     def __init__(self, es_host, target_name=None, **kwargs):
         self.host = es_host
         self.env = None
@@ -163,7 +172,12 @@ class Indexer(object):
                     or, if not pass, ES will be queried to identify which IDs are missing for each batch in
                     order to complete the index.
             - 'merge': will merge data with existing index' documents, used when populated several distinct times (cold/hot merge for instance)
+            - 'update': for a build merged incrementally (see DataBuilder.merge_incremental()), will use existing
+                    index, holding documents from the build it was built from, and only index touched _ids
+                    (and delete the ones which are gone). Other documents are left untouched in the index.
             - None (default): will create a new index, assuming it doesn't already exist
+
+        Note a new index needs every document, touched _ids are used in 'update' mode only.
         """
         assert job_manager
         # check what to do
@@ -208,12 +222,32 @@ class Indexer(object):
             if es_idxer.exists_index():
                 if mode == "purge":
                     es_idxer.delete_index()
-                elif mode not in ["resume", "merge"]:
+                elif mode not in ["resume", "merge", "update"]:
                     msg = "Index already '%s' exists, (use mode='purge' to auto-delete it or mode='resume' to add more documents)" % index_name
                     self.register_status("failed", job={"err": msg})
                     raise IndexerException(msg)
+            elif mode == "update":
+                msg = "Index '%s' doesn't exist, can't be updated" % index_name
+                self.register_status("failed", job={"err": msg})
+                raise IndexerException(msg)
 
-            if mode not in ["resume", "merge"]:
+            if mode == "update":
+                try:
+                    touched = self.get_touched_collection(index_name, target_collection)
+                except IndexerException as e:
+                    self.register_status("failed", job={"err": str(e)})
+                    raise
+                ids = [d["_id"] for d in touched.find({"op": "update"}, {"_id": 1})]
+                deleted = [d["_id"] for d in touched.find({"op": "delete"}, {"_id": 1})]
+                self.logger.info("Updating index '%s': %d touched document(s), %d deleted",
+                                 index_name, len(ids), len(deleted))
+                if deleted:
+                    pinfo = self.get_pinfo()
+                    pinfo["step"] = "delete"
+                    job = yield from job_manager.defer_to_thread(
+                        pinfo, partial(es_idxer.delete_docs, deleted))
+                    yield from job
+            elif mode not in ["resume", "merge"]:
                 try:
                     es_idxer.create_index({self.doc_type: _mapping}, _extra)
                 except Exception as e:
@@ -237,14 +271,28 @@ class Indexer(object):
                 return cleaned
 
             jobs = []
-            total = target_collection.count()
+            # only touched documents are indexed in "update" mode
+            total = len(ids) if mode == "update" else target_collection.count()
             btotal = math.ceil(total / batch_size)
             bnum = 1
-            if ids:
+            id_ranges = None
+            if self.partition_by_range and not ids and mode != "update":
+                id_ranges = get_id_ranges([target_collection], btotal)
+                if btotal > 1 and len(id_ranges) == 1:
+                    self.logger.info(
+                        "Can't split '%s' in _id ranges (_ids aren't all strings), "
+                        "indexing lists of _ids instead", target_name)
+                    id_ranges = None
+            if ids or mode == "update":
                 self.logger.info(
                     "Indexing from '%s' with specific list of _ids, create indexer job with batch_size=%d",
                     target_name, batch_size)
                 id_provider = iter_n(ids,batch_size)
+            elif id_ranges:
+                id_provider = id_ranges
+                self.logger.info(
+                    "Split '%s' in %d _id range(s), and create indexer job for each",
+                    target_name, len(id_provider))
             else:
                 self.logger.info(
                     "Fetch _ids from '%s', and create indexer job with batch_size=%d",
@@ -254,15 +302,19 @@ class Indexer(object):
                                         logger=self.logger)
             for ids in id_provider:
                 yield from asyncio.sleep(0.0)
-                origcnt = len(ids)
-                ids = clean_ids(ids)
-                newcnt = len(ids)
-                if origcnt != newcnt:
-                    self.logger.warning(
-                        "%d document(s) can't be indexed and will be skipped (invalid _id)",
-                        origcnt-newcnt)
-                # progress count
-                cnt += len(ids)
+                if isinstance(ids, IdRange):
+                    # ranges hold about batch_size documents
+                    cnt = min(total, cnt + batch_size)
+                else:
+                    origcnt = len(ids)
+                    ids = clean_ids(ids)
+                    newcnt = len(ids)
+                    if origcnt != newcnt:
+                        self.logger.warning(
+                            "%d document(s) can't be indexed and will be skipped (invalid _id)",
+                            origcnt-newcnt)
+                    # progress count
+                    cnt += len(ids)
                 pinfo = self.get_pinfo()
                 pinfo["step"] = self.target_name
                 try:
@@ -376,6 +428,23 @@ class Indexer(object):
             self.register_status("success")
             return {"%s" % self.index_name: cnt}
 
+    def get_touched_collection(self, index_name, target_collection):
+        """
+        Return collection of _ids touched by an incremental build (see
+        DataBuilder.flag_touched_ids()), used to update index_name in "update"
+        mode. Raise IndexerException if current build wasn't built incrementally
+        or if index_name wasn't created from the build it was built from.
+        """
+        incremental = self.build_doc.get("incremental") or {}
+        if not incremental.get("from"):
+            raise IndexerException("Build '%s' wasn't built incrementally, index needs every document" %
+                                   self.target_name)
+        previous = get_src_build().find_one({"_id": incremental["from"]}) or {}
+        if index_name not in previous.get("index", {}):
+            raise IndexerException("Index '%s' wasn't created from build '%s', can't be updated" %
+                                   (index_name, incremental["from"]))
+        return target_collection.database[touched_collection_name(target_collection.name)]
+
     def register_status(self, status, transient=False, init=False, **extra):
         assert self.build_doc
         src_build = get_src_build()
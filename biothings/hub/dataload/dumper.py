@@ -7,14 +7,19 @@ import asyncio
 from functools import partial
 import inspect
 import subprocess
+import hashlib
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from biothings.utils.hub_db import get_src_dump
-from biothings.utils.common import timesofar, rmdashfr
+from biothings.utils.common import timesofar, rmdashfr, dotdict
 from biothings.utils.loggers import get_logger
 from biothings.hub import DUMPER_CATEGORY, UPLOADER_CATEGORY
 from biothings import config as btconfig
 from biothings.utils.manager import BaseSourceManager, ResourceError
 from biothings.hub.dataload.uploader import set_pending_to_upload
+from biothings.hub.dataload.metrics import summarize_dump
 
 logging = btconfig.logger
 
@@ -44,6 +49,9 @@ class BaseDumper(object):
 
     SCHEDULE = None  # crontab format schedule, if None, won't be scheduled
 
+    # number of dump metrics kept in src_dump (metrics.download)
+    KEEP_METRICS = 30
+
     def __init__(self,
                  src_name=None,
                  src_root_folder=None,
@@ -60,6 +68,15 @@ class BaseDumper(object):
         self.t0 = time.time()
         self.logfile = None
         self.prev_data_folder = None
+        # information returned by download() as a dict, if any, recorded
+        # in src_dump once dumped (download.files)
+        self.dumped_files = []
+        # previous release's files, by URL (see HTTPDumper.BLOB_STORE)
+        self.prev_manifest = {}
+        # (local file, download time) for each file, summarized in
+        # self.metrics once dumped
+        self.download_times = []
+        self.metrics = None
         self.timestamp = time.strftime('%Y%m%d')
         self.prepared = False
         self.steps = ["dump", "post"]
@@ -152,7 +169,8 @@ class BaseDumper(object):
     def download(self, remotefile, localfile):
         """
         Download "remotefile' to local location defined by 'localfile'
-        Return relevant information about remotefile (depends on the actual client)
+        Return relevant information about remotefile (depends on the actual client).
+        If a dict is returned, it's recorded in src_dump (download.files)
         """
         raise NotImplementedError("Define in subclass")
 
@@ -247,6 +265,15 @@ class BaseDumper(object):
             self.src_doc["download"].update(extra["download"])
         else:
             self.src_doc.update(extra)
+        if self.src_doc["download"].get("metrics"):
+            # keep metrics from previous dumps so they can be compared
+            record = dict(self.src_doc["download"]["metrics"],
+                          release=release,
+                          status=status,
+                          finished_at=datetime.now().astimezone())
+            metrics = self.src_doc.setdefault("metrics", {})
+            metrics["download"] = (metrics.get("download", []) +
+                                   [record])[-self.__class__.KEEP_METRICS:]
         self.src_dump.save(self.src_doc)
 
     @asyncio.coroutine
@@ -327,7 +354,12 @@ class BaseDumper(object):
                 if got_error:
                     raise got_error
                 # set it to success at the very end
-                self.register_status("success")
+                download = {}
+                if self.dumped_files:
+                    download["files"] = self.dumped_files
+                if self.metrics:
+                    download["metrics"] = self.metrics
+                self.register_status("success", download=download)
                 if self.__class__.AUTO_UPLOAD:
                     set_pending_to_upload(self.src_name)
                 self.logger.info("success %s" % strargs,
@@ -422,14 +454,24 @@ class BaseDumper(object):
         courtesy_wait = self.__class__.SLEEP_BETWEEN_DOWNLOAD
         got_error = None
         jobs = []
+        self.dumped_files = []
+        self.download_times = []
+        t0 = time.time()
         self.unprepare()
+
+        def timed(local, started, f):
+            if not f.exception():
+                self.download_times.append((local, time.time() - started))
+
         for todo in self.to_dump:
             remote = todo["remote"]
             local = todo["local"]
 
             def done(f):
                 try:
-                    _ = f.result()
+                    res = f.result()
+                    if isinstance(res, dict):
+                        self.dumped_files.append(res)
                     nonlocal max_dump
                     nonlocal got_error
                     if max_dump:
@@ -451,6 +493,7 @@ class BaseDumper(object):
             job = yield from job_manager.defer_to_process(
                 pinfo, partial(self.download, remote, local))
             job.add_done_callback(done)
+            job.add_done_callback(partial(timed, local, time.time()))
             jobs.append(job)
             # raise error as soon as we get it:
             # 1. it prevents from launching things for nothing
@@ -461,6 +504,7 @@ class BaseDumper(object):
         yield from asyncio.gather(*jobs)
         if got_error:
             raise got_error
+        self.metrics = summarize_dump(self.download_times, time.time() - t0)
         self.logger.info("%s successfully downloaded" % self.SRC_NAME)
         self.to_dump = []
 
@@ -669,6 +713,7 @@ class LastModifiedFTPDumper(LastModifiedBaseDumper):
 
 
 import requests
+import aiohttp
 
 
 class HTTPDumper(BaseDumper):
@@ -681,6 +726,36 @@ class HTTPDumper(BaseDumper):
 
     # when available
 
+    # downloaded data can be hashed and decompressed while being written, in
+    # one pass. CHECKSUM is a hashlib algorithm ("md5", "sha256", ...) applied
+    # to downloaded data and recorded in src_dump. DECOMPRESS ("gzip", "bz2",
+    # "xz", or True to guess from file extension) also writes the decompressed
+    # file (without extension). KEEP_COMPRESSED=False then skips the
+    # compressed one.
+    CHECKSUM = None
+    DECOMPRESS = False
+    KEEP_COMPRESSED = True
+
+    # files of at least SEGMENT_MIN_SIZE bytes are downloaded as SEGMENTS
+    # byte ranges fetched concurrently, if server supports ranges. Progress
+    # is saved in "<localfile>.segments" so an interrupted download resumes
+    # missing parts only, as long as the remote file didn't change.
+    SEGMENTS = 1
+    SEGMENT_MIN_SIZE = 64 * 1024 * 1024
+    SEGMENT_SAVE_EVERY = 16 * 1024 * 1024  # bytes between progress saves
+
+    # keep downloaded files in a content-addressed store shared by releases,
+    # SRC_ROOT_FOLDER/.blobs, listing them in each release's MANIFEST_FILE.
+    # Files identical to the previous release's ones (same ETag, or same
+    # Last-Modified and size) are hard-linked from the store instead of being
+    # downloaded. Files are then shared by releases: don't modify them in place.
+    # Decompressed files (see DECOMPRESS) are stored too. Stored files not
+    # listed by the BLOB_KEEP_RELEASES latest releases are removed from the
+    # store after each dump (release folders still hold them).
+    BLOB_STORE = False
+    BLOB_KEEP_RELEASES = 2
+    MANIFEST_FILE = ".manifest.json"
+
     def prepare_client(self):
         self.client = requests.Session()
         self.client.verify = self.__class__.VERIFY_CERT
@@ -695,8 +770,39 @@ class HTTPDumper(BaseDumper):
     def remote_is_better(self, remotefile, localfile):
         return True
 
+    @asyncio.coroutine
+    def do_dump(self, job_manager=None):
+        if self.__class__.BLOB_STORE:
+            self.prev_manifest = self.load_manifest(self.current_data_folder)
+        yield from super(HTTPDumper, self).do_dump(job_manager=job_manager)
+        if self.__class__.BLOB_STORE:
+            self.save_manifest()
+            self.prune_blobs()
+
     def download(self, remoteurl, localfile, headers={}):
         self.prepare_local_folders(localfile)
+        if not self.__class__.BLOB_STORE:
+            return self.fetch(remoteurl, localfile, headers)
+        head = self.client.head(remoteurl, allow_redirects=True, headers=headers)
+        if head.status_code == 200:
+            info = self.reuse_blob(remoteurl, head.headers, localfile)
+            if info:
+                return info
+        info = self.fetch(remoteurl, localfile, headers, head)
+        if isinstance(info, dict):
+            info = self.store_blob(remoteurl, head.headers, info, localfile)
+        return info
+
+    def fetch(self, remoteurl, localfile, headers={}, head=None):
+        """
+        Actually download remoteurl as localfile. "head" is the response
+        to a HEAD request already sent for remoteurl, if any.
+        """
+        if self.__class__.SEGMENTS > 1:
+            res = head or self.client.head(remoteurl, allow_redirects=True, headers=headers)
+            if self.segmentable(res.status_code, res.headers):
+                localfile = self.resolve_filename(res, localfile)
+                return self.download_segments(res, localfile, headers)
         res = self.client.get(remoteurl, stream=True, headers=headers)
         if not res.status_code == 200:
             if res.status_code in self.__class__.IGNORE_HTTP_CODE:
@@ -706,6 +812,18 @@ class HTTPDumper(BaseDumper):
             else:
                 raise DumperException("Error while downloading '%s' (status: %s, reason: %s)" %
                                       (remoteurl, res.status_code, res.reason))
+        localfile = self.resolve_filename(res, localfile)
+        self.logger.debug("Downloading '%s' as '%s'" % (remoteurl, localfile))
+        if self.get_checksum() or self.__class__.DECOMPRESS:
+            return self.write_stream(res.iter_content(chunk_size=512 * 1024), localfile)
+        fout = open(localfile, 'wb')
+        for chunk in res.iter_content(chunk_size=512 * 1024):
+            if chunk:
+                fout.write(chunk)
+        fout.close()
+        return res
+
+    def resolve_filename(self, res, localfile):
         # issue biothings.api #3: take filename from header if specified
         # note: this has to explicit, either on a globa (class) level or per file to dump
         if self.__class__.RESOLVE_FILENAME and res.headers.get(
@@ -717,13 +835,477 @@ class HTTPDumper(BaseDumper):
                 # localfile is an absolute path, replace last part
                 localfile = os.path.join(os.path.dirname(localfile),
                                          parsed[1]["filename"])
-        self.logger.debug("Downloading '%s' as '%s'" % (remoteurl, localfile))
-        fout = open(localfile, 'wb')
-        for chunk in res.iter_content(chunk_size=512 * 1024):
-            if chunk:
-                fout.write(chunk)
-        fout.close()
-        return res
+        return localfile
+
+    def segmentable(self, status, headers):
+        """
+        Return True if file described by HEAD response status and headers
+        should be downloaded in segments (see SEGMENTS)
+        """
+        return self.__class__.SEGMENTS > 1 and status == 200 and \
+            headers.get("accept-ranges") == "bytes" and \
+            int(headers.get("content-length", 0)) >= self.__class__.SEGMENT_MIN_SIZE
+
+    def download_segments(self, head, localfile, headers={}):
+        """
+        Download URL from HEAD response 'head' as SEGMENTS byte ranges
+        written concurrently in localfile, resuming a previous attempt
+        if its progress file matches the remote file.
+        """
+        manifestfile = localfile + ".segments"
+        remote = {
+            "url": head.url,
+            "size": int(head.headers["content-length"]),
+            "etag": head.headers.get("etag"),
+            "last_modified": head.headers.get("last-modified"),
+        }
+        manifest = None
+        if os.path.exists(manifestfile) and os.path.exists(localfile):
+            try:
+                with open(manifestfile) as in_f:
+                    manifest = json.load(in_f)
+            except ValueError:
+                pass
+            if manifest and any(manifest.get(k) != v for k, v in remote.items()):
+                self.logger.info("Remote file '%s' changed, can't resume download" % head.url)
+                manifest = None
+        if manifest:
+            self.logger.info("Resuming download of '%s' as '%s'" % (head.url, localfile))
+        else:
+            self.logger.debug("Downloading '%s' as '%s' in %d segments" %
+                              (head.url, localfile, self.__class__.SEGMENTS))
+            size = remote["size"]
+            bounds = [size * i // self.__class__.SEGMENTS
+                      for i in range(self.__class__.SEGMENTS + 1)]
+            # [start, end, bytes already downloaded]
+            manifest = dict(remote, segments=[[start, end, 0] for start, end in zip(bounds, bounds[1:])])
+            with open(localfile, "wb") as fout:
+                fout.truncate(size)
+        lock = threading.Lock()
+
+        def save_manifest():
+            with lock:
+                with open(manifestfile + ".tmp", "w") as out_f:
+                    json.dump(manifest, out_f)
+                os.replace(manifestfile + ".tmp", manifestfile)
+
+        def fetch(segment):
+            start, end, done = segment
+            if start + done >= end:
+                return
+            session = requests.Session()
+            session.verify = self.__class__.VERIFY_CERT
+            hdrs = dict(headers, Range="bytes=%d-%d" % (start + done, end - 1))
+            try:
+                res = session.get(head.url, stream=True, headers=hdrs)
+                if res.status_code != 206:
+                    raise DumperException("Error while downloading '%s' %s (status: %s, reason: %s)" %
+                                          (head.url, hdrs["Range"], res.status_code, res.reason))
+                unsaved = 0
+                with open(localfile, "r+b") as fout:
+                    fout.seek(start + done)
+                    for chunk in res.iter_content(chunk_size=512 * 1024):
+                        chunk = chunk[:end - start - segment[2]]
+                        fout.write(chunk)
+                        segment[2] += len(chunk)
+                        unsaved += len(chunk)
+                        if unsaved >= self.__class__.SEGMENT_SAVE_EVERY:
+                            fout.flush()
+                            save_manifest()
+                            unsaved = 0
+                if start + segment[2] < end:
+                    raise DumperException("Incomplete download of '%s' %s" % (head.url, hdrs["Range"]))
+            finally:
+                session.close()
+
+        save_manifest()
+        try:
+            with ThreadPoolExecutor(max_workers=len(manifest["segments"])) as executor:
+                # list() to raise the first error, if any
+                list(executor.map(fetch, manifest["segments"]))
+        finally:
+            save_manifest()
+        os.remove(manifestfile)
+
+        if self.get_checksum() or self.__class__.DECOMPRESS:
+            return self.write_stream(iter_file(localfile), localfile, written=True)
+        return {"file": os.path.basename(localfile), "size": remote["size"]}
+
+    def write_stream(self, chunks, localfile, written=False):
+        """
+        Write data chunks to localfile, hashing and decompressing them on the
+        fly according to CHECKSUM, DECOMPRESS and KEEP_COMPRESSED. Return a
+        dict describing files written, to be recorded in src_dump.
+        If written, chunks were already written in localfile, they're only
+        hashed and decompressed.
+        """
+        writer = self.new_writer(localfile, written)
+        try:
+            for chunk in chunks:
+                writer.write(chunk)
+        finally:
+            writer.close()
+        return writer.info()
+
+    def get_checksum(self):
+        """Hash algorithm applied to downloaded files, if any"""
+        return self.__class__.CHECKSUM or (self.__class__.BLOB_STORE and "sha256") or None
+
+    def blob_path(self, digest):
+        return os.path.join(self.src_root_folder, ".blobs", self.get_checksum(),
+                            digest[:2], digest)
+
+    def load_manifest(self, data_folder):
+        """Return files listed in data_folder's manifest, by URL"""
+        try:
+            with open(os.path.join(data_folder, self.__class__.MANIFEST_FILE)) as in_f:
+                return json.load(in_f)["files"]
+        except (TypeError, OSError, ValueError, KeyError):
+            return {}
+
+    def save_manifest(self):
+        files = {info["url"]: info for info in self.dumped_files if info.get("url")}
+        with open(os.path.join(self.new_data_folder, self.__class__.MANIFEST_FILE), "w") as out_f:
+            json.dump({"release": self.release, "files": files}, out_f, indent=2, default=str)
+
+    def reuse_blob(self, remoteurl, headers, localfile):
+        """
+        If remoteurl didn't change since the previous release, according to
+        response headers, link its stored files (downloaded and decompressed)
+        in localfile's folder and return their information. Return None otherwise.
+        """
+        prev = self.prev_manifest.get(remoteurl)
+        algo = self.get_checksum()
+        if not prev or not prev.get(algo):
+            return None
+        if headers.get("etag"):
+            same = headers["etag"] == prev.get("etag")
+        else:
+            same = headers.get("last-modified") and \
+                headers["last-modified"] == prev.get("last_modified") and \
+                int(headers.get("content-length", -1)) == prev.get("size")
+        blobs = self.get_blobs(prev)
+        if not same or not blobs or not all(os.path.exists(blob) for blob in blobs.values()):
+            return None
+        for filename, blob in blobs.items():
+            path = os.path.join(os.path.dirname(localfile), filename)
+            self.logger.debug("'%s' unchanged, linking '%s' as '%s'" % (remoteurl, blob, path))
+            if os.path.exists(path):
+                os.remove(path)
+            os.link(blob, path)
+        info = dict(prev)
+        info["reused"] = True
+        return info
+
+    def store_blob(self, remoteurl, headers, info, localfile):
+        """
+        Store files downloaded from remoteurl (and decompressed), described by
+        info, in the blob store, or link them to already stored identical files.
+        Return info completed with remote file information.
+        """
+        info.update({"url": remoteurl, "etag": headers.get("etag"),
+                     "last_modified": headers.get("last-modified")})
+        for filename, blob in self.get_blobs(info).items():
+            path = os.path.join(os.path.dirname(localfile), filename)
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            try:
+                os.link(path, blob)
+            except FileExistsError:
+                # same content already stored, share it
+                os.remove(path)
+                os.link(blob, path)
+        return info
+
+    def get_blobs(self, info):
+        """
+        Return {filename: blob path} for files described by info (see write_stream()),
+        decompressed data being stored next to the downloaded data's blob
+        """
+        digest = info.get(self.get_checksum())
+        if not digest:
+            return {}
+        blobs = {}
+        if info.get("file"):
+            blobs[info["file"]] = self.blob_path(digest)
+        if info.get("decompressed"):
+            blobs[info["decompressed"]["file"]] = self.blob_path(digest) + ".decompressed"
+        return blobs
+
+    def prune_blobs(self):
+        """
+        Remove stored files not listed in the manifests of the BLOB_KEEP_RELEASES
+        latest releases. Release folders still hold them (blobs are hard links),
+        they just can't be reused anymore.
+        """
+        store = os.path.join(self.src_root_folder, ".blobs", self.get_checksum())
+        if not os.path.isdir(store):
+            return
+        manifests = [os.path.join(self.src_root_folder, name, self.__class__.MANIFEST_FILE)
+                     for name in os.listdir(self.src_root_folder) if not name.startswith(".")]
+        manifests = sorted((m for m in manifests if os.path.exists(m)), key=os.path.getmtime)
+        keep = set()
+        for manifest in manifests[-self.__class__.BLOB_KEEP_RELEASES:]:
+            for info in self.load_manifest(os.path.dirname(manifest)).values():
+                keep.update(self.get_blobs(info).values())
+        removed = 0
+        for folder in os.listdir(store):
+            for name in os.listdir(os.path.join(store, folder)):
+                blob = os.path.join(store, folder, name)
+                if blob not in keep:
+                    os.remove(blob)
+                    removed += 1
+        if removed:
+            self.logger.info("Removed %d file(s) from blob store '%s'" % (removed, store))
+
+    def new_writer(self, localfile, written=False):
+        return DownloadWriter(localfile,
+                              checksum=self.get_checksum(),
+                              decompress=self.__class__.DECOMPRESS,
+                              keep_compressed=self.__class__.KEEP_COMPRESSED,
+                              written=written)
+
+
+class DownloadWriter(object):
+    """
+    Write downloaded data chunks to localfile, optionally hashing them with
+    hashlib algorithm checksum, and writing them decompressed in localfile
+    without extension (see HTTPDumper.DECOMPRESS)
+    """
+
+    def __init__(self, localfile, checksum=None, decompress=False,
+                 keep_compressed=True, written=False):
+        self.localfile = localfile
+        self.checksum = checksum
+        self.keep_compressed = keep_compressed
+        self.written = written
+        self.size = 0
+        self.hasher = checksum and hashlib.new(checksum)
+        if decompress is True:
+            decompress = StreamDecompressor.guess(localfile)
+        self.decompressor = decompress and StreamDecompressor(decompress)
+        self.decodedfile = self.decompressor and os.path.splitext(localfile)[0]
+        self.fout = None
+        self.dout = None
+        if not written and (not self.decompressor or keep_compressed):
+            self.fout = open(localfile, 'wb')
+        if self.decompressor:
+            self.dout = open(self.decodedfile, 'wb')
+
+    def write(self, chunk):
+        if not chunk:
+            return
+        self.size += len(chunk)
+        if self.hasher:
+            self.hasher.update(chunk)
+        if self.fout:
+            self.fout.write(chunk)
+        if self.dout:
+            self.dout.write(self.decompressor.decompress(chunk))
+
+    def close(self):
+        for out in (self.fout, self.dout):
+            if out:
+                out.close()
+
+    def info(self):
+        """Return a dict describing files written"""
+        info = {"file": os.path.basename(self.localfile), "size": self.size}
+        if self.hasher:
+            info[self.checksum] = self.hasher.hexdigest()
+        if self.decompressor:
+            if not self.decompressor.eof:
+                raise DumperException("Truncated compressed data in '%s'" % self.localfile)
+            info["decompressed"] = {"file": os.path.basename(self.decodedfile),
+                                    "size": os.path.getsize(self.decodedfile)}
+            if not self.keep_compressed:
+                if self.written:
+                    os.remove(self.localfile)
+                info["file"] = None  # compressed file not kept
+        return info
+
+
+def iter_file(path, chunk_size=512 * 1024):
+    with open(path, "rb") as in_f:
+        yield from iter(partial(in_f.read, chunk_size), b'')
+
+
+class StreamDecompressor(object):
+    """
+    Incremental decompression of gzip, bz2 or xz data, including data
+    made of several concatenated streams (eg. bgzip or pbzip2 files)
+    """
+    EXTENSIONS = {".gz": "gzip", ".bz2": "bz2", ".xz": "xz"}
+
+    def __init__(self, compression):
+        assert compression in self.EXTENSIONS.values(), \
+            "Unsupported compression '%s'" % compression
+        self.compression = compression
+        self.decompressor = self.new_decompressor()
+        self.eof = False
+
+    @classmethod
+    def guess(klass, filename):
+        return klass.EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+
+    def new_decompressor(self):
+        if self.compression == "gzip":
+            import zlib
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.compression == "bz2":
+            import bz2
+            return bz2.BZ2Decompressor()
+        else:
+            import lzma
+            return lzma.LZMADecompressor()
+
+    def decompress(self, data):
+        decoded = []
+        while data:
+            if self.eof:
+                # another stream starts
+                self.decompressor = self.new_decompressor()
+            decoded.append(self.decompressor.decompress(data))
+            self.eof = self.decompressor.eof
+            data = self.decompressor.unused_data if self.eof else b''
+        return b''.join(decoded)
+
+
+class AsyncHTTPDumper(HTTPDumper):
+    """
+    HTTPDumper running downloads within the hub's event loop, with aiohttp,
+    instead of one process per file: all downloads share a connection pool,
+    and at most MAX_PARALLEL_DUMP_PER_HOST files (MAX_PARALLEL_DUMP overall)
+    are downloaded at the same time from a host. Processes are then left to
+    CPU-bound jobs, and sources with many small files get dumped faster.
+    Downloaded files are always recorded in src_dump (download.files).
+
+    Writing, hashing and decompressing data run in the loop's default
+    executor, and files to download in SEGMENTS are fetched by threads
+    (see download_segments()), so the loop itself only receives data.
+    Before each download, job manager's constraints and predicates (see
+    get_predicates()) are checked, but downloads aren't registered as jobs:
+    they're not listed among the hub's running jobs.
+    """
+    MAX_PARALLEL_DUMP_PER_HOST = 8
+    DOWNLOAD_TIMEOUT = 24 * 60 * 60  # seconds, per file
+
+    async def do_dump(self, job_manager=None):
+        self.logger.info("%d file(s) to download" % len(self.to_dump))
+        if self.__class__.BLOB_STORE:
+            self.prev_manifest = self.load_manifest(self.current_data_folder)
+        max_dump = self.__class__.MAX_PARALLEL_DUMP and asyncio.Semaphore(
+            self.__class__.MAX_PARALLEL_DUMP)
+        per_host = {}
+        self.dumped_files = []
+        self.download_times = []
+        t0 = time.time()
+        connector = aiohttp.TCPConnector(ssl=None if self.__class__.VERIFY_CERT else False)
+        timeout = aiohttp.ClientTimeout(total=self.__class__.DOWNLOAD_TIMEOUT)
+
+        async def dump(session, remote, local):
+            host = urlparse.urlsplit(remote).netloc
+            if host not in per_host:
+                per_host[host] = asyncio.Semaphore(self.__class__.MAX_PARALLEL_DUMP_PER_HOST)
+            async with per_host[host]:
+                if max_dump:
+                    await max_dump.acquire()
+                try:
+                    if job_manager:
+                        await job_manager.ok_to_run.acquire()
+                        try:
+                            await job_manager.check_constraints(self.get_pinfo())
+                        finally:
+                            job_manager.ok_to_run.release()
+                    if self.__class__.SLEEP_BETWEEN_DOWNLOAD:
+                        await asyncio.sleep(self.__class__.SLEEP_BETWEEN_DOWNLOAD)
+                    started = time.time()
+                    info = await self.download_async(session, remote, local)
+                    self.download_times.append((local, time.time() - started))
+                finally:
+                    if max_dump:
+                        max_dump.release()
+            self.post_download(remote, local)
+            return info
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            jobs = [asyncio.ensure_future(dump(session, todo["remote"], todo["local"]))
+                    for todo in self.to_dump]
+            try:
+                for info in await asyncio.gather(*jobs):
+                    if info:
+                        self.dumped_files.append(info)
+            except Exception as e:
+                self.logger.exception("Error downloading files: %s" % e)
+                for job in jobs:
+                    job.cancel()
+                raise
+        if self.__class__.BLOB_STORE:
+            self.save_manifest()
+            await asyncio.get_event_loop().run_in_executor(None, self.prune_blobs)
+        self.metrics = summarize_dump(self.download_times, time.time() - t0)
+        self.logger.info("%s successfully downloaded" % self.SRC_NAME)
+        self.to_dump = []
+
+    async def download_async(self, session, remoteurl, localfile, headers={}):
+        """
+        Same as download(), using aiohttp session. Return a dict describing
+        files written (see write_stream()).
+        """
+        loop = asyncio.get_event_loop()
+        self.prepare_local_folders(localfile)
+        head = None
+        if self.__class__.BLOB_STORE or self.__class__.SEGMENTS > 1:
+            async with session.head(remoteurl, allow_redirects=True, headers=headers) as res:
+                head = res
+        if self.__class__.BLOB_STORE and head.status == 200:
+            info = await loop.run_in_executor(
+                None, partial(self.reuse_blob, remoteurl, head.headers, localfile))
+            if info:
+                return info
+        info = await self.fetch_async(session, remoteurl, localfile, headers, head)
+        if self.__class__.BLOB_STORE and info:
+            info = await loop.run_in_executor(
+                None, partial(self.store_blob, remoteurl, head.headers, info, localfile))
+        return info
+
+    async def fetch_async(self, session, remoteurl, localfile, headers={}, head=None):
+        """
+        Same as fetch(), using aiohttp session. "head" is the response to a
+        HEAD request already sent for remoteurl, if any.
+        """
+        loop = asyncio.get_event_loop()
+        if head is not None and self.segmentable(head.status, head.headers):
+            localfile = self.resolve_filename(head, localfile)
+            # download_segments() only needs the URL and headers of a response
+            head = dotdict({"url": str(head.url), "headers": head.headers})
+            return await loop.run_in_executor(
+                None, partial(self.download_segments, head, localfile, headers))
+        async with session.get(remoteurl, headers=headers) as res:
+            if not res.status == 200:
+                if res.status in self.__class__.IGNORE_HTTP_CODE:
+                    self.logger.info("Remote URL %s gave http code %s, ignored" %
+                                     (remoteurl, res.status))
+                    return
+                else:
+                    raise DumperException("Error while downloading '%s' (status: %s, reason: %s)" %
+                                          (remoteurl, res.status, res.reason))
+            localfile = self.resolve_filename(res, localfile)
+            self.logger.debug("Downloading '%s' as '%s'" % (remoteurl, localfile))
+            writer = await loop.run_in_executor(None, self.new_writer, localfile)
+            pending = None
+            try:
+                async for chunk in res.content.iter_chunked(512 * 1024):
+                    # previous chunk is written while this one is received
+                    if pending:
+                        await pending
+                    pending = loop.run_in_executor(None, writer.write, chunk)
+                if pending:
+                    await pending
+            finally:
+                if pending:
+                    await asyncio.wait([pending])
+                await loop.run_in_executor(None, writer.close)
+        return await loop.run_in_executor(None, writer.info)
 
 
 class LastModifiedHTTPDumper(HTTPDumper, LastModifiedBaseDumper):
@@ -0,0 +1,164 @@
+"""
+Throughput metrics recorded for dump and upload steps, stored in src_dump
+so they can be compared across releases.
+"""
+import os
+import time
+import resource
+
+from biothings.utils.common import FileRange
+
+
+def percentiles(values, pcts=(50, 90, 99)):
+    """
+    Return {"p50": ..., "p90": ..., "p99": ..., "max": ...} for given
+    values (nearest-rank), or {} if no values
+    """
+    if not values:
+        return {}
+    values = sorted(values)
+    res = {}
+    for pct in pcts:
+        rank = max(0, -(-len(values) * pct // 100) - 1)
+        res["p%s" % pct] = round(values[rank], 4)
+    res["max"] = round(values[-1], 4)
+    return res
+
+
+def peak_rss():
+    """Peak resident memory of the current process, in bytes"""
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def input_size(*args):
+    """
+    Size in bytes of the data given to a parser: files, folders
+    (all files within) and file ranges found in args. Other args are ignored,
+    as well as files and folders given more than once (eg. a data folder
+    passed to several parallelized jobs).
+    """
+    size = 0
+    seen = set()
+    for arg in args:
+        if isinstance(arg, str):
+            if arg in seen:
+                continue
+            seen.add(arg)
+        if isinstance(arg, FileRange):
+            size += arg.length
+        elif isinstance(arg, str) and os.path.isfile(arg):
+            size += os.path.getsize(arg)
+        elif isinstance(arg, str) and os.path.isdir(arg):
+            for root, _, files in os.walk(arg):
+                for fn in files:
+                    path = os.path.join(root, fn)
+                    if not os.path.islink(path):
+                        size += os.path.getsize(path)
+    return size
+
+
+class UploadMetrics(object):
+    """
+    Collect metrics for an upload worker: the storage reports the duration
+    of each write to the database (see BaseStorage.timed_write), giving batch
+    latencies and writing time. The rest of the time counts as parsing (so
+    storages' own work, like hashing or merging, is part of parsing), unless
+    the storage parses and writes in different threads (PipelinedStorage).
+
+        metrics = UploadMetrics()
+        data = metrics.load(load_data, data_folder)
+        storage.on_write = metrics.on_write
+        cnt = storage.process(data, batch_size)
+        metrics.finish(storage, cnt)
+    """
+
+    def __init__(self):
+        self.t0 = time.time()
+        self.info = {
+            "docs": 0,
+            "parse_time": 0.0,
+            "write_time": 0.0,
+            "batch_latencies": [],
+        }
+
+    def load(self, loaddata_func, *args):
+        """
+        Call loaddata_func(*args) and return its data. Time spent in the
+        call itself is only significant for parsers returning a dict.
+        """
+        t1 = time.time()
+        docs = loaddata_func(*args)
+        self.info["parse_time"] += time.time() - t1
+        return docs
+
+    def on_write(self, elapsed):
+        # list.append() is atomic, writer threads can call it
+        self.info["batch_latencies"].append(elapsed)
+
+    def finish(self, storage=None, count=None):
+        """
+        Return collected metrics, including the ones from storage
+        (PipelinedStorage's parsing time and queue waits)
+        """
+        info = self.info
+        info["time"] = time.time() - self.t0
+        info["docs"] = count or 0
+        info["write_time"] = sum(info["batch_latencies"])
+        stats = getattr(storage, "pipeline_stats", None)
+        if stats:
+            # writing happens in writer threads, in parallel with parsing
+            info["parse_time"] += stats["parse"]["time"]
+            info["queue_wait"] = {
+                "parse": stats["parse"]["wait"],
+                "write": stats["write"]["wait"]
+            }
+        else:
+            info["parse_time"] = max(0.0, info["time"] - info["write_time"])
+        info["peak_rss"] = peak_rss()
+        return info
+
+
+def summarize_upload(results, elapsed, size=0):
+    """
+    Aggregate metrics from upload workers (see UploadMetrics) into the
+    summary stored in src_dump. elapsed is the wall-clock time of the
+    whole step (workers run in parallel), size the size in bytes of
+    the uploaded data (see input_size())
+    """
+    summary = {
+        "workers": len(results),
+        "time": round(elapsed, 2),
+        "docs": sum(r["docs"] for r in results),
+        "bytes": size,
+        "peak_rss": max([r["peak_rss"] for r in results] or [0]),
+    }
+    for key in ("parse_time", "write_time"):
+        summary[key] = round(sum(r[key] for r in results), 2)
+    waits = [r["queue_wait"] for r in results if r.get("queue_wait")]
+    if waits:
+        summary["queue_wait"] = {
+            k: round(sum(w[k] for w in waits), 2)
+            for k in ("parse", "write")
+        }
+    summary["docs_per_sec"] = round(summary["docs"] / elapsed, 1) if elapsed else None
+    summary["bytes_per_sec"] = round(summary["bytes"] / elapsed, 1) if elapsed else None
+    latencies = [lat for r in results for lat in r["batch_latencies"]]
+    summary["batches"] = len(latencies)
+    summary["batch_latency"] = percentiles(latencies)
+    return summary
+
+
+def summarize_dump(files, elapsed):
+    """
+    Summary stored in src_dump for a dump step, from downloaded
+    files given as a list of (local path, download time in seconds)
+    """
+    size = sum(os.path.getsize(path) for path, _ in files if os.path.exists(path))
+    return {
+        "files": len(files),
+        "time": round(elapsed, 2),
+        "bytes": size,
+        "bytes_per_sec": round(size / elapsed, 1) if elapsed else None,
+        "file_latency": percentiles([t for _, t in files]),
+    }
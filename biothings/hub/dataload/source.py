@@ -140,6 +140,8 @@ class SourceManager(BaseSourceManager):
             mini["download"]["dumper"] = src["download"].get("dumper", {})
             if src["download"].get("err"):
                 mini["download"]["error"] = src["download"]["err"]
+            if detailed and src["download"].get("metrics"):
+                mini["download"]["metrics"] = src["download"]["metrics"]
 
         count = 0
         if src.get("upload"):
@@ -155,6 +157,8 @@ class SourceManager(BaseSourceManager):
                 }
                 if info.get("err"):
                     mini["upload"]["sources"][job]["error"] = info["err"]
+                if detailed and info.get("metrics"):
+                    mini["upload"]["sources"][job]["metrics"] = info["metrics"]
                 count += info.get("count") or 0
                 if detailed:
                     self.set_mapping_src_meta(job, mini)
@@ -364,3 +368,27 @@ class SourceManager(BaseSourceManager):
             logging.exception(e)
             raise ValueError(
                 "Can't delete information, not found in document: %s" % e)
+
+    def get_metrics(self, name, key=None, subkey=None):
+        """
+        Return throughput metrics recorded for source "name", for each dump
+        and upload (oldest first), so they can be compared across releases:
+        {"download": [...], "upload": {"subsource": [...], ...}}
+
+        "key" restricts to 'download' or 'upload' metrics, and "subkey" to
+        a sub-source's upload metrics.
+        """
+        doc = self.src_dump.find_one({"_id": name})
+        if not doc:
+            raise ValueError("No such datasource named '%s'" % name)
+        metrics = doc.get("metrics", {})
+        if key not in [None, "download", "upload"]:
+            raise ValueError("key=%s not allowed" % repr(key))
+        if subkey:
+            return metrics.get("upload", {}).get(subkey, [])
+        if key:
+            return metrics.get(key, {} if key == "upload" else [])
+        return {
+            "download": metrics.get("download", []),
+            "upload": metrics.get("upload", {})
+        }
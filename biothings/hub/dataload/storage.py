@@ -1,8 +1,23 @@
+import os
+import gzip
+import hashlib
+import heapq
 import types
 import copy
 import time
+import queue
+import pickle
+import shutil
 import logging
-
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import groupby
+from operator import itemgetter
+
+import bson
+from bson.raw_bson import RawBSONDocument
 from pymongo.errors import DuplicateKeyError, BulkWriteError
 
 from biothings.utils.common import timesofar, iter_n
@@ -15,11 +30,30 @@ class StorageException(Exception):
 
 
 class BaseStorage(object):
+    # if set, called with the duration (in seconds) of each write to the
+    # database, possibly from several threads (see metrics.UploadMetrics)
+    on_write = None
+
     def __init__(self, db, dest_col_name, logger=logging):
         db = db or get_src_db()
         self.temp_collection = db[dest_col_name]
         self.logger = logger
 
+    @contextmanager
+    def timed_write(self):
+        """
+        Context in which storages write to the database, timed and
+        reported to on_write (even if the write fails)
+        """
+        if self.on_write is None:
+            yield
+            return
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.on_write(time.time() - t0)
+
     def process(self, iterable, *args, **kwargs):
         """
         Process iterable to store data. Must return the number
@@ -83,15 +117,56 @@ class BasicStorage(BaseStorage):
         for doc_li in self.doc_iterator(doc_d,
                                         batch=True,
                                         batch_size=batch_size):
-            self.temp_collection.insert(doc_li,
-                                        manipulate=False,
-                                        check_keys=False)
+            with self.timed_write():
+                self.temp_collection.insert(doc_li,
+                                            manipulate=False,
+                                            check_keys=False)
             total += len(doc_li)
         self.logger.info('Done[%s]' % timesofar(t0))
 
         return total
 
 
+class FastLoadStorage(BasicStorage):
+    """
+    Storage for a new collection nothing reads from while loading, like
+    uploaders' temp collections. Documents are encoded once, and sent in
+    batches of about batch_bytes (and at most batch_size documents) as
+    unordered inserts, skipping document validation. Writes are still
+    acknowledged so, like BasicStorage, duplicated _ids raise an error.
+    """
+    batch_bytes = 16 * 1024 * 1024
+
+    def process(self, doc_d, batch_size):
+        self.logger.info("Uploading to the DB...")
+        t0 = time.time()
+        total = 0
+        batch = []
+        size = 0
+        for doc_li in self.doc_iterator(doc_d,
+                                        batch=True,
+                                        batch_size=batch_size):
+            for doc in doc_li:
+                raw = RawBSONDocument(bson.BSON.encode(doc))
+                batch.append(raw)
+                size += len(raw.raw)
+                if size >= self.batch_bytes or len(batch) >= batch_size:
+                    total += self.insert_batch(batch)
+                    batch = []
+                    size = 0
+        if batch:
+            total += self.insert_batch(batch)
+        self.logger.info('Done[%s]' % timesofar(t0))
+
+        return total
+
+    def insert_batch(self, batch):
+        with self.timed_write():
+            self.temp_collection.insert_many(batch, ordered=False,
+                                             bypass_document_validation=True)
+        return len(batch)
+
+
 class MergerStorage(BasicStorage):
     """
     This storage will try to merge documents when finding duplicated errors.
@@ -102,70 +177,175 @@ class MergerStorage(BasicStorage):
     """
 
     merge_func = merge_struct
+    # number of recently stored _ids remembered across batches: documents
+    # with those _ids are merged right away instead of failing to insert
+    recent_ids_size = 100000
+
+    def premerge(self, doc_li):
+        """
+        Merge documents sharing the same _id within a batch. Return the
+        list of merged documents and the "__aslistofdict__" value found
+        """
+        aslistofdict = None
+        merged = OrderedDict()
+        for d in doc_li:
+            aslistofdict = d.pop("__aslistofdict__", None) or aslistofdict
+            existing = merged.get(d["_id"])
+            if existing is None:
+                merged[d["_id"]] = d
+            elif d is not existing:
+                # same document yielded twice is simply ignored
+                _id = d.pop("_id")
+                merged[_id] = self.__class__.merge_func(
+                    d, existing, aslistofdict=aslistofdict)
+                assert "_id" in merged[_id]
+        return list(merged.values()), aslistofdict
+
+    def merge_existing(self, docs, aslistofdict=None):
+        """
+        Merge documents with the ones already stored with the same _id,
+        (documents not found are inserted)
+        """
+        ids = [d["_id"] for d in docs]
+        # build hash of existing docs
+        hdocs = {}
+        for doc in self.temp_collection.find({"_id": {"$in": ids}}):
+            hdocs[doc["_id"]] = doc
+        bob = self.temp_collection.initialize_unordered_bulk_op()
+        for d in docs:
+            existing = hdocs.get(d["_id"])
+            if existing is None:
+                bob.insert(d)
+                continue
+            assert "_id" in existing
+            _id = d.pop("_id")
+            merged = self.__class__.merge_func(d, existing, aslistofdict=aslistofdict)
+            assert "_id" in merged
+            bob.find({"_id": _id}).update_one({"$set": merged})
+        with self.timed_write():
+            bob.execute()
 
     def process(self, doc_d, batch_size):
         self.logger.info("Uploading to the DB...")
         t0 = time.time()
         tinner = time.time()
-        aslistofdict = None
         total = 0
+        recent_ids = OrderedDict()
         for doc_li in self.doc_iterator(doc_d,
                                         batch=True,
                                         batch_size=batch_size):
             toinsert = len(doc_li)
-            nbinsert = 0
-            self.logger.info("Inserting %s records ... " % toinsert)
+            doc_li, aslistofdict = self.premerge(doc_li)
+            known = [d for d in doc_li if d["_id"] in recent_ids]
+            doc_li = [d for d in doc_li if d["_id"] not in recent_ids]
+            ids = [d["_id"] for d in known + doc_li]
+            self.logger.info("Inserting %s records (%s merged in batch, %s recently stored) ... " %
+                             (len(doc_li), toinsert - len(ids), len(known)))
+            if known:
+                self.merge_existing(known, aslistofdict)
             try:
-                bob = self.temp_collection.initialize_unordered_bulk_op()
-                for d in doc_li:
-                    aslistofdict = d.pop("__aslistofdict__", None)
-                    bob.insert(d)
-                res = bob.execute()
-                nbinsert += res["nInserted"]
+                if doc_li:
+                    bob = self.temp_collection.initialize_unordered_bulk_op()
+                    for d in doc_li:
+                        bob.insert(d)
+                    with self.timed_write():
+                        bob.execute()
                 self.logger.info("OK [%s]" % timesofar(tinner))
             except BulkWriteError as e:
-                inserted = e.details["nInserted"]
-                nbinsert += inserted
                 self.logger.info("Fixing %d records " %
                                  len(e.details["writeErrors"]))
-                ids = [d["op"]["_id"] for d in e.details["writeErrors"]]
-                # build hash of existing docs
-                docs = self.temp_collection.find({"_id": {"$in": ids}})
-                hdocs = {}
-                for doc in docs:
-                    hdocs[doc["_id"]] = doc
-                bob2 = self.temp_collection.initialize_unordered_bulk_op()
-                for err in e.details["writeErrors"]:
-                    errdoc = err["op"]
-                    existing = hdocs[errdoc["_id"]]
-                    if errdoc is existing:
-                        # if the same document has been yielded twice,
-                        # they could be the same, so we ignore it but
-                        # count it as processed (see assert below)
-                        nbinsert += 1
-                        continue
-                    assert "_id" in existing
-                    _id = errdoc.pop("_id")
-                    merged = self.__class__.merge_func(
-                        errdoc, existing, aslistofdict=aslistofdict)
-                    # update previously fetched doc. if several errors are about the same doc id,
-                    # we would't merged things properly without an updated document
-                    assert "_id" in merged
-                    bob2.find({"_id": _id}).update_one({"$set": merged})
-                    hdocs[_id] = merged
-                    nbinsert += 1
-
-                res = bob2.execute()
+                self.merge_existing([err["op"] for err in e.details["writeErrors"]],
+                                    aslistofdict)
                 self.logger.info("OK [%s]" % timesofar(tinner))
-            assert nbinsert == toinsert, "nb %s to %s" % (nbinsert, toinsert)
+            for _id in ids:
+                recent_ids[_id] = None
+                recent_ids.move_to_end(_id)
+            while len(recent_ids) > self.recent_ids_size:
+                recent_ids.popitem(last=False)
             # end of loop so it counts the time spent in doc_iterator
             tinner = time.time()
-            total += nbinsert
+            total += toinsert
+
+        self.logger.info('Done[%s]' % timesofar(t0))
+
+        return total
 
+
+class SortMergeStorage(MergerStorage):
+    """
+    Like MergerStorage, documents with the same _id are merged, but
+    without any duplicated error: documents are accumulated in runs of
+    run_size documents, each sorted by _id and spilled to a compressed
+    file in spill_folder (defaults to system's temp folder). Runs are then
+    merged while being read, and merged documents are inserted in _id
+    order. Memory usage depends on run_size, not on the data size.
+    Note: _ids must be comparable (eg. all strings)
+    """
+    run_size = 100000
+    spill_folder = None
+
+    def process(self, doc_d, batch_size):
+        self.logger.info("Uploading to the DB...")
+        t0 = time.time()
+        folder = tempfile.mkdtemp(prefix="sortmerge_", dir=self.spill_folder)
+        try:
+            runs = []
+            aslistofdict = None
+            # records processed, as counted by MergerStorage
+            total = 0
+            for doc_li in self.doc_iterator(doc_d,
+                                            batch=True,
+                                            batch_size=self.run_size):
+                total += len(doc_li)
+                doc_li, found = self.premerge(doc_li)
+                aslistofdict = found or aslistofdict
+                doc_li.sort(key=itemgetter("_id"))
+                runs.append(os.path.join(folder, "run_%d.pickle.gz" % len(runs)))
+                self.write_run(runs[-1], doc_li)
+                self.logger.info("Spilled run #%d (%d records) [%s]" %
+                                 (len(runs), len(doc_li), timesofar(t0)))
+            tinner = time.time()
+            merged = self.merge_runs(runs, aslistofdict)
+            for doc_li in iter_n(merged, n=batch_size):
+                with self.timed_write():
+                    self.temp_collection.insert_many(doc_li, ordered=False)
+                self.logger.info("Inserted %s records [%s]" %
+                                 (len(doc_li), timesofar(tinner)))
+                tinner = time.time()
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
         self.logger.info('Done[%s]' % timesofar(t0))
 
         return total
 
+    def write_run(self, path, doc_li):
+        with gzip.open(path, "wb", compresslevel=1) as run_f:
+            for doc in doc_li:
+                pickle.dump(doc, run_f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def read_run(self, path):
+        with gzip.open(path, "rb") as run_f:
+            while True:
+                try:
+                    yield pickle.load(run_f)
+                except EOFError:
+                    return
+
+    def merge_runs(self, runs, aslistofdict=None):
+        """
+        Read sorted runs together, yielding documents in _id order,
+        documents with the same _id merged in the order they were stored.
+        """
+        # heapq.merge keeps runs' order for equal _ids
+        docs = heapq.merge(*[self.read_run(path) for path in runs],
+                           key=itemgetter("_id"))
+        for _id, group in groupby(docs, key=itemgetter("_id")):
+            merged = next(group)
+            for doc in group:
+                doc.pop("_id")
+                merged = self.__class__.merge_func(doc, merged, aslistofdict=aslistofdict)
+            yield merged
+
 
 class RootKeyMergerStorage(MergerStorage):
     """
@@ -204,7 +384,8 @@ class IgnoreDuplicatedStorage(BasicStorage):
                 bob = self.temp_collection.initialize_unordered_bulk_op()
                 for d in doc_li:
                     bob.insert(d)
-                res = bob.execute()
+                with self.timed_write():
+                    res = bob.execute()
                 total += res['nInserted']
                 self.logger.info("Inserted %s records [%s]" %
                                  (res['nInserted'], timesofar(tinner)))
@@ -236,9 +417,10 @@ class NoBatchIgnoreDuplicatedStorage(BasicStorage):
         dups = 0
         for doc_li in self.doc_iterator(doc_d, batch=True, batch_size=1):
             try:
-                self.temp_collection.insert(doc_li,
-                                            manipulate=False,
-                                            check_keys=False)
+                with self.timed_write():
+                    self.temp_collection.insert(doc_li,
+                                                manipulate=False,
+                                                check_keys=False)
                 cnt += 1
                 total += 1
                 if (cnt + dups) % batch_size == 0:
@@ -270,7 +452,8 @@ class UpsertStorage(BasicStorage):
                 bob = self.temp_collection.initialize_unordered_bulk_op()
                 for d in doc_li:
                     bob.find({"_id": d["_id"]}).upsert().replace_one(d)
-                res = bob.execute()
+                with self.timed_write():
+                    res = bob.execute()
                 nb = res["nUpserted"] + res["nModified"]
                 total += nb
                 self.logger.info("Upserted %s records [%s]" %
@@ -283,6 +466,253 @@ class UpsertStorage(BasicStorage):
         return total
 
 
+class DeltaStorage(BasicStorage):
+    """
+    Update the destination collection in place, applying only what changed
+    since the previous upload. A content hash of each document is kept in
+    "<collection>_hashes": documents with a new _id are inserted, documents
+    whose hash differs are replaced, others are left untouched. Once all
+    documents are processed, documents not seen anymore are deleted.
+    Changes (_id and operation, "insert", "replace" or "delete") are recorded
+    in "<collection>_changes", reset on each upload. When the parser yields
+    the same _id several times, the last document is stored and the first
+    change is recorded.
+
+    Documents without hash are upserted, so the first upload can be done on
+    an already populated collection (documents it doesn't contain are then
+    deleted), and an interrupted upload is completed by the next one (changes
+    recorded by the interrupted one are lost though).
+
+    Note: hashes are computed on BSON-encoded documents, so key order matters.
+    Parsers should build documents the same way across releases.
+    """
+    def __init__(self, db, dest_col_name, logger=logging):
+        db = db or get_src_db()
+        super().__init__(db, dest_col_name, logger)
+        self.hash_collection = db[hash_collection_name(dest_col_name)]
+        self.change_collection = db[change_collection_name(dest_col_name)]
+
+    @classmethod
+    def hash_doc(klass, doc):
+        return hashlib.sha1(bson.BSON.encode(doc)).hexdigest()
+
+    def process(self, doc_d, batch_size):
+        self.logger.info("Uploading changes to the DB...")
+        t0 = time.time()
+        tinner = time.time()
+        self.change_collection.drop()
+        # hashes not flagged with this run at the end belong to deleted docs
+        run = bson.ObjectId()
+        # no hash at all, documents possibly stored otherwise can't be
+        # found from hashes
+        first = self.hash_collection.count() == 0
+        total = 0
+        for doc_li in self.doc_iterator(doc_d,
+                                        batch=True,
+                                        batch_size=batch_size):
+            total += len(doc_li)
+            # last document of an _id repeated in the batch is the one stored
+            doc_li = list(OrderedDict((d["_id"], d) for d in doc_li).values())
+            hashes = OrderedDict((d["_id"], self.hash_doc(d)) for d in doc_li)
+            prev = {
+                h["_id"]: h["hash"]
+                for h in self.hash_collection.find({"_id": {"$in": list(hashes)}})
+            }
+            changes = []
+            bob = self.temp_collection.initialize_unordered_bulk_op()
+            for doc in doc_li:
+                _id = doc["_id"]
+                if _id not in prev:
+                    # may already be stored (first or interrupted upload)
+                    bob.find({"_id": _id}).upsert().replace_one(doc)
+                    changes.append({"_id": _id, "op": "insert"})
+                elif prev[_id] != hashes[_id]:
+                    bob.find({"_id": _id}).replace_one(doc)
+                    changes.append({"_id": _id, "op": "replace"})
+            if changes:
+                # an _id seen in a previous batch may already be recorded
+                cob = self.change_collection.initialize_unordered_bulk_op()
+                for change in changes:
+                    cob.find({"_id": change["_id"]}).upsert().update_one(
+                        {"$setOnInsert": {"op": change["op"]}})
+                with self.timed_write():
+                    bob.execute()
+                    cob.execute()
+            # hashes are stored once data is, so an interrupted upload is
+            # fixed by the next one
+            hob = self.hash_collection.initialize_unordered_bulk_op()
+            for _id, _hash in hashes.items():
+                hob.find({"_id": _id}).upsert().replace_one(
+                    {"_id": _id, "hash": _hash, "run": run})
+            with self.timed_write():
+                hob.execute()
+            self.logger.info(
+                "Processed %s records, %s changed [%s]" %
+                (len(doc_li), len(changes), timesofar(tinner)))
+            tinner = time.time()
+        deleted = self.delete_missing(run, batch_size)
+        if first:
+            deleted += self.delete_unhashed(batch_size)
+        self.logger.info("Deleted %s records" % deleted)
+        self.logger.info('Done[%s]' % timesofar(t0))
+
+        return total
+
+    def delete_missing(self, run, batch_size):
+        cur = self.hash_collection.find({"run": {"$ne": run}}, {"_id": 1})
+        total = 0
+        for ids in iter_n((h["_id"] for h in cur), batch_size):
+            with self.timed_write():
+                self.temp_collection.remove({"_id": {"$in": ids}})
+                self.hash_collection.remove({"_id": {"$in": ids}})
+                self.change_collection.insert(
+                    [{"_id": _id, "op": "delete"} for _id in ids],
+                    manipulate=False, check_keys=False)
+            total += len(ids)
+        return total
+
+    def delete_unhashed(self, batch_size):
+        """Delete stored documents without hash (not part of the upload)"""
+        cur = self.temp_collection.find({}, {"_id": 1})
+        total = 0
+        for ids in iter_n((d["_id"] for d in cur), batch_size):
+            hashed = {h["_id"] for h in self.hash_collection.find(
+                {"_id": {"$in": ids}}, {"_id": 1})}
+            ids = [_id for _id in ids if _id not in hashed]
+            if ids:
+                with self.timed_write():
+                    self.temp_collection.remove({"_id": {"$in": ids}})
+                    self.change_collection.insert(
+                        [{"_id": _id, "op": "delete"} for _id in ids],
+                        manipulate=False, check_keys=False)
+                total += len(ids)
+        return total
+
+
+def hash_collection_name(col_name):
+    return "%s_hashes" % col_name
+
+
+def change_collection_name(col_name):
+    return "%s_changes" % col_name
+
+
+class PipelinedStorage(BaseStorage):
+    """
+    Overlap parsing and storing: the parser fills a bounded queue of
+    batches while writer threads consume it, so documents are parsed
+    while previous batches are sent to the database. This is a mixin,
+    storing itself is delegated to the next storage in the hierarchy:
+
+        storage_class = (PipelinedStorage, BasicStorage)
+
+    Per-stage counters are kept in self.pipeline_stats and logged once
+    done. Storages merging documents on duplicates (MergerStorage)
+    should keep a single writer so merges aren't interleaved.
+    """
+
+    pipeline_writers = 2
+    pipeline_queue_size = 4  # batches
+
+    def process(self, doc_d, batch_size):
+        if not (isinstance(doc_d, types.GeneratorType)
+                or isinstance(doc_d, list)):
+            # already in memory, nothing to overlap
+            return super().process(doc_d, batch_size)
+
+        self.logger.info("Uploading to the DB using %d writer(s)..." %
+                         self.pipeline_writers)
+        t0 = time.time()
+        batches = queue.Queue(maxsize=self.pipeline_queue_size)
+        abort = threading.Event()
+        lock = threading.Lock()
+        results = []
+        stats = self.pipeline_stats = {
+            "parse": {"docs": 0, "time": 0.0, "wait": 0.0},
+            "write": {"docs": 0, "time": 0.0, "wait": 0.0},
+        }
+
+        def dequeue():
+            while True:
+                # stop as soon as another thread failed, even with batches queued
+                if abort.is_set():
+                    raise StorageException("Pipeline aborted")
+                t1 = time.time()
+                try:
+                    doc_li = batches.get(timeout=1)
+                except queue.Empty:
+                    continue
+                finally:
+                    with lock:
+                        stats["write"]["wait"] += time.time() - t1
+                if doc_li is None:
+                    return
+                yield from doc_li
+
+        def write():
+            t1 = time.time()
+            try:
+                res = super(PipelinedStorage, self).process(dequeue(), batch_size)
+            except Exception as e:
+                abort.set()
+                res = e
+            with lock:
+                stats["write"]["time"] += time.time() - t1
+                results.append(res)
+
+        def enqueue(item):
+            t1 = time.time()
+            while not abort.is_set():
+                try:
+                    batches.put(item, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+            stats["parse"]["wait"] += time.time() - t1
+            if abort.is_set():
+                raise StorageException("Pipeline aborted")
+
+        writers = [threading.Thread(target=write, name="storage-writer-%d" % i)
+                   for i in range(self.pipeline_writers)]
+        for writer in writers:
+            writer.start()
+        try:
+            t1 = time.time()
+            for doc_li in iter_n(doc_d, n=batch_size):
+                stats["parse"]["time"] += time.time() - t1
+                stats["parse"]["docs"] += len(doc_li)
+                enqueue(doc_li)
+                t1 = time.time()
+            for _ in writers:
+                enqueue(None)
+        except StorageException:
+            pass  # a writer failed, its error is raised below
+        except Exception:
+            abort.set()
+            raise
+        finally:
+            for writer in writers:
+                writer.join()
+
+        errors = [res for res in results if isinstance(res, Exception)]
+        if errors:
+            # report the writer error which aborted the pipeline first
+            raise next((e for e in errors if not isinstance(e, StorageException)),
+                       errors[0])
+        total = stats["write"]["docs"] = sum(results)
+        stats["write"]["time"] -= stats["write"]["wait"]
+
+        for stage in ("parse", "write"):
+            stat = stats[stage]
+            self.logger.info(
+                "%s: %d docs in %.1fs (%.0f docs/s), waited %.1fs on queue" %
+                (stage, stat["docs"], stat["time"],
+                 stat["docs"] / stat["time"] if stat["time"] else 0, stat["wait"]))
+        self.logger.info('Done[%s]' % timesofar(t0))
+
+        return total
+
+
 class NoStorage(object):
     """
     This a kind of a place-holder, this storage will just store nothing...
@@ -1,5 +1,6 @@
 import time
 import os
+import glob
 import copy
 import datetime
 import asyncio
@@ -7,13 +8,18 @@ import logging as loggingmod
 from functools import partial
 import inspect
 
-from biothings.utils.common import get_timestamp, get_random_string, timesofar
+from pymongo import IndexModel
+
+from biothings.utils.common import get_timestamp, get_random_string, timesofar, \
+    split_file
 from biothings.utils.hub_db import get_src_dump, get_src_master
 from biothings.utils.mongo import get_src_conn
 from biothings.utils.manager import BaseSourceManager, ResourceNotFound
 from .storage import IgnoreDuplicatedStorage, MergerStorage, \
     BasicStorage, NoBatchIgnoreDuplicatedStorage, \
-    NoStorage
+    NoStorage, PipelinedStorage, FastLoadStorage, SortMergeStorage, \
+    DeltaStorage, change_collection_name
+from .metrics import UploadMetrics, summarize_upload, input_size
 from biothings.utils.loggers import get_logger
 from biothings.utils.version import get_source_code_info
 from biothings import config
@@ -31,16 +37,18 @@ class ResourceError(Exception):
 
 
 def upload_worker(name, storage_class, loaddata_func, col_name, batch_size,
-                  batch_num, *args):
+                  batch_num, *args, with_metrics=False):
     """
     Pickable job launcher, typically running from multiprocessing.
     storage_class will instanciate with col_name, the destination
     collection name. loaddata_func is the parsing/loading function,
-    called with `*args`.
+    called with `*args`. Return the number of stored documents, or
+    (count, metrics) if with_metrics (see UploadMetrics)
     """
     data = []
     try:
-        data = loaddata_func(*args)
+        metrics = UploadMetrics()
+        data = metrics.load(loaddata_func, *args)
         if type(storage_class) is tuple:
             klass_name = "_".join(
                 [k.__class__.__name__ for k in storage_class])
@@ -48,7 +56,12 @@ def upload_worker(name, storage_class, loaddata_func, col_name, batch_size,
                                                           loggingmod)
         else:
             storage = storage_class(None, col_name, loggingmod)
-        return storage.process(data, batch_size)
+        if with_metrics:
+            storage.on_write = metrics.on_write
+        cnt = storage.process(data, batch_size)
+        if with_metrics:
+            return cnt, metrics.finish(storage, cnt)
+        return cnt
     except Exception as e:
         logger_name = "%s_batch_%s" % (name, batch_num)
         logger, logfile = get_logger(logger_name, config.LOG_FOLDER)
@@ -103,6 +116,11 @@ class BaseSourceUploader(object):
     regex_name = None
 
     keep_archive = 10  # number of archived collection to keep. Oldest get dropped first.
+    keep_metrics = 30  # number of upload metrics kept in src_dump (see get_metrics())
+
+    # indexes created on the temp collection once all data is loaded, before
+    # switching it. List of pymongo.IndexModel or keys (see IndexModel)
+    indexes = []
 
     def __init__(self,
                  db_conn_info,
@@ -129,6 +147,7 @@ class BaseSourceUploader(object):
         self.data_folder = None
         self.prepared = False
         self.src_doc = {}  # will hold src_dump's doc
+        self.metrics = None  # throughput metrics from update_data()
 
     @property
     def fullname(self):
@@ -310,6 +329,9 @@ class BaseSourceUploader(object):
         '''
         if self.temp_collection_name and self.db[
                 self.temp_collection_name].count() > 0:
+            src_doc = self.src_dump.find_one({"_id": self.main_source}) or {}
+            releases = self.get_collection_releases(src_doc)
+            current = releases.pop(self.collection_name, None)
             if self.collection_name in self.db.collection_names():
                 # renaming existing collections
                 new_name = '_'.join([
@@ -318,26 +340,71 @@ class BaseSourceUploader(object):
                     get_random_string()
                 ])
                 self.collection.rename(new_name, dropTarget=True)
+                if current:
+                    releases[new_name] = current
             self.logger.info("Renaming collection '%s' to '%s'" %
                              (self.temp_collection_name, self.collection_name))
             self.db[self.temp_collection_name].rename(self.collection_name)
+            releases[self.collection_name] = src_doc.get(
+                "download", {}).get("release") or src_doc.get("release")
+            # forget about dropped archives
+            cols = self.db.collection_names()
+            releases = {k: v for k, v in releases.items() if k in cols}
+            self.src_dump.update_one(
+                {"_id": self.main_source},
+                {"$set": {"upload.archives.%s" % self.name: releases}})
         else:
             raise ResourceError("No temp collection (or it's empty)")
 
+    def get_collection_releases(self, src_doc=None):
+        """
+        Return releases held by this source's collection and its archived
+        collections, as {collection name: release}, as recorded when
+        collections were switched (see switch_collection()).
+        """
+        src_doc = src_doc or self.src_dump.find_one({"_id": self.main_source}) or {}
+        return dict(src_doc.get("upload", {}).get("archives", {}).get(self.name) or {})
+
+    def build_indexes(self, col_name=None):
+        '''Create declared indexes on the temp collection (or col_name),
+           all in one pass'''
+        if not self.indexes:
+            return
+        col_name = col_name or self.temp_collection_name
+        models = [idx if isinstance(idx, IndexModel) else IndexModel(idx)
+                  for idx in self.indexes]
+        self.logger.info("Creating %d index(es) on '%s'" %
+                         (len(models), col_name))
+        t0 = time.time()
+        self.db[col_name].create_indexes(models)
+        self.logger.info("Indexes created [%s]" % timesofar(t0))
+
     def post_update_data(self, steps, force, batch_size, job_manager,
                          **kwargs):
         """Override as needed to perform operations after
            data has been uploaded"""
         pass
 
+    def finish_update_data(self, col_name):
+        """
+        Called once data is stored in col_name by update_data(): create
+        indexes, and make it the collection in use (switch_collection()).
+        Override for uploaders storing data somewhere else.
+        """
+        self.build_indexes(col_name)
+        self.switch_collection()
+
     @asyncio.coroutine
-    def update_data(self, batch_size, job_manager):
+    def update_data(self, batch_size, job_manager, col_name=None):
         """
-        Iterate over load_data() to pull data and store it
+        Iterate over load_data() to pull data and store it in col_name
+        (temp_collection_name by default), then finish_update_data()
         """
+        col_name = col_name or self.temp_collection_name
         pinfo = self.get_pinfo()
         pinfo["step"] = "update_data"
         got_error = False
+        t0 = time.time()
         self.unprepare()
         job = yield from job_manager.defer_to_process(
             pinfo,
@@ -346,14 +413,15 @@ class BaseSourceUploader(object):
                 self.fullname,
                 self.__class__.storage_class,
                 self.load_data,
-                self.temp_collection_name,
+                col_name,
                 batch_size,
                 1,  # no batch, just #1
-                self.data_folder))
+                self.data_folder,
+                with_metrics=True))
 
         def uploaded(f):
             nonlocal got_error
-            if type(f.result()) != int:
+            if type(f.result()[0]) != int:
                 got_error = Exception(
                     "upload error (should have a int as returned value got %s"
                     % repr(f.result()))
@@ -362,7 +430,9 @@ class BaseSourceUploader(object):
         yield from job
         if got_error:
             raise got_error
-        self.switch_collection()
+        self.metrics = summarize_upload([job.result()[1]], time.time() - t0,
+                                        input_size(self.data_folder))
+        self.finish_update_data(col_name)
 
     def generate_doc_src_master(self):
         _doc = {
@@ -444,6 +514,15 @@ class BaseSourceUploader(object):
             upd["%s.step" % job_key] = self.name  # collection name
             upd["%s.release" % job_key] = release
             upd["%s.data_folder" % job_key] = data_folder
+            if extra.get("metrics"):
+                # keep metrics from previous uploads so they can be compared
+                history = src_doc.get("metrics", {}).get(subkey, {}).get(self.name, [])
+                record = dict(extra["metrics"],
+                              release=release,
+                              status=status,
+                              finished_at=datetime.datetime.now().astimezone())
+                upd["metrics.%s.%s" % (subkey, self.name)] = \
+                    (history + [record])[-self.keep_metrics:]
             self.src_dump.update_one({"_id": self.main_source}, {"$set": upd})
 
     @asyncio.coroutine
@@ -470,6 +549,7 @@ class BaseSourceUploader(object):
             clean_archives = "clean" in steps
             strargs = "[steps=%s]" % ",".join(steps)
             cnt = None
+            self.metrics = None
             if not self.temp_collection_name:
                 self.make_temp_collection()
             if self.db[self.temp_collection_name]:
@@ -511,7 +591,7 @@ class BaseSourceUploader(object):
             cnt = cnt or self.db[self.collection_name].count()
             if clean_archives:
                 self.clean_archived_collections()
-            self.register_status("success", count=cnt)
+            self.register_status("success", count=cnt, metrics=self.metrics)
             self.logger.info("success %s" % strargs, extra={"notify": True})
         except Exception as e:
             self.logger.exception("failed %s: %s" % (strargs, e),
@@ -569,6 +649,81 @@ class MergerSourceUploader(BaseSourceUploader):
     storage_class = MergerStorage
 
 
+class SortMergeSourceUploader(BaseSourceUploader):
+    '''Same as MergerSourceUploader, but records are sorted on disk and merged
+    by _id before being stored (see SortMergeStorage). Suited to sources
+    with many unsorted records per _id.
+    '''
+    storage_class = SortMergeStorage
+
+
+class FastLoadSourceUploader(BaseSourceUploader):
+    '''Same as default uploader, but optimized for bulk loading (see
+    FastLoadStorage). Declared indexes are created once data is loaded.
+    '''
+    storage_class = FastLoadStorage
+
+
+class PipelinedSourceUploader(BaseSourceUploader):
+    '''Same as default uploader, but parsing and storing run concurrently:
+    batches yielded by load_data() are queued and stored by writer threads
+    (see PipelinedStorage).
+    '''
+    storage_class = (PipelinedStorage, BasicStorage)
+
+
+class DeltaSourceUploader(BaseSourceUploader):
+    '''Instead of loading data in a temp collection then switching it,
+    only changed documents are inserted, replaced or deleted in place,
+    based on content hashes stored from the previous upload (see DeltaStorage).
+    Changed _ids are recorded so later stages can process them only (see
+    get_changes()), and a summary is registered in src_dump, under upload's
+    job "changes" key ("changes_from" being the release changes apply to).
+    Suited to sources where releases change few records.
+    Note: there's no temp collection, data is stored in collection_name
+    directly, which is what post_update_data() should work on.
+    '''
+    storage_class = DeltaStorage
+
+    @asyncio.coroutine
+    def update_data(self, batch_size, job_manager, col_name=None):
+        # stored in place, no temp collection
+        res = yield from super().update_data(
+            batch_size, job_manager, col_name=col_name or self.collection_name)
+        return res
+
+    def finish_update_data(self, col_name):
+        self.build_indexes(col_name)
+        summary = {"insert": 0, "replace": 0, "delete": 0}
+        for res in self.db[change_collection_name(col_name)].aggregate(
+                [{"$group": {"_id": "$op", "count": {"$sum": 1}}}]):
+            summary[res["_id"]] = res["count"]
+        self.logger.info("Changes: %s" % summary)
+        self.src_dump.update_one(
+            {"_id": self.main_source},
+            {"$set": {"upload.jobs.%s.changes" % self.name: summary}})
+
+    def register_status(self, status, subkey="upload", **extra):
+        if status == "uploading" and subkey == "upload":
+            # changes are relative to the release previously uploaded, which
+            # is overwritten here. Unknown if that upload didn't succeed
+            src_doc = self.src_dump.find_one({"_id": self.main_source}) or {}
+            job = src_doc.get("upload", {}).get("jobs", {}).get(self.name, {})
+            extra["changes_from"] = job.get("status") == "success" and job.get("release") or None
+        super().register_status(status, subkey=subkey, **extra)
+
+    def get_changes(self, op=None):
+        '''
+        Return a cursor over _ids changed by last upload, as documents like
+        {"_id": ..., "op": "insert"|"replace"|"delete"}, optionally restricted
+        to given operation(s) (str or list)
+        '''
+        query = {}
+        if op:
+            query["op"] = {"$in": [op] if type(op) == str else list(op)}
+        return self.db[change_collection_name(self.collection_name)].find(query)
+
+
 class DummySourceUploader(BaseSourceUploader):
     """
     Dummy uploader, won't upload any data, assuming data is already there
@@ -604,23 +759,50 @@ class DummySourceUploader(BaseSourceUploader):
 
 
 class ParallelizedSourceUploader(BaseSourceUploader):
+
+    # instead of implementing jobs(), data files matching these patterns
+    # (relative to data folder) can be split in line-aligned parts, one job
+    # per part. Each part is passed to load_data() in place of a file name
+    # and can be read with anyfile(), open_anyfile() or tabfile_feeder().
+    # Only uncompressed and bgzip'ed files are split (see split_file())
+    split_files = []
+    split_parts = None  # number of parts per file, defaults to HUB_MAX_WORKERS
+    # number of header lines repeated in each part, required when splitting
+    # (0 if none): it must match the lines load_data() skips in every part
+    split_header = None
+
     def jobs(self):
         """Return list of (`*arguments`) passed to self.load_data, in order. for
         each parallelized jobs. Ex: [(x,1),(y,2),(z,3)]
         If only one argument is required, it still must be passed as a 1-element tuple
         """
-        raise NotImplementedError("implement me in subclass")
+        if not self.split_files:
+            raise NotImplementedError("implement me in subclass")
+        if self.split_header is None:
+            raise ResourceError("split_header must be set to the number of header " +
+                                "lines of the files to split (0 if none)")
+        parts = self.split_parts or getattr(config, "HUB_MAX_WORKERS", None) or os.cpu_count()
+        jobs = []
+        for pattern in self.split_files:
+            for path in sorted(glob.glob(os.path.join(self.data_folder, pattern))):
+                ranges = split_file(path, parts, header=self.split_header)
+                self.logger.info("Uploading '%s' in %d part(s)" % (path, len(ranges)))
+                jobs.extend((frange,) for frange in ranges)
+        return jobs
 
     @asyncio.coroutine
-    def update_data(self, batch_size, job_manager=None):
+    def update_data(self, batch_size, job_manager=None, col_name=None):
         jobs = []
-        job_params = self.jobs()
+        t0 = time.time()
+        job_params = list(self.jobs())
+        # jobs may share files, counted once
+        size = input_size(*[arg for args in job_params for arg in args])
         got_error = False
         # make sure we don't use any of self reference in the following loop
         fullname = copy.deepcopy(self.fullname)
         storage_class = copy.deepcopy(self.__class__.storage_class)
         load_data = copy.deepcopy(self.load_data)
-        temp_collection_name = copy.deepcopy(self.temp_collection_name)
+        col_name = copy.deepcopy(col_name or self.temp_collection_name)
         self.unprepare()
         # important: within this loop, "self" should never be used to make sure we don't
         # instantiate unpicklable attributes (via via autoset attributes, see prepare())
@@ -645,13 +827,14 @@ class ParallelizedSourceUploader(BaseSourceUploader):
                     # loading func
                     load_data,
                     # dest collection name
-                    temp_collection_name,
+                    col_name,
                     # batch size
                     batch_size,
                     # batch num
                     bnum,
                     # and finally *args passed to loading func
-                    *args))
+                    *args,
+                    with_metrics=True))
             jobs.append(job)
 
             # raise error as soon as we know
@@ -663,7 +846,7 @@ class ParallelizedSourceUploader(BaseSourceUploader):
                 # (see comment above, before loop)
                 nonlocal got_error
                 try:
-                    if type(f.result()) != int:
+                    if type(f.result()[0]) != int:
                         got_error = Exception(
                             "Batch #%s failed while uploading source '%s' [%s]"
                             % (batch_num, name, f.result()))
@@ -673,10 +856,12 @@ class ParallelizedSourceUploader(BaseSourceUploader):
             job.add_done_callback(
                 partial(batch_uploaded, name=fullname, batch_num=bnum))
         if jobs:
-            yield from asyncio.gather(*jobs)
+            results = yield from asyncio.gather(*jobs)
             if got_error:
                 raise got_error
-            self.switch_collection()
+            self.metrics = summarize_upload([res[1] for res in results],
+                                            time.time() - t0, size)
+            self.finish_update_data(col_name)
             self.clean_archived_collections()
 
 
@@ -0,0 +1,456 @@
+import config, biothings
+biothings.config_for_app(config)
+
+import asyncio
+import unittest
+from functools import partial
+from types import SimpleNamespace
+from unittest import mock
+
+import biothings.utils.mongo as mongo
+from biothings.hub.databuild.backend import SourceDocMongoBackend, \
+    TargetDocMongoBackend, touched_collection_name
+from biothings.hub.databuild import builder
+from biothings.hub.databuild.builder import DataBuilder, SortedMergeDataBuilder, \
+    merger_worker
+from biothings.hub.databuild.differ import JsonDiffer, touched_id_feeder
+from biothings.hub.databuild.mapper import TransparentMapper
+from biothings.hub.dataindex.indexer import Indexer, IndexerException, indexer_worker
+from biothings.hub.dataload.storage import change_collection_name
+from biothings.utils.backend import DocMongoBackend
+from biothings.utils.mongo import IdRange
+from biothings.tests.mongo import Database
+
+
+class IncrementalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.hub_db = Database("hub")
+        self.src_db = Database("src")
+        self.tgt_db = Database("tgt")
+        self.src_build = self.hub_db["src_build"]
+        self.src_dump = self.hub_db["src_dump"]
+        self.hub_db["src_build_config"].insert_one(
+            {"_id": "mybuild", "name": "mybuild", "sources": ["s1", "s2"], "root": []})
+        for name in ("s1", "s2"):
+            self.hub_db["src_master"].insert_one({"_id": name, "name": name})
+            self.src_db[name].insert_many([{"_id": str(i), name: i} for i in range(5)])
+        # previous build, merged from s1 "v1" and s2 "v1"
+        self.src_build.insert_one({
+            "_id": "mybuild_prev", "started_at": "2020-01-01",
+            "build_config": {"name": "mybuild", "sources": ["s1", "s2"], "root": []},
+            "_meta": {"src": {"s1": {"version": "v1"}, "s2": {"version": "v1"}}},
+            "merge_stats": {"s1": 5, "s2": 5}})
+        self.tgt_db["mybuild_prev"].insert_many(
+            [{"_id": str(i), "s1": i, "s2": i} for i in range(5)])
+        self.set_upload("s1", "v1")
+        self.set_upload("s2", "v1")
+        patchers = [
+            mock.patch.object(mongo, "get_src_db", return_value=self.src_db),
+            mock.patch("biothings.hub.databuild.builder.get_source_fullname",
+                       side_effect=lambda name: name),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        source_backend = SourceDocMongoBackend(
+            build_config=partial(lambda: self.hub_db["src_build_config"]),
+            build=partial(lambda: self.src_build),
+            master=partial(lambda: self.hub_db["src_master"]),
+            dump=partial(lambda: self.src_dump),
+            sources=partial(lambda: self.src_db))
+        self.builder = DataBuilder("mybuild", source_backend,
+                                   TargetDocMongoBackend(self.tgt_db),
+                                   log_folder=config.LOG_FOLDER,
+                                   target_name="mybuild_new")
+
+    def set_upload(self, name, release, archives=None, **job):
+        job["release"] = release
+        self.src_dump.save({
+            "_id": name,
+            "download": {"release": release},
+            "upload": {"jobs": {name: job},
+                       "archives": {name: archives or {name: release}}}})
+
+
+class TestPlanIncremental(IncrementalTestCase):
+
+    def test_no_previous_build(self):
+        self.src_build.remove({})
+        self.assertIsNone(self.builder.plan_incremental())
+
+    def test_configuration_changed(self):
+        self.src_build.update_one({"_id": "mybuild_prev"},
+                                  {"$set": {"build_config.sources": ["s1"]}})
+        self.assertIsNone(self.builder.plan_incremental())
+
+    def test_unchanged(self):
+        self.assertEqual(self.builder.plan_incremental(),
+                         {"from": "mybuild_prev", "sources": {}})
+
+    def test_delta(self):
+        self.set_upload("s2", "v2", changes={"insert": 1}, changes_from="v1")
+        self.assertEqual(self.builder.plan_incremental(),
+                         {"from": "mybuild_prev", "sources": {"s2": "delta"}})
+        # changes recorded since another release
+        self.set_upload("s2", "v3", changes={"insert": 1}, changes_from="v2")
+        self.assertIsNone(self.builder.plan_incremental())
+
+    def test_archive(self):
+        self.src_db["s2_archive_20200102_aaaa"].insert_one({"_id": "0"})
+        self.src_db["s2_archive_20200101_bbbb"].insert_one({"_id": "0"})
+        self.set_upload("s2", "v3", archives={"s2": "v3",
+                                              "s2_archive_20200102_aaaa": "v2",
+                                              "s2_archive_20200101_bbbb": "v1"})
+        # not the latest archive, the one holding previous build's release
+        self.assertEqual(self.builder.plan_incremental(),
+                         {"from": "mybuild_prev",
+                          "sources": {"s2": "s2_archive_20200101_bbbb"}})
+
+    def test_archive_release_not_found(self):
+        self.src_db["s2_archive_20200102_aaaa"].insert_one({"_id": "0"})
+        self.set_upload("s2", "v3", archives={"s2": "v3", "s2_archive_20200102_aaaa": "v2"})
+        self.assertIsNone(self.builder.plan_incremental())
+        # archives not recorded
+        self.set_upload("s2", "v2", archives={"s2": "v2"})
+        self.assertIsNone(self.builder.plan_incremental())
+
+    def test_archive_dropped(self):
+        self.set_upload("s2", "v2", archives={"s2": "v2", "s2_archive_20200101_bbbb": "v1"})
+        self.assertIsNone(self.builder.plan_incremental())
+
+    def test_collection_release_mismatch(self):
+        # collection switched to another release than the one registered
+        self.src_db["s2_archive_20200101_bbbb"].insert_one({"_id": "0"})
+        self.set_upload("s2", "v2", archives={"s2": "v3", "s2_archive_20200101_bbbb": "v1"})
+        self.assertIsNone(self.builder.plan_incremental())
+
+
+class TestChangedIds(IncrementalTestCase):
+
+    def changed_ids(self, how):
+        return sorted(_id for ids in self.builder.get_changed_ids("s2", how, batch_size=2)
+                      for _id in ids)
+
+    def test_delta(self):
+        self.src_db[change_collection_name("s2")].insert_many(
+            [{"_id": "1", "op": "replace"}, {"_id": "7", "op": "insert"},
+             {"_id": "3", "op": "delete"}])
+        self.assertEqual(self.changed_ids("delta"), ["1", "3", "7"])
+
+    def test_archive(self):
+        archive = self.src_db["s2_archive"]
+        archive.insert_many(list(self.src_db["s2"].find()))
+        self.assertEqual(self.changed_ids("s2_archive"), [])
+        self.src_db["s2"].update_one({"_id": "1"}, {"$set": {"s2": 10}})
+        self.src_db["s2"].delete_one({"_id": "3"})
+        self.src_db["s2"].insert_one({"_id": "7", "s2": 7})
+        self.assertEqual(self.changed_ids("s2_archive"), ["1", "3", "7"])
+
+
+class TestTouchedIds(IncrementalTestCase):
+
+    def test_prepare_and_flag(self):
+        self.builder.incremental = {"from": "mybuild_prev",
+                                    "sources": {"s2": "delta"}}
+        self.src_db[change_collection_name("s2")].insert_many(
+            [{"_id": "1", "op": "replace"}, {"_id": "3", "op": "delete"},
+             {"_id": "7", "op": "insert"}])
+        ids = self.builder.prepare_incremental(batch_size=2)
+        self.assertEqual(sorted(ids), ["1", "3", "7"])
+        target = self.tgt_db["mybuild_new"]
+        self.assertEqual(sorted(target.docs), ["0", "2", "4"])
+        # previous build is left untouched
+        self.assertEqual(len(self.tgt_db["mybuild_prev"].docs), 5)
+        # touched _ids merged again, "3" is gone from sources
+        target.insert_many([{"_id": "1", "s1": 1, "s2": 10}, {"_id": "7", "s2": 7}])
+        self.assertEqual(self.builder.flag_touched_ids(batch_size=2), 3)
+        touched = self.tgt_db[touched_collection_name("mybuild_new")]
+        self.assertEqual({d["_id"]: d["op"] for d in touched.find()},
+                         {"1": "update", "3": "delete", "7": "update"})
+
+
+class TestTouchedDiff(IncrementalTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.src_build.insert_one({"_id": "mybuild_new",
+                                   "incremental": {"from": "mybuild_prev"}})
+        self.touched = self.tgt_db[touched_collection_name("mybuild_new")]
+        self.touched.insert_many([{"_id": "1", "op": "update"}, {"_id": "3", "op": "delete"},
+                                  {"_id": "7", "op": "update"}])
+        self.old = DocMongoBackend(self.tgt_db, self.tgt_db["mybuild_prev"])
+        self.new = DocMongoBackend(self.tgt_db, self.tgt_db["mybuild_new"])
+        patcher = mock.patch("biothings.hub.databuild.differ.get_src_build",
+                             return_value=self.src_build)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.differ = JsonDiffer(job_manager=None, log_folder=config.LOG_FOLDER)
+
+    def test_touched_collection(self):
+        self.assertIs(self.differ.get_touched_collection(self.old, self.new), self.touched)
+        # other way around, or from another build: every _id is compared
+        self.assertIsNone(self.differ.get_touched_collection(self.new, self.old))
+        other = DocMongoBackend(self.tgt_db, self.tgt_db["mybuild_other"])
+        self.assertIsNone(self.differ.get_touched_collection(other, self.new))
+
+    def test_touched_id_feeder(self):
+        self.assertEqual([_id for ids in touched_id_feeder(self.touched, "update", 1)
+                          for _id in ids], ["1", "7"])
+        self.assertEqual(list(touched_id_feeder(self.touched, "delete", 10)), [["3"]])
+
+
+class TestTouchedIndex(IncrementalTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch("biothings.hub.dataindex.indexer.get_src_build",
+                             return_value=self.src_build)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.indexer = Indexer(es_host="localhost:9200")
+        self.indexer.target_name = "mybuild_new"
+        self.indexer.build_doc = {"_id": "mybuild_new",
+                                  "incremental": {"from": "mybuild_prev"}}
+
+    def test_touched_collection(self):
+        target = self.tgt_db["mybuild_new"]
+        # index doesn't hold previous build's documents
+        with self.assertRaises(IndexerException):
+            self.indexer.get_touched_collection("myindex", target)
+        self.src_build.update_one({"_id": "mybuild_prev"},
+                                  {"$set": {"index.myindex": {"target_name": "mybuild_prev"}}})
+        self.assertIs(self.indexer.get_touched_collection("myindex", target),
+                      self.tgt_db[touched_collection_name("mybuild_new")])
+        # not built incrementally, a full index is needed
+        self.indexer.build_doc = {"_id": "mybuild_new"}
+        with self.assertRaises(IndexerException):
+            self.indexer.get_touched_collection("myindex", target)
+
+
+class JobManager(object):
+    """Run jobs in-process, one after the other"""
+
+    async def defer_to_process(self, pinfo, func):
+        fut = asyncio.Future()
+        fut.set_result(func())
+        return fut
+
+
+class TestIdRangeMerge(IncrementalTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(mongo, "get_target_db", return_value=self.tgt_db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.builder.target_backend.set_target_name("mybuild_new")
+        self.builder.build_config = {"sources": ["s1", "s2"], "root": []}
+        self.builder.mappers = {None: TransparentMapper()}
+        self.builder.partition_by_range = True
+        self.target = self.tgt_db["mybuild_new"]
+
+    def merge(self, src_name):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        with mock.patch.object(builder, "merger_worker", wraps=merger_worker) as worker:
+            loop.run_until_complete(self.builder.merge_source(
+                src_name, batch_size=2, job_manager=JobManager()))
+        return [call[0][2] for call in worker.call_args_list]
+
+    def test_merger_worker(self):
+        worker_args = ("s2", "mybuild_new", None, TransparentMapper(), None, True, "upsert", 1)
+        args = list(worker_args)
+        args[2] = IdRange("1", "3")
+        self.assertEqual(merger_worker(*args), 2)
+        self.assertEqual(sorted(self.target.docs), ["1", "2"])
+        # combined with the source query
+        args[2] = IdRange("3", None)
+        merger_worker(*args, query={"s2": {"$ne": 4}})
+        self.assertEqual(sorted(self.target.docs), ["1", "2", "3"])
+        args[2] = ["0", "4"]
+        merger_worker(*args)
+        self.assertEqual(self.target.find_one({"_id": "4"}), {"_id": "4", "s2": 4})
+        self.assertEqual(len(self.target.docs), 5)
+
+    def test_merge_source(self):
+        ids = self.merge("s1")
+        self.assertTrue(all(isinstance(id_range, IdRange) for id_range in ids))
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(self.target.docs, {str(i): {"_id": str(i), "s1": i} for i in range(5)})
+
+    def test_merge_source_not_str(self):
+        # can't be split in ranges, lists of _ids are merged instead
+        self.src_db["s1"].insert_one({"_id": 5, "s1": 5})
+        ids = sorted(self.src_db["s1"].docs, key=str)
+        with mock.patch.object(builder, "id_feeder",
+                               side_effect=lambda col, batch_size, **kwargs: [ids]):
+            ids = self.merge("s1")
+        self.assertFalse(any(isinstance(batch, IdRange) for batch in ids))
+        self.assertEqual(sorted((_id for batch in ids for _id in batch), key=str),
+                         sorted(self.src_db["s1"].docs, key=str))
+        self.assertEqual(len(self.target.docs), 6)
+
+
+class FilteredMixin(object):
+    """Documents flagged "skip" aren't merged from s2"""
+
+    def generate_document_query(self, src_name):
+        return {"skip": {"$ne": True}} if src_name == "s2" else None
+
+
+class FilteredDataBuilder(FilteredMixin, DataBuilder):
+    pass
+
+
+class FilteredSortedMergeDataBuilder(FilteredMixin, SortedMergeDataBuilder):
+    pass
+
+
+class TestSortedMerge(unittest.TestCase):
+    """
+    Merging sources in one pass gives the same documents as merging
+    them one after the other
+    """
+
+    def setUp(self):
+        self.hub_db = Database("hub")
+        self.src_db = Database("src")
+        self.tgt_db = Database("tgt")
+        # r1 is a root source, s3 merged with merge_struct, "k99" is
+        # a number in s2 and s3, "k18" is filtered out from s2
+        self.src_db["r1"].insert_many(
+            [{"_id": "k%02d" % i, "root": i, "common": "r1"} for i in range(15)])
+        self.src_db["s2"].insert_many(
+            [{"_id": "k%02d" % i, "s2": i, "common": "s2", "skip": i == 18}
+             for i in range(5, 25)] + [{"_id": 99, "s2": 99}])
+        self.src_db["s3"].insert_many(
+            [{"_id": "k%02d" % i, "s3": [i], "common": "s3"} for i in range(10, 20)] +
+            [{"_id": 99, "s3": [99]}, {"_id": "k00", "s3": [0, 1]}])
+        for name in ("r1", "s2", "s3"):
+            self.hub_db["src_master"].insert_one(
+                {"_id": name, "name": name,
+                 "merger": "merge_struct" if name == "s3" else "upsert"})
+        patchers = [
+            mock.patch.object(mongo, "get_src_db", return_value=self.src_db),
+            mock.patch.object(mongo, "get_target_db", return_value=self.tgt_db),
+            # _ids of sources which can't be split in ranges
+            mock.patch.object(builder, "id_feeder", side_effect=self.id_feeder),
+            mock.patch.object(builder, "get_id_ranges", side_effect=self.get_id_ranges),
+            mock.patch("biothings.hub.databuild.builder.get_source_fullname",
+                       side_effect=lambda name: name),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def id_feeder(self, col, batch_size, **kwargs):
+        ids = sorted(col.docs, key=str)
+        return [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+
+    def get_id_ranges(self, cols, parts):
+        id_ranges = mongo.get_id_ranges(cols, parts)
+        if len(cols) > 1:
+            # ranges the sorted merge is split into
+            self.id_ranges = id_ranges
+        return id_ranges
+
+    def merge(self, builder_class, target_name, root):
+        self.hub_db["src_build_config"].save(
+            {"_id": "mybuild", "name": "mybuild", "sources": ["r1", "s2", "s3"], "root": root})
+        source_backend = SourceDocMongoBackend(
+            build_config=partial(lambda: self.hub_db["src_build_config"]),
+            build=partial(lambda: self.hub_db["src_build"]),
+            master=partial(lambda: self.hub_db["src_master"]),
+            dump=partial(lambda: self.hub_db["src_dump"]),
+            sources=partial(lambda: self.src_db))
+        builder = builder_class("mybuild", source_backend,
+                                TargetDocMongoBackend(self.tgt_db),
+                                log_folder=config.LOG_FOLDER,
+                                target_name=target_name)
+        builder.target_backend.set_target_name(target_name)
+        builder.mappers = {None: TransparentMapper()}
+        builder.partition_by_range = True
+        builder.sorted_merge_parts = 3
+        builder.register_status = mock.Mock()
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        loop.run_until_complete(builder.merge_sources(
+            ["s3", "s2", "r1"], steps="merge", batch_size=4, job_manager=JobManager()))
+        if isinstance(builder, SortedMergeDataBuilder):
+            # all merged in one pass
+            self.assertEqual(set(builder.sorted_merged), {"r1", "s2", "s3"})
+        return self.tgt_db[target_name].docs
+
+    def check(self, root):
+        expected = self.merge(FilteredDataBuilder, "regular", root)
+        with mock.patch.object(builder, "merger_worker") as regular_worker:
+            merged = self.merge(FilteredSortedMergeDataBuilder, "sorted", root)
+        self.assertFalse(regular_worker.called)
+        self.assertEqual(sorted(merged, key=str), sorted(expected, key=str))
+        for _id, doc in expected.items():
+            self.assertEqual(merged[_id], doc)
+        return merged
+
+    def test_root_source(self):
+        merged = self.check(["r1"])
+        self.assertEqual(len(merged), 15)
+        self.assertEqual(merged["k12"]["common"], ["s2", "s3"])
+        self.assertEqual(merged["k00"]["s3"], [0, 1])
+
+    def test_no_root_source(self):
+        merged = self.check([])
+        self.assertEqual(len(merged), 26)
+        self.assertNotIn("s2", merged["k18"])
+        self.assertEqual(merged[99], {"_id": 99, "s2": 99, "s3": [99]})
+        # one range when _ids aren't all strings
+        self.assertEqual(self.id_ranges, [IdRange(None, None)])
+
+    def test_id_ranges(self):
+        self.src_db["s2"].delete_one({"_id": 99})
+        self.src_db["s3"].delete_one({"_id": 99})
+        merged = self.check([])
+        self.assertEqual(len(merged), 25)
+        self.assertEqual(len(self.id_ranges), 3)
+        self.assertEqual(merged["k10"], {"_id": "k10", "root": 10, "s2": 10, "s3": [10],
+                                         "common": ["s2", "s3"], "skip": False})
+
+
+class TestIdRangeIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.col = Database("tgt")["mybuild"]
+        self.col.insert_many([{"_id": "id%d" % i, "v": i} for i in range(10)])
+        self.indexed = []
+        patcher = mock.patch("biothings.hub.dataindex.indexer.create_backend",
+                             return_value=SimpleNamespace(target_collection=self.col))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def pindexer(self):
+        indexed = self.indexed
+
+        class ESIndexer(object):
+            def index_bulk(self, docs, *args):
+                docs = list(docs)
+                indexed.extend(d["_id"] for d in docs)
+                return (len(docs), [])
+
+            def mexists(self, ids):
+                return [(_id, _id in ("id3", "id4")) for _id in ids]
+
+        return ESIndexer()
+
+    def test_index(self):
+        self.assertEqual(indexer_worker("mybuild", IdRange("id2", "id5"), self.pindexer, 1),
+                         (3, []))
+        self.assertEqual(self.indexed, ["id2", "id3", "id4"])
+
+    def test_resume(self):
+        # documents missing from the index only
+        indexer_worker("mybuild", IdRange(None, "id6"), self.pindexer, 1, mode="resume")
+        self.assertEqual(self.indexed, ["id0", "id1", "id2", "id5"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+import config, biothings
+biothings.config_for_app(config)
+
+import datetime
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from biothings.hub.databuild.mapper import MmapIDMapper
+from biothings.tests.mongo import Database
+from biothings.utils import sqlite3 as sqlite_hub_db
+
+
+class DictMapper(MmapIDMapper):
+
+    def __init__(self, mapping, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mapping = mapping
+        self.compiled = 0
+
+    def iter_mapping(self):
+        self.compiled += 1
+        return iter(self.mapping.items())
+
+
+class TestMmapIDMapper(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.mapping = {"ENSG%05d" % i: str(i) for i in range(1000)}
+        self.mapping["ENSG99999"] = ["1", "2"]
+        self.mapping[123] = "int"
+        self.mapper = DictMapper(self.mapping, name="ensembl",
+                                 mapping_file=os.path.join(self.folder, "ensembl.idmap"))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_translate(self):
+        self.assertEqual(len(self.mapper), 1002)
+        self.assertEqual(self.mapper.translate("ENSG00042"), "42")
+        self.assertEqual(self.mapper.translate("ENSG99999"), ["1", "2"])
+        self.assertEqual(self.mapper.translate(123), "int")
+        # keys compared as strings
+        self.assertEqual(self.mapper.translate("123"), "int")
+        self.assertIsNone(self.mapper.translate("nope"))
+        self.assertEqual(self.mapper.translate("nope", transparent=True), "nope")
+        self.assertIn("ENSG00000", self.mapper)
+        self.assertNotIn("ENSG", self.mapper)
+        ids = ["ENSG00999", "nope", "ENSG00000", "ENSG00999", "ENSG00500"]
+        self.assertEqual(self.mapper.translate_many(ids),
+                         ["999", None, "0", "999", "500"])
+
+    def test_process(self):
+        docs = [{"_id": "ENSG00001"}, {"_id": "nope"}, {"_id": "ENSG99999"}]
+        res = [dict(d) for d in self.mapper.process(docs, transparent=False, batch_size=2)]
+        self.assertEqual(res, [{"_id": "1"}, {"_id": "1"}, {"_id": "2"}])
+
+    def test_shared(self):
+        self.mapper.load()
+        # pickled (sent to workers) without the table, and without compiling it again
+        other = pickle.loads(pickle.dumps(self.mapper))
+        self.assertTrue(other.need_load())
+        self.assertEqual(other.translate("ENSG00007"), "7")
+        self.assertEqual(other.compiled, 1)
+
+    def check_mapping_timestamp(self, src_dump):
+        with mock.patch("biothings.hub.databuild.mapper.get_src_dump",
+                        return_value=src_dump):
+            # mapping collection never uploaded
+            self.assertIsNone(self.mapper.mapping_timestamp())
+            self.assertEqual(self.mapper.translate("ENSG00007"), "7")
+            self.mapper.init_table()
+            self.assertFalse(self.mapper.need_compile())
+            # uploaded again after the table was compiled
+            uploaded = datetime.datetime.utcnow() + datetime.timedelta(seconds=10)
+            src_dump.save({"_id": "ensembl", "upload": {"jobs": {"ensembl": {
+                "status": "success", "started_at": uploaded}}}})
+            self.assertAlmostEqual(self.mapper.mapping_timestamp(), time.time() + 10, delta=5)
+            self.assertTrue(self.mapper.need_compile())
+            self.mapper.mapping["ENSG00007"] = "seven"
+            self.assertEqual(self.mapper.translate("ENSG00007"), "seven")
+            self.assertEqual(self.mapper.compiled, 2)
+            # a sub-source of another source
+            other = DictMapper({}, name="ensembl_gene", mapping_source="ensembl")
+            self.assertIsNone(other.mapping_timestamp())
+            src_dump.save({"_id": "ensembl", "upload": {"jobs": {"ensembl_gene": {
+                "status": "success", "started_at": uploaded}}}})
+            self.assertAlmostEqual(other.mapping_timestamp(), time.time() + 10, delta=5)
+            # failed uploads don't count
+            src_dump.save({"_id": "ensembl", "upload": {"jobs": {"ensembl_gene": {
+                "status": "failed", "started_at": uploaded}}}})
+            self.assertIsNone(other.mapping_timestamp())
+
+    def test_mapping_timestamp(self):
+        self.check_mapping_timestamp(Database("hub")["src_dump"])
+        other = DictMapper({}, name="ensembl", mapping_collection="ensembl_gene")
+        self.assertEqual(other.mapping_collection, "ensembl_gene")
+        self.assertEqual(other.mapping_source, "ensembl_gene")
+
+    def test_mapping_timestamp_sqlite(self):
+        # dates stored as ISO strings
+        src_dump = sqlite_hub_db.Database()["src_dump_%s" % os.path.basename(self.folder)]
+        self.check_mapping_timestamp(src_dump)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,249 @@
+import config, biothings
+biothings.config_for_app(config)
+
+import asyncio
+import gzip
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from biothings.hub.dataload.dumper import HTTPDumper, AsyncHTTPDumper, DownloadWriter
+
+DATA = os.urandom(1024 * 1024)
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serve DATA, supporting byte ranges. Requests for ranges starting
+    at server.fail_at are interrupted halfway."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.server.heads += 1
+        self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(len(self.server.data)))
+        self.send_header("ETag", '"v1"')
+        self.end_headers()
+
+    def do_GET(self):
+        match = re.match(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        start, end = (int(match.group(1)), int(match.group(2)) + 1) if match else (0, len(self.server.data))
+        data = self.server.data[start:end]
+        self.send_response(206 if match else 200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if start == self.server.fail_at:
+            self.server.fail_at = None
+            data = data[:len(data) // 2]
+        self.wfile.write(data)
+        self.server.served += len(data)
+
+
+class TestSegmentedDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+        self.server.fail_at = None
+        self.server.served = 0
+        self.server.heads = 0
+        self.server.data = DATA
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:%s/data.bin" % self.server.server_port
+        self.folder = tempfile.mkdtemp()
+        self.localfile = os.path.join(self.folder, "data.bin")
+
+        class SegmentedDumper(HTTPDumper):
+            SEGMENTS = 4
+            SEGMENT_MIN_SIZE = 1
+            SEGMENT_SAVE_EVERY = 1
+        self.dumper = SegmentedDumper()
+        self.dumper.logger = logging.getLogger("test_dumper")
+        self.dumper.prepare_client()
+
+    def tearDown(self):
+        self.dumper.release_client()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder)
+
+    def test_segments(self):
+        info = self.dumper.download(self.url, self.localfile)
+        self.assertEqual(info["size"], len(DATA))
+        with open(self.localfile, "rb") as in_f:
+            self.assertEqual(in_f.read(), DATA)
+        self.assertFalse(os.path.exists(self.localfile + ".segments"))
+
+    def test_resume(self):
+        """
+        Only missing parts are downloaded again after an interruption.
+        """
+        self.server.fail_at = len(DATA) // 4
+        with self.assertRaises(Exception):
+            self.dumper.download(self.url, self.localfile)
+        self.assertTrue(os.path.exists(self.localfile + ".segments"))
+        self.server.served = 0
+        self.dumper.download(self.url, self.localfile)
+        self.assertLessEqual(self.server.served, len(DATA) // 4)
+        with open(self.localfile, "rb") as in_f:
+            self.assertEqual(in_f.read(), DATA)
+
+    def test_async(self):
+        dumper = AsyncHTTPDumper()
+        dumper.logger = self.dumper.logger
+        dumper.to_dump = [{"remote": self.url, "local": os.path.join(self.folder, "data%d.bin" % i)}
+                          for i in range(3)]
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(dumper.do_dump())
+        finally:
+            loop.close()
+        self.assertEqual([info["file"] for info in dumper.dumped_files],
+                         ["data0.bin", "data1.bin", "data2.bin"])
+        for i in range(3):
+            with open(os.path.join(self.folder, "data%d.bin" % i), "rb") as in_f:
+                self.assertEqual(in_f.read(), DATA)
+
+    def run_async(self, dumper, job_manager=None, num=3):
+        dumper.logger = self.dumper.logger
+        dumper.to_dump = [{"remote": self.url, "local": os.path.join(self.folder, "data%d.bin" % i)}
+                          for i in range(num)]
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(dumper.do_dump(job_manager=job_manager))
+        finally:
+            loop.close()
+        for i in range(num):
+            with open(os.path.join(self.folder, "data%d.bin" % i), "rb") as in_f:
+                self.assertEqual(in_f.read(), DATA)
+
+    def test_async_off_loop(self):
+        """
+        Data is written outside the event loop's thread, segmented
+        downloads are honored, and so are job manager's constraints.
+        """
+        threads = set()
+
+        class Writer(DownloadWriter):
+            def write(self, chunk):
+                threads.add(threading.current_thread())
+                super().write(chunk)
+
+        class SegmentedDumper(AsyncHTTPDumper):
+            SEGMENTS = 4
+            SEGMENT_MIN_SIZE = len(DATA) + 1
+
+            def new_writer(self, localfile, written=False):
+                return Writer(localfile, checksum="md5", written=written)
+
+        checked = []
+
+        class JobManager(object):
+            def __init__(self):
+                self.ok_to_run = asyncio.Semaphore()
+
+            async def check_constraints(self, pinfo):
+                checked.append(pinfo["__predicates__"])
+
+        self.run_async(SegmentedDumper(), JobManager(), num=2)
+        self.assertEqual(len(checked), 2)
+        self.assertTrue(threads)
+        self.assertNotIn(threading.current_thread(), threads)
+        # large enough to be downloaded in segments
+        SegmentedDumper.SEGMENT_MIN_SIZE = 1
+        self.server.fail_at = len(DATA) // 4
+        with self.assertRaises(Exception):
+            self.run_async(SegmentedDumper(), num=1)
+        self.assertTrue(os.path.exists(os.path.join(self.folder, "data0.bin.segments")))
+        self.server.served = 0
+        self.run_async(SegmentedDumper(), num=1)
+        self.assertLessEqual(self.server.served, len(DATA) // 4)
+
+    def test_blob_store(self):
+        """
+        Unchanged files are linked from the previous release, not downloaded.
+        """
+        class BlobDumper(HTTPDumper):
+            BLOB_STORE = True
+        dumper = BlobDumper(src_root_folder=self.folder)
+        dumper.logger = self.dumper.logger
+        dumper.prepare_client()
+        first = os.path.join(self.folder, "v1", "data.bin")
+        info = dumper.download(self.url, first)
+        self.assertEqual(info["etag"], '"v1"')
+        self.assertTrue(os.path.exists(dumper.blob_path(info["sha256"])))
+        self.server.served = 0
+        dumper.prev_manifest = {self.url: info}
+        second = os.path.join(self.folder, "v2", "data.bin")
+        info = dumper.download(self.url, second)
+        dumper.release_client()
+        self.assertTrue(info["reused"])
+        self.assertEqual(self.server.served, 0)
+        self.assertTrue(os.path.samefile(first, second))
+
+    def test_blob_store_decompressed(self):
+        """
+        Decompressed files are stored too, and not decompressed again when reused.
+        """
+        class BlobDumper(HTTPDumper):
+            BLOB_STORE = True
+            DECOMPRESS = True
+            KEEP_COMPRESSED = False
+            SEGMENTS = 2
+            SEGMENT_MIN_SIZE = 1
+        self.server.data = gzip.compress(DATA)
+        url = self.url.replace(".bin", ".bin.gz")
+        dumper = BlobDumper(src_root_folder=self.folder)
+        dumper.logger = self.dumper.logger
+        dumper.prepare_client()
+        info = dumper.download(url, os.path.join(self.folder, "v1", "data.bin.gz"))
+        # HEAD response shared by blob store and segmented download
+        self.assertEqual(self.server.heads, 1)
+        self.assertIsNone(info["file"])
+        dumper.prev_manifest = {url: info}
+        with mock.patch.object(dumper, "new_writer") as new_writer:
+            info = dumper.download(url, os.path.join(self.folder, "v2", "data.bin.gz"))
+            self.assertFalse(new_writer.called)
+        dumper.release_client()
+        self.assertTrue(info["reused"])
+        self.assertTrue(os.path.samefile(os.path.join(self.folder, "v1", "data.bin"),
+                                         os.path.join(self.folder, "v2", "data.bin")))
+        with open(os.path.join(self.folder, "v2", "data.bin"), "rb") as in_f:
+            self.assertEqual(in_f.read(), DATA)
+
+    def test_prune_blobs(self):
+        class BlobDumper(HTTPDumper):
+            BLOB_STORE = True
+            BLOB_KEEP_RELEASES = 1
+        dumper = BlobDumper(src_root_folder=self.folder)
+        dumper.logger = self.dumper.logger
+        dumper.prepare_client()
+        for release in ("v1", "v2"):
+            self.server.data = os.urandom(1024)
+            info = dumper.download(self.url, os.path.join(self.folder, release, "data.bin"))
+            dumper.dumped_files = [info]
+            dumper.release = release
+            with mock.patch.object(BlobDumper, "new_data_folder",
+                                   os.path.join(self.folder, release)):
+                dumper.save_manifest()
+            os.utime(os.path.join(self.folder, release, BlobDumper.MANIFEST_FILE),
+                     (int(release[1:]), int(release[1:])))
+        dumper.release_client()
+        dumper.prune_blobs()
+        store = os.path.join(self.folder, ".blobs", "sha256")
+        blobs = [name for folder in os.listdir(store)
+                 for name in os.listdir(os.path.join(store, folder))]
+        self.assertEqual(blobs, [info["sha256"]])
+        # release folders keep their files
+        self.assertTrue(os.path.exists(os.path.join(self.folder, "v1", "data.bin")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+import config, biothings
+biothings.config_for_app(config)
+
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from biothings.hub.dataload.metrics import UploadMetrics, percentiles, \
+    summarize_upload, input_size
+from biothings.hub.dataload.storage import BaseStorage, BasicStorage, \
+    FastLoadStorage, PipelinedStorage
+from biothings.utils.common import FileRange
+from biothings.tests.mongo import Database
+
+
+class SlowStorage(BaseStorage):
+    """Store batches of documents, taking some time to do so"""
+
+    def __init__(self, delay):
+        super().__init__(Database("src"), "slow")
+        self.delay = delay
+        self.stored = []
+
+    def process(self, docs, batch_size):
+        batch = []
+        for doc in docs:
+            batch.append(doc)
+            if len(batch) == batch_size:
+                self.write(batch)
+                batch = []
+        if batch:
+            self.write(batch)
+        return len(self.stored)
+
+    def write(self, batch):
+        with self.timed_write():
+            time.sleep(self.delay)
+            self.stored.extend(batch)
+
+
+class TestUploadMetrics(unittest.TestCase):
+
+    def test_percentiles(self):
+        res = percentiles(list(range(1, 101)))
+        self.assertEqual(res, {"p50": 50, "p90": 90, "p99": 99, "max": 100})
+        self.assertEqual(percentiles([]), {})
+
+    def test_upload_metrics(self):
+        def load_data():
+            for i in range(25):
+                time.sleep(0.002)
+                yield {"_id": i}
+
+        metrics = UploadMetrics()
+        storage = SlowStorage(0.05)
+        storage.on_write = metrics.on_write
+        cnt = storage.process(metrics.load(load_data), 10)
+        res = metrics.finish(storage, cnt)
+
+        self.assertEqual(res["docs"], 25)
+        # 3 batches (10, 10 and 5 docs), each written in about 50ms
+        self.assertEqual(len(res["batch_latencies"]), 3)
+        for latency in res["batch_latencies"]:
+            self.assertGreaterEqual(latency, 0.05)
+        self.assertGreaterEqual(res["parse_time"], 0.05)
+        self.assertGreaterEqual(res["write_time"], 0.15)
+        self.assertLess(res["parse_time"], res["write_time"])
+        self.assertGreater(res["peak_rss"], 0)
+
+        summary = summarize_upload([res, res], res["time"], 1000)
+        self.assertEqual(summary["docs"], 50)
+        self.assertEqual(summary["bytes"], 1000)
+        self.assertEqual(summary["batches"], 6)
+        self.assertEqual(set(summary["batch_latency"]), {"p50", "p90", "p99", "max"})
+
+    def test_upload_metrics_dict(self):
+        metrics = UploadMetrics()
+        docs = metrics.load(lambda: {i: {"v": i} for i in range(5)})
+        self.assertIsInstance(docs, dict)
+        res = metrics.finish(None, len(docs))
+        self.assertEqual(res["docs"], 5)
+        self.assertEqual(res["batch_latencies"], [])
+
+    def test_storage_writes(self):
+        # batches are the ones actually written, not batch_size documents
+        storage = FastLoadStorage(Database("src"), "fast")
+        storage.batch_bytes = 100
+        metrics = UploadMetrics()
+        storage.on_write = metrics.on_write
+        docs = ({"_id": i, "v": "x" * 40} for i in range(10))
+        with mock.patch.object(storage.temp_collection, "insert_many",
+                               wraps=storage.temp_collection.insert_many) as insert_many:
+            cnt = storage.process(docs, 8)
+        res = metrics.finish(storage, cnt)
+        self.assertEqual(res["docs"], 10)
+        self.assertEqual(len(res["batch_latencies"]), insert_many.call_count)
+        self.assertEqual(insert_many.call_count, 5)
+
+    def test_pipelined_storage(self):
+        def load_data():
+            for i in range(25):
+                time.sleep(0.002)
+                yield {"_id": i}
+
+        storage = type("Pipelined", (PipelinedStorage, BasicStorage), {})(
+            Database("src"), "pipelined")
+        metrics = UploadMetrics()
+        storage.on_write = metrics.on_write
+        cnt = storage.process(metrics.load(load_data), 10)
+        res = metrics.finish(storage, cnt)
+        self.assertEqual(res["docs"], 25)
+        # written by writer threads, in batches from the queue
+        self.assertGreaterEqual(len(res["batch_latencies"]), 3)
+        self.assertGreaterEqual(res["parse_time"], 0.05)
+        self.assertEqual(set(res["queue_wait"]), {"parse", "write"})
+
+    def test_input_size(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "data.tsv")
+            with open(path, "wb") as data:
+                data.write(b"x" * 1000)
+            # folder shared by jobs is counted once
+            self.assertEqual(input_size(folder, 1, folder), 1000)
+            self.assertEqual(input_size(FileRange(path, 0, 400),
+                                        FileRange(path, 400, 600)), 1000)
+            self.assertEqual(input_size(None, "missing"), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,294 @@
+import config, biothings
+biothings.config_for_app(config)
+
+import copy
+import os
+import tempfile
+import threading
+import time
+import unittest
+from collections import OrderedDict
+from unittest import mock
+
+import bson
+from bson.raw_bson import RawBSONDocument
+from pymongo.errors import BulkWriteError
+
+from biothings.hub.dataload.storage import BasicStorage, DeltaStorage, \
+    FastLoadStorage, MergerStorage, PipelinedStorage, SortMergeStorage, \
+    hash_collection_name, change_collection_name
+from biothings.utils.dataload import merge_struct
+from biothings.tests.mongo import Database
+
+
+class TestDeltaStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Database("src")
+        self.col = self.db["delta"]
+        self.hashes = self.db[hash_collection_name("delta")]
+        self.changes = self.db[change_collection_name("delta")]
+
+    def upload(self, docs, batch_size=2):
+        storage = DeltaStorage(self.db, "delta")
+        return storage.process((dict(d) for d in docs), batch_size)
+
+    def get_changes(self):
+        return {d["_id"]: d["op"] for d in self.changes.find()}
+
+    def test_changes(self):
+        docs = [{"_id": i, "v": i} for i in range(5)]
+        self.assertEqual(self.upload(docs), 5)
+        self.assertEqual(self.get_changes(), {i: "insert" for i in range(5)})
+        docs[1]["v"] = 10
+        del docs[3]
+        docs.append({"_id": 7, "v": 7})
+        self.assertEqual(self.upload(docs), 5)
+        self.assertEqual(self.get_changes(), {1: "replace", 3: "delete", 7: "insert"})
+        self.assertEqual(sorted(self.col.docs), [0, 1, 2, 4, 7])
+        self.assertEqual(self.col.find_one({"_id": 1})["v"], 10)
+        self.assertEqual(sorted(self.hashes.docs), [0, 1, 2, 4, 7])
+        # nothing changed
+        self.upload(docs)
+        self.assertEqual(self.get_changes(), {})
+
+    def test_populated_collection(self):
+        # collection uploaded before, without hashes
+        self.col.insert_many([{"_id": i, "v": 0} for i in range(4)])
+        docs = [{"_id": i, "v": i} for i in range(1, 6)]
+        self.assertEqual(self.upload(docs), 5)
+        self.assertEqual(self.col.find_one({"_id": 2}), {"_id": 2, "v": 2})
+        self.assertEqual(sorted(self.col.docs), [1, 2, 3, 4, 5])
+        changes = self.get_changes()
+        self.assertEqual(changes.pop(0), "delete")
+        self.assertEqual(set(changes.values()), {"insert"})
+
+    def test_interrupted_upload(self):
+        self.upload([{"_id": i, "v": i} for i in range(6)])
+        docs = [{"_id": i, "v": i * 10} for i in range(1, 8)]
+        # interrupted after storing a batch, before storing its hashes
+        with mock.patch.object(self.hashes, "initialize_unordered_bulk_op",
+                               side_effect=RuntimeError("interrupted")):
+            with self.assertRaises(RuntimeError):
+                self.upload(docs, batch_size=3)
+        self.assertEqual(self.col.find_one({"_id": 1})["v"], 10)
+        self.assertEqual(self.col.find_one({"_id": 6}), None)
+        # next upload completes it
+        self.assertEqual(self.upload(docs, batch_size=3), 7)
+        self.assertEqual(sorted(self.col.docs), list(range(1, 8)))
+        self.assertEqual([d["v"] for d in self.col.find()], [i * 10 for i in range(1, 8)])
+        self.assertEqual(self.get_changes()[0], "delete")
+
+    def test_duplicated_ids(self):
+        self.upload([{"_id": i, "v": i} for i in range(3)])
+        # repeated within a batch, and across batches
+        docs = [{"_id": 1, "v": 10}, {"_id": 1, "v": 11}, {"_id": 5, "v": 5},
+                {"_id": 5, "v": 50}, {"_id": 2, "v": 2}, {"_id": 1, "v": 12}]
+        self.assertEqual(self.upload(docs, batch_size=3), 6)
+        self.assertEqual(self.get_changes(), {0: "delete", 1: "replace", 5: "insert"})
+        self.assertEqual(list(self.col.find()),
+                         [{"_id": 1, "v": 12}, {"_id": 2, "v": 2}, {"_id": 5, "v": 50}])
+        self.assertEqual(sorted(self.hashes.docs), [1, 2, 5])
+        # stored as it was last
+        self.upload([{"_id": 1, "v": 12}, {"_id": 2, "v": 2}, {"_id": 5, "v": 50}])
+        self.assertEqual(self.get_changes(), {})
+
+
+def merged_docs(docs):
+    """
+    Expected result of storing docs one by one, merging
+    the ones sharing an _id in the order they come
+    """
+    merged = OrderedDict()
+    for doc in copy.deepcopy(docs):
+        if doc["_id"] in merged:
+            _id = doc.pop("_id")
+            merged[_id] = merge_struct(doc, merged[_id])
+        else:
+            merged[doc["_id"]] = doc
+    return merged
+
+
+# _ids repeated within and across batches
+MERGE_DOCS = [{"_id": i % 7, "v": i, "sub": {"w": i}} for i in range(30)] + \
+    [{"_id": 3, "other": True}, {"_id": 3, "v": 100}]
+
+
+class MergeStorageTestCase(unittest.TestCase):
+
+    storage_class = MergerStorage
+
+    def setUp(self):
+        self.db = Database("src")
+        self.col = self.db["merged"]
+
+    def upload(self, docs, batch_size=4, **attrs):
+        storage = type("Storage", (self.storage_class,), attrs)(self.db, "merged")
+        storage.logger = mock.Mock()
+        cnt = storage.process((d for d in copy.deepcopy(docs)), batch_size)
+        return cnt, storage
+
+    def check_merged(self, docs, **kwargs):
+        cnt, storage = self.upload(docs, **kwargs)
+        self.assertEqual(cnt, len(docs))
+        expected = merged_docs(docs)
+        self.assertEqual(sorted(self.col.docs), sorted(expected))
+        for _id, doc in expected.items():
+            self.assertEqual(self.col.find_one({"_id": _id}), doc)
+        return storage
+
+
+class TestMergerStorage(MergeStorageTestCase):
+
+    def test_premerge(self):
+        storage = MergerStorage(self.db, "merged")
+        doc = {"_id": 1, "v": 1}
+        docs, aslistofdict = storage.premerge(
+            [{"_id": 2, "v": 2, "__aslistofdict__": "sub"}, doc, {"_id": 1, "v": 3}, doc])
+        self.assertEqual(aslistofdict, "sub")
+        self.assertEqual(docs, [{"_id": 2, "v": 2}, {"_id": 1, "v": [3, 1]}])
+
+    def test_merged(self):
+        # merged in batches and with recently stored documents
+        storage = self.check_merged(MERGE_DOCS)
+        fixes = [c for c in storage.logger.info.call_args_list if "Fixing" in c[0][0]]
+        self.assertEqual(fixes, [])
+
+    def test_merged_duplicate_errors(self):
+        # recent _ids not remembered, merged on duplicate errors
+        storage = self.check_merged(MERGE_DOCS, recent_ids_size=0)
+        fixes = [c for c in storage.logger.info.call_args_list if "Fixing" in c[0][0]]
+        self.assertTrue(fixes)
+
+    def test_merged_recent_ids_size(self):
+        # only a few _ids remembered
+        self.check_merged(MERGE_DOCS, recent_ids_size=2)
+        self.col.drop()
+        self.check_merged(MERGE_DOCS, batch_size=1, recent_ids_size=1)
+
+
+class TestSortMergeStorage(MergeStorageTestCase):
+
+    storage_class = SortMergeStorage
+
+    def test_merged(self):
+        with tempfile.TemporaryDirectory() as folder:
+            # several runs, merged in _id order
+            storage = self.check_merged(MERGE_DOCS, run_size=5, spill_folder=folder)
+            self.assertEqual(list(self.col.docs), sorted(self.col.docs))
+            spilled = [c for c in storage.logger.info.call_args_list if "Spilled" in c[0][0]]
+            self.assertEqual(len(spilled), 7)
+            # runs removed
+            self.assertEqual(os.listdir(folder), [])
+        self.col.drop()
+        self.check_merged(MERGE_DOCS, batch_size=100)
+
+    def test_same_as_merger_storage(self):
+        cnt, _ = self.upload(MERGE_DOCS, run_size=3)
+        merged = copy.deepcopy(self.col.docs)
+        self.col.drop()
+        self.storage_class = MergerStorage
+        self.assertEqual(self.upload(MERGE_DOCS)[0], cnt)
+        self.assertEqual(self.col.docs, merged)
+
+
+class TestPipelinedStorage(MergeStorageTestCase):
+
+    storage_class = type("PipelinedBasicStorage", (PipelinedStorage, BasicStorage), {})
+
+    def test_stored(self):
+        docs = [{"_id": i, "v": i} for i in range(100)]
+        cnt, storage = self.upload(docs, batch_size=7)
+        self.assertEqual(cnt, 100)
+        self.assertEqual(sorted(self.col.docs), list(range(100)))
+        self.assertEqual(storage.pipeline_stats["parse"]["docs"], 100)
+        self.assertEqual(storage.pipeline_stats["write"]["docs"], 100)
+        # not a generator, stored as is
+        storage = self.storage_class(self.db, "other")
+        self.assertEqual(storage.process({"a": {"v": 1}}, 10), 1)
+        self.assertEqual(self.db["other"].find_one(), {"_id": "a", "v": 1})
+
+    def test_merged(self):
+        self.storage_class = type("PipelinedMergerStorage",
+                                  (PipelinedStorage, MergerStorage), {})
+        self.check_merged(MERGE_DOCS, pipeline_writers=1)
+
+    def test_writer_error(self):
+        insert = self.col.insert
+        inserts = []
+        lock = threading.Lock()
+
+        def failing_insert(docs, **kwargs):
+            # let the parser fill the queue
+            time.sleep(0.2)
+            with lock:
+                inserts.append(len(docs))
+                if len(inserts) == 1:
+                    raise RuntimeError("write failed")
+            insert(docs, **kwargs)
+        self.col.insert = failing_insert
+
+        parsed = []
+
+        def parse():
+            for i in range(1000):
+                parsed.append(i)
+                yield {"_id": i}
+        storage = self.storage_class(self.db, "merged")
+        storage.pipeline_queue_size = 4
+        with self.assertRaisesRegex(RuntimeError, "write failed"):
+            storage.process(parse(), 10)
+        # parser stopped, queued batches dropped: only the batch the
+        # other writer was storing is stored
+        self.assertLess(len(parsed), 200)
+        self.assertLessEqual(len(inserts), 2)
+        self.assertLessEqual(len(self.col.docs), 10)
+
+    def test_parser_error(self):
+        def parse():
+            for i in range(100):
+                yield {"_id": i}
+            raise ValueError("parse failed")
+        storage = self.storage_class(self.db, "merged")
+        with self.assertRaisesRegex(ValueError, "parse failed"):
+            storage.process(parse(), 10)
+        self.assertFalse([t for t in threading.enumerate()
+                          if t.name.startswith("storage-writer")])
+
+
+class TestFastLoadStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Database("src")
+        self.col = self.db["fast"]
+        self.storage = FastLoadStorage(self.db, "fast")
+        self.batches = []
+
+        def insert_many(docs, **kwargs):
+            self.batches.append(list(docs))
+            return self.col.__class__.insert_many(self.col, docs, **kwargs)
+        self.col.insert_many = insert_many
+
+    def test_batch_bytes(self):
+        docs = [{"_id": i, "v": "x" * 100} for i in range(20)]
+        size = len(bson.BSON.encode(docs[0]))
+        self.storage.batch_bytes = size * 3
+        self.assertEqual(self.storage.process((d for d in docs), 100), 20)
+        self.assertEqual([len(batch) for batch in self.batches], [3] * 6 + [2])
+        self.assertTrue(all(isinstance(doc, RawBSONDocument)
+                            for batch in self.batches for doc in batch))
+        self.assertEqual([self.col.find_one({"_id": i}) for i in range(20)], docs)
+
+    def test_batch_size(self):
+        docs = [{"_id": i} for i in range(10)]
+        self.assertEqual(self.storage.process((d for d in docs), 4), 10)
+        self.assertEqual([len(batch) for batch in self.batches], [4, 4, 2])
+
+    def test_duplicates(self):
+        docs = [{"_id": 1}, {"_id": 2}, {"_id": 1}]
+        with self.assertRaises(BulkWriteError):
+            self.storage.process((d for d in docs), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
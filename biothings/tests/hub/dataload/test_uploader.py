@@ -0,0 +1,185 @@
+import config, biothings
+biothings.config_for_app(config)
+
+import asyncio
+import os
+import tempfile
+import unittest
+from functools import partial
+from unittest import mock
+
+from pymongo import ASCENDING, IndexModel
+
+from biothings.hub.dataload.uploader import BaseSourceUploader, \
+    DeltaSourceUploader, ParallelizedSourceUploader, ResourceError
+from biothings.tests.mongo import Database
+from biothings.utils.common import FileRange, split_file
+
+
+class SplitUploader(ParallelizedSourceUploader):
+
+    name = "split"
+    split_files = ["*.tsv"]
+    split_parts = 4
+
+
+class TestParallelizedSourceUploader(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        with open(os.path.join(self.folder.name, "data.tsv"), "w") as out_f:
+            out_f.write("id\tvalue\n")
+            for i in range(1000):
+                out_f.write("%d\t%s\n" % (i, "x" * 20))
+        self.uploader = SplitUploader(None)
+        self.uploader.data_folder = self.folder.name
+        self.uploader.logger = mock.Mock()
+
+    def test_split_header_required(self):
+        with self.assertRaises(ResourceError):
+            self.uploader.jobs()
+
+    def test_split_jobs(self):
+        self.uploader.split_header = 1
+        with mock.patch("biothings.hub.dataload.uploader.split_file",
+                        partial(split_file, min_size=1000)):
+            jobs = self.uploader.jobs()
+        self.assertEqual(len(jobs), 4)
+        self.assertTrue(all(isinstance(frange, FileRange) and frange.header == 1
+                            for frange, in jobs))
+
+
+class TestBuildIndexes(unittest.TestCase):
+
+    def setUp(self):
+        self.uploader = BaseSourceUploader(None)
+        self.uploader.db = Database("src")
+        self.uploader.temp_collection_name = "tmp"
+        self.uploader.logger = mock.Mock()
+
+    def test_build_indexes(self):
+        # nothing declared
+        self.uploader.build_indexes()
+        self.assertEqual(self.uploader.db["tmp"].indexes, [])
+        model = IndexModel([("b", ASCENDING), ("c", ASCENDING)], name="b_c")
+        self.uploader.indexes = [[("a", ASCENDING)], model]
+        with mock.patch.object(self.uploader.db["tmp"], "create_indexes",
+                               wraps=self.uploader.db["tmp"].create_indexes) as create:
+            self.uploader.build_indexes()
+        # all at once
+        self.assertEqual(create.call_count, 1)
+        indexes = self.uploader.db["tmp"].indexes
+        self.assertTrue(all(isinstance(idx, IndexModel) for idx in indexes))
+        self.assertEqual([idx.document["key"] for idx in indexes],
+                         [{"a": ASCENDING}, {"b": ASCENDING, "c": ASCENDING}])
+        self.assertIs(indexes[1], model)
+        # on another collection
+        self.uploader.build_indexes("main")
+        self.assertEqual(len(self.uploader.db["main"].indexes), 2)
+
+
+class JobManager(object):
+
+    async def defer_to_process(self, pinfo, func):
+        fut = asyncio.Future()
+        fut.set_result(func())
+        return fut
+
+
+class DocsMixin(object):
+
+    name = "docs"
+    docs = []
+
+    def load_data(self, data_folder):
+        return (doc for doc in self.docs)
+
+
+class DocsUploader(DocsMixin, BaseSourceUploader):
+    pass
+
+
+class DeltaDocsUploader(DocsMixin, DeltaSourceUploader):
+    pass
+
+
+class PartsUploader(DocsMixin, ParallelizedSourceUploader):
+
+    def jobs(self):
+        # all jobs parse the same folder
+        return [(self.data_folder, part) for part in range(3)]
+
+    def load_data(self, data_folder, part):
+        return (doc for i, doc in enumerate(self.docs) if i % 3 == part)
+
+
+class TestUpdateData(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Database("src")
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        with open(os.path.join(self.folder.name, "data.json"), "wb") as out_f:
+            out_f.write(b"x" * 100)
+        self.src_dump = Database("hub")["src_dump"]
+        self.src_dump.insert_one({"_id": "docs", "download": {
+            "release": "2", "data_folder": self.folder.name}})
+        patchers = [
+            mock.patch("biothings.hub.dataload.uploader.get_src_conn",
+                       return_value={BaseSourceUploader.__database__: self.db}),
+            mock.patch("biothings.hub.dataload.uploader.get_src_dump",
+                       return_value=self.src_dump),
+            mock.patch("biothings.hub.dataload.uploader.get_src_master",
+                       return_value=Database("hub")["src_master"]),
+            mock.patch("biothings.hub.dataload.storage.get_src_db", return_value=self.db),
+            mock.patch.object(BaseSourceUploader, "setup_log",
+                              return_value=(mock.Mock(), None)),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def update_data(self, uploader_class, docs):
+        uploader = uploader_class(None)
+        uploader.docs = docs
+        uploader.prepare()
+        uploader.make_temp_collection()
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        loop.run_until_complete(uploader.update_data(10, JobManager()))
+        return uploader
+
+    def test_update_data(self):
+        uploader = self.update_data(DocsUploader, [{"_id": "1"}, {"_id": "2"}])
+        # stored in a temp collection, then switched
+        self.assertEqual(sorted(self.db["docs"].docs), ["1", "2"])
+        self.assertNotIn(uploader.temp_collection_name, self.db.collection_names())
+        self.assertEqual(self.src_dump.find_one({"_id": "docs"})["upload"]["archives"],
+                         {"docs": {"docs": "2"}})
+        self.assertEqual(uploader.metrics["docs"], 2)
+        self.assertEqual(uploader.metrics["bytes"], 100)
+        self.assertEqual(uploader.metrics["batches"], 1)
+
+    def test_delta_update_data(self):
+        self.db["docs"].insert_many([{"_id": "1"}, {"_id": "3"}])
+        uploader = self.update_data(DeltaDocsUploader, [{"_id": "1"}, {"_id": "2"}])
+        # stored in place, with changes recorded
+        self.assertEqual(sorted(self.db["docs"].docs), ["1", "2"])
+        self.assertNotIn(uploader.temp_collection_name, self.db.collection_names())
+        job = self.src_dump.find_one({"_id": "docs"})["upload"]["jobs"]["docs"]
+        self.assertEqual(job["changes"], {"insert": 2, "replace": 0, "delete": 1})
+        self.assertEqual(uploader.metrics["docs"], 2)
+
+    def test_parallelized_update_data(self):
+        uploader = self.update_data(PartsUploader, [{"_id": str(i)} for i in range(7)])
+        self.assertEqual(sorted(self.db["docs"].docs), [str(i) for i in range(7)])
+        self.assertEqual(uploader.metrics["workers"], 3)
+        self.assertEqual(uploader.metrics["docs"], 7)
+        # data folder is counted once, not once per job
+        self.assertEqual(uploader.metrics["bytes"], 100)
+        self.assertEqual(uploader.metrics["batches"], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
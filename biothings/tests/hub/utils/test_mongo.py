@@ -0,0 +1,63 @@
+import config, biothings
+biothings.config_for_app(config)
+
+import unittest
+from unittest import mock
+
+from biothings.utils.mongo import IdRange, get_id_ranges, get_split_points, \
+    id_range_query, ids_query
+from biothings.tests.mongo import Database, match
+
+
+class TestIdRanges(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Database("src")
+        self.col = self.db["col"]
+        self.col.insert_many([{"_id": "id%03d" % i} for i in range(100)])
+
+    def test_split_points(self):
+        # splitVector not allowed, _ids read once, in order
+        with mock.patch.object(self.col, "find", wraps=self.col.find) as find:
+            self.assertEqual(get_split_points(self.col, 4), ["id025", "id050", "id075"])
+        self.assertEqual(find.call_count, 1)
+        self.assertEqual(get_split_points(self.col, 1), [])
+        self.assertEqual(len(get_split_points(self.col, 100)), 99)
+        self.assertEqual(get_split_points(self.col, 101), [])
+
+    def test_split_points_split_vector(self):
+        def command(name, *args, **kwargs):
+            if name == "collstats":
+                return {"size": 1000}
+            return {"splitKeys": [{"_id": "id%03d" % i} for i in range(10, 100, 10)]}
+        with mock.patch.object(self.db, "command", side_effect=command):
+            self.assertEqual(get_split_points(self.col, 3), ["id030", "id060"])
+
+    def test_id_ranges(self):
+        other = self.db["other"]
+        other.insert_many([{"_id": "id%03d" % i} for i in range(50, 60)])
+        ranges = get_id_ranges([other, self.col], 4)
+        self.assertEqual(ranges, [IdRange(None, "id025"), IdRange("id025", "id050"),
+                                  IdRange("id050", "id075"), IdRange("id075", None)])
+        # every _id in exactly one range
+        for col in (self.col, other):
+            found = []
+            for id_range in ranges:
+                found.extend(d["_id"] for d in col.find(ids_query(id_range)))
+            self.assertEqual(sorted(found), sorted(col.docs))
+
+    def test_id_ranges_not_str(self):
+        self.col.insert_one({"_id": 1})
+        self.assertEqual(get_id_ranges([self.col], 4), [IdRange(None, None)])
+
+    def test_queries(self):
+        self.assertEqual(ids_query(["a", "b"]), {"_id": {"$in": ["a", "b"]}})
+        self.assertEqual(ids_query(IdRange("a", None)), {"_id": {"$gte": "a"}})
+        self.assertEqual(id_range_query(IdRange(None, None)), {})
+        self.assertEqual(id_range_query(IdRange(None, None), {"x": 1}), {"x": 1})
+        query = id_range_query(IdRange("id010", "id020"), {"_id": {"$ne": "id012"}})
+        self.assertEqual(len([d for d in self.col.docs.values() if match(query, d)]), 9)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,10 @@
+import os
+import struct
+import tempfile
 import unittest
-from biothings.utils.dataload import merge_struct
+import zlib
+from biothings.utils.common import FileRange, split_file, _bgzf_blocks
+from biothings.utils.dataload import merge_struct, tabfile_feeder, tabfile_typed_feeder
 from biothings.utils.dataload import merge_root_keys
 
 
@@ -44,3 +49,110 @@ class TestDataTransform(unittest.TestCase):
         self.assertEquals(res['unii'][0]['preferred_term'], 'drugnameA')
         self.assertEquals(res['unii'][1]['preferred_term'], 'drugnameB')
 
+
+def write_bgzf(path, data, block_size):
+    """
+    Write data to path as bgzip would, in blocks of
+    block_size uncompressed bytes, followed by the EOF block.
+    """
+    with open(path, "wb") as out_f:
+        for start in list(range(0, len(data), block_size)) + [len(data)]:
+            block = data[start:start + block_size]
+            comp = zlib.compressobj(6, zlib.DEFLATED, -15)
+            cdata = comp.compress(block) + comp.flush()
+            out_f.write(b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00")
+            out_f.write(struct.pack("<H", len(cdata) + 25))
+            out_f.write(cdata)
+            out_f.write(struct.pack("<II", zlib.crc32(block), len(block)))
+
+
+class TestSplitFile(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".tsv")
+        with os.fdopen(fd, "w") as out_f:
+            out_f.write("id\tvalue\n")
+            for i in range(1000):
+                out_f.write("%d\t%s\n" % (i, "x" * (i % 37)))
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_split_file(self):
+        """
+        Test parts are line-aligned and each one starts with the header.
+        """
+        ranges = split_file(self.path, 4, header=1, min_size=1000)
+        self.assertEqual(len(ranges), 4)
+        rows = []
+        for frange in ranges:
+            rows.extend(tabfile_feeder(frange, header=1))
+        self.assertEqual([int(row[0]) for row in rows], list(range(1000)))
+
+    def test_split_file_no_header(self):
+        """
+        Test the first line of each part is data when there's no header.
+        """
+        ranges = split_file(self.path, 4, header=0, min_size=1000)
+        rows = []
+        for frange in ranges:
+            rows.extend(tabfile_feeder(frange, header=0))
+        self.assertEqual(rows[0], ["id", "value"])
+        self.assertEqual([int(row[0]) for row in rows[1:]], list(range(1000)))
+
+    def test_split_bgzf(self):
+        """
+        Test BGZF files are split on line boundaries, within or between blocks.
+        """
+        with open(self.path, "rb") as in_f:
+            data = in_f.read()
+        bgzf = self.path + ".gz"
+        self.addCleanup(os.remove, bgzf)
+        lines = data.splitlines(keepends=True)
+        # lines across blocks, and blocks ending on a line boundary
+        for block_size in (97, 1000, len(lines[0]) + len(lines[1])):
+            write_bgzf(bgzf, data, block_size)
+            blocks = _bgzf_blocks(bgzf)
+            self.assertEqual(sum(block[2] for block in blocks), len(data))
+            ranges = split_file(bgzf, 4, header=1, min_size=500)
+            self.assertTrue(1 < len(ranges) <= 4)
+            self.assertTrue(all(isinstance(frange, FileRange) and frange.compressed
+                                for frange in ranges))
+            self.assertEqual(sum(frange.length for frange in ranges), len(data))
+            rows = []
+            for frange in ranges:
+                with frange.open("rb") as in_f:
+                    part = in_f.read()
+                self.assertTrue(part.startswith(lines[0]))
+                self.assertTrue(part.endswith(b"\n"))
+                rows.extend(tabfile_feeder(frange, header=1))
+            self.assertEqual([int(row[0]) for row in rows], list(range(1000)))
+
+    def test_split_gzip(self):
+        """
+        Test gzip files which aren't BGZF are not split.
+        """
+        import gzip
+        with open(self.path, "rb") as in_f, gzip.open(self.path + ".gz", "wb") as out_f:
+            out_f.write(in_f.read())
+        self.addCleanup(os.remove, self.path + ".gz")
+        self.assertIsNone(_bgzf_blocks(self.path + ".gz"))
+        self.assertEqual(split_file(self.path + ".gz", 4, min_size=100), [self.path + ".gz"])
+
+    def test_split_file_small(self):
+        """
+        Test files smaller than min_size aren't split.
+        """
+        self.assertEqual(split_file(self.path, 4, header=1), [self.path])
+
+    def test_tabfile_typed_feeder(self):
+        """
+        Test values are converted per column and missing ones skipped.
+        """
+        columns = [("_id", str), ("value", None)]
+        docs = list(tabfile_typed_feeder(self.path, columns, as_dict=True))
+        self.assertEqual(docs[0], {"_id": "0"})
+        columns = [("_id", int), ("value", str)]
+        rows = list(tabfile_typed_feeder(self.path, columns, threaded=False))
+        self.assertEqual(rows[0], [0, None])
+        self.assertEqual(rows[998], [998, "x" * (998 % 37)])
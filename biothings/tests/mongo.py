@@ -0,0 +1,441 @@
+"""
+    In-memory stand-ins for pymongo databases and collections, supporting
+    the subset of the API used by hub storages, builders and differs
+    (including legacy bulk operations), so they can be tested without a
+    MongoDB server.
+
+        db = Database("src")
+        db["col"].insert_many([{"_id": 1}, {"_id": 2}])
+        storage = BasicStorage(db, "col")
+"""
+import copy
+from collections import OrderedDict
+
+import bson
+from bson.raw_bson import RawBSONDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+
+def _get(doc, key):
+    for part in key.split("."):
+        if not isinstance(doc, dict) or part not in doc:
+            return None
+        doc = doc[part]
+    return doc
+
+
+def _compare(value, op, arg):
+    if op == "$in":
+        return value in arg
+    if op == "$nin":
+        return value not in arg
+    if op == "$ne":
+        return value != arg
+    if op == "$exists":
+        return (value is not None) == bool(arg)
+    if value is None:
+        return False
+    try:
+        return {
+            "$gt": lambda: value > arg,
+            "$gte": lambda: value >= arg,
+            "$lt": lambda: value < arg,
+            "$lte": lambda: value <= arg,
+        }[op]()
+    except TypeError:
+        # mixed types, never matching
+        return False
+
+
+def match(query, doc):
+    """Return True if doc matches query (equality and common operators)"""
+    for key, cond in (query or {}).items():
+        if key == "$and":
+            if not all(match(q, doc) for q in cond):
+                return False
+        elif key == "$or":
+            if not any(match(q, doc) for q in cond):
+                return False
+        elif isinstance(cond, dict) and cond and all(k.startswith("$") for k in cond):
+            value = _get(doc, key)
+            if not all(_compare(value, op, arg) for op, arg in cond.items()):
+                return False
+        elif _get(doc, key) != cond:
+            return False
+    return True
+
+
+def project(doc, projection):
+    if not projection:
+        return copy.deepcopy(doc)
+    if isinstance(projection, (list, tuple)):
+        projection = {k: 1 for k in projection}
+    res = {"_id": doc["_id"]} if projection.get("_id", 1) else {}
+    for key, keep in projection.items():
+        if keep and key != "_id" and key in doc:
+            res[key] = copy.deepcopy(doc[key])
+    return res
+
+
+def sort_key(value):
+    # mongo sorts numbers before strings
+    return (isinstance(value, str), value)
+
+
+class Cursor(object):
+
+    def __init__(self, docs):
+        self.docs = list(docs)
+        self._iter = None
+
+    def sort(self, key, direction=1):
+        keys = key if isinstance(key, list) else [(key, direction)]
+        for field, direc in reversed(keys):
+            self.docs.sort(key=lambda d: sort_key(_get(d, field)), reverse=direc < 0)
+        return self
+
+    def skip(self, num):
+        self.docs = self.docs[num:]
+        return self
+
+    def limit(self, num):
+        if num:
+            self.docs = self.docs[:num]
+        return self
+
+    def batch_size(self, num):
+        return self
+
+    def count(self, *args, **kwargs):
+        return len(self.docs)
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._iter is None:
+            self._iter = iter(self.docs)
+        return next(self._iter)
+
+    def __getitem__(self, idx):
+        return self.docs[idx]
+
+
+class BulkOperation(object):
+    """Legacy bulk API (initialize_unordered_bulk_op())"""
+
+    def __init__(self, collection, ordered=False):
+        self.collection = collection
+        self.ordered = ordered
+        self.ops = []
+
+    def insert(self, doc):
+        self.ops.append(("insert", doc))
+
+    def find(self, query):
+        bulk = self
+
+        class Selector(object):
+            upserting = False
+
+            def upsert(self):
+                self.upserting = True
+                return self
+
+            def update_one(self, update):
+                bulk.ops.append(("update", query, update, self.upserting))
+
+            # documents are selected by _id, one at most
+            update = update_one
+
+            def replace_one(self, doc):
+                bulk.ops.append(("replace", query, doc, self.upserting))
+
+            def remove(self):
+                bulk.ops.append(("remove", query))
+
+            remove_one = remove
+
+        return Selector()
+
+    def execute(self):
+        col = self.collection
+        res = {"nInserted": 0, "nUpserted": 0, "nMatched": 0, "nModified": 0,
+               "nRemoved": 0, "writeErrors": []}
+        for idx, op in enumerate(self.ops):
+            if op[0] == "insert":
+                try:
+                    col.insert_one(op[1])
+                    res["nInserted"] += 1
+                except DuplicateKeyError:
+                    res["writeErrors"].append({"index": idx, "code": 11000, "op": op[1]})
+                    if self.ordered:
+                        break
+            elif op[0] == "remove":
+                res["nRemoved"] += col.delete_many(op[1]).deleted_count
+            else:
+                kind, query, arg, upsert = op
+                if kind == "update":
+                    r = col.update_one(query, arg, upsert=upsert)
+                else:
+                    r = col.replace_one(query, arg, upsert=upsert)
+                res["nMatched"] += r.modified_count
+                res["nModified"] += r.modified_count
+                res["nUpserted"] += r.upserted_id is not None
+        col.bulk_executions += 1
+        if res["writeErrors"]:
+            raise BulkWriteError(res)
+        return res
+
+
+class Result(object):
+
+    def __init__(self, **kwargs):
+        self.modified_count = 0
+        self.deleted_count = 0
+        self.upserted_id = None
+        self.inserted_ids = []
+        self.__dict__.update(kwargs)
+
+
+def apply_update(doc, update, inserted=False):
+    for op, fields in update.items():
+        if op == "$setOnInsert":
+            if inserted:
+                apply_update(doc, {"$set": fields})
+            continue
+        for key, value in fields.items():
+            parts = key.split(".")
+            target = doc
+            for part in parts[:-1]:
+                target = target.setdefault(part, {})
+            if op == "$set":
+                target[parts[-1]] = copy.deepcopy(value)
+            elif op == "$unset":
+                target.pop(parts[-1], None)
+            elif op == "$inc":
+                target[parts[-1]] = target.get(parts[-1], 0) + value
+            elif op == "$push":
+                target.setdefault(parts[-1], []).append(copy.deepcopy(value))
+            elif op == "$addToSet":
+                values = target.setdefault(parts[-1], [])
+                if value not in values:
+                    values.append(copy.deepcopy(value))
+            else:
+                raise NotImplementedError(op)
+
+
+class Collection(object):
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.docs = OrderedDict()
+        self.indexes = []
+        self.bulk_executions = 0
+
+    def __repr__(self):
+        return "<Collection %s.%s>" % (self.database.name, self.name)
+
+    def __bool__(self):
+        # pymongo collections can't be tested, code relies on them being true
+        return True
+
+    def _decode(self, doc):
+        if isinstance(doc, RawBSONDocument):
+            return bson.decode(doc.raw)
+        return copy.deepcopy(dict(doc))
+
+    # read
+    def find(self, filter=None, projection=None, *args, **kwargs):
+        projection = projection or kwargs.get("projection") or kwargs.get("fields")
+        return Cursor(project(d, projection) for d in self.docs.values() if match(filter, d))
+
+    def find_one(self, filter=None, projection=None, sort=None, **kwargs):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {"_id": filter}
+        cur = self.find(filter, projection)
+        if sort:
+            cur.sort(sort)
+        return next(cur, None)
+
+    def count(self, filter=None, **kwargs):
+        return len([d for d in self.docs.values() if match(filter, d)])
+
+    count_documents = count
+
+    def estimated_document_count(self):
+        return len(self.docs)
+
+    def distinct(self, key, filter=None):
+        return sorted({_get(d, key) for d in self.docs.values() if match(filter, d)},
+                      key=sort_key)
+
+    def aggregate(self, pipeline, **kwargs):
+        docs = [copy.deepcopy(d) for d in self.docs.values()]
+        for stage in pipeline:
+            (op, arg), = stage.items()
+            if op == "$match":
+                docs = [d for d in docs if match(arg, d)]
+            elif op == "$group":
+                groups = OrderedDict()
+                key = arg["_id"]
+                for d in docs:
+                    value = _get(d, key[1:]) if isinstance(key, str) else key
+                    group = groups.setdefault(value, {"_id": value})
+                    for field, acc in arg.items():
+                        if field == "_id":
+                            continue
+                        (aop, aval), = acc.items()
+                        assert aop == "$sum"
+                        inc = _get(d, aval[1:]) if isinstance(aval, str) else aval
+                        group[field] = group.get(field, 0) + inc
+                docs = list(groups.values())
+            elif op == "$out":
+                out = self.database[arg]
+                out.docs = OrderedDict((d["_id"], d) for d in docs)
+                docs = []
+            else:
+                raise NotImplementedError(op)
+        return Cursor(docs)
+
+    # write
+    def insert_one(self, doc, **kwargs):
+        doc = self._decode(doc)
+        if "_id" not in doc:
+            doc["_id"] = bson.ObjectId()
+        if doc["_id"] in self.docs:
+            raise DuplicateKeyError("E11000 duplicate key: %s" % repr(doc["_id"]))
+        self.docs[doc["_id"]] = doc
+        return Result(inserted_id=doc["_id"])
+
+    def insert_many(self, docs, ordered=True, **kwargs):
+        errors = []
+        inserted = []
+        for idx, doc in enumerate(docs):
+            try:
+                inserted.append(self.insert_one(doc).inserted_id)
+            except DuplicateKeyError:
+                errors.append({"index": idx, "code": 11000, "op": doc})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({"nInserted": len(inserted), "writeErrors": errors})
+        return Result(inserted_ids=inserted)
+
+    def insert(self, doc_or_docs, manipulate=True, check_keys=True, **kwargs):
+        if isinstance(doc_or_docs, list):
+            for doc in doc_or_docs:
+                self.insert_one(doc)
+        else:
+            self.insert_one(doc_or_docs)
+
+    def save(self, doc):
+        self.replace_one({"_id": doc["_id"]}, doc, upsert=True)
+
+    def replace_one(self, filter, doc, upsert=False, **kwargs):
+        doc = self._decode(doc)
+        found = next((d for d in self.docs.values() if match(filter, d)), None)
+        if found is None:
+            if not upsert:
+                return Result()
+            doc.setdefault("_id", filter.get("_id", bson.ObjectId()))
+            self.docs[doc["_id"]] = doc
+            return Result(upserted_id=doc["_id"])
+        doc["_id"] = found["_id"]
+        self.docs[found["_id"]] = doc
+        return Result(modified_count=1)
+
+    def update_one(self, filter, update, upsert=False, **kwargs):
+        found = next((d for d in self.docs.values() if match(filter, d)), None)
+        if found is None:
+            if not upsert:
+                return Result()
+            found = {k: v for k, v in filter.items() if not k.startswith("$")}
+            found.setdefault("_id", bson.ObjectId())
+            apply_update(found, update, inserted=True)
+            self.docs[found["_id"]] = found
+            return Result(upserted_id=found["_id"])
+        apply_update(found, update)
+        return Result(modified_count=1)
+
+    def update_many(self, filter, update, upsert=False, **kwargs):
+        found = [d for d in self.docs.values() if match(filter, d)]
+        for doc in found:
+            apply_update(doc, update)
+        return Result(modified_count=len(found))
+
+    def update(self, filter, update, upsert=False, multi=False, **kwargs):
+        if multi:
+            return self.update_many(filter, update)
+        return self.update_one(filter, update, upsert=upsert)
+
+    def delete_many(self, filter):
+        ids = [_id for _id, d in self.docs.items() if match(filter, d)]
+        for _id in ids:
+            del self.docs[_id]
+        return Result(deleted_count=len(ids))
+
+    def delete_one(self, filter):
+        _id = next((_id for _id, d in self.docs.items() if match(filter, d)), None)
+        if _id is not None:
+            del self.docs[_id]
+        return Result(deleted_count=int(_id is not None))
+
+    def remove(self, filter=None, **kwargs):
+        return self.delete_many(filter)
+
+    def initialize_unordered_bulk_op(self):
+        return BulkOperation(self)
+
+    def initialize_ordered_bulk_op(self):
+        return BulkOperation(self, ordered=True)
+
+    # admin
+    def with_options(self, **kwargs):
+        return self
+
+    def create_index(self, keys, **kwargs):
+        self.indexes.append(keys)
+
+    def create_indexes(self, indexes):
+        self.indexes.extend(indexes)
+
+    def drop(self):
+        self.docs = OrderedDict()
+        self.indexes = []
+
+    def rename(self, new_name, dropTarget=False):
+        if new_name in self.database.collection_names() and not dropTarget:
+            raise OperationFailure("target namespace exists")
+        self.database.collections.pop(self.name, None)
+        self.name = new_name
+        self.database.collections[new_name] = self
+
+
+class Database(object):
+    """
+    Collections are created when accessed, and listed once they
+    hold documents (or were renamed/created by $out)
+    """
+
+    def __init__(self, name="test"):
+        self.name = name
+        self.collections = {}
+        self.client = None
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = Collection(self, name)
+        return self.collections[name]
+
+    def collection_names(self, *args, **kwargs):
+        return sorted(name for name, col in self.collections.items() if col.docs)
+
+    list_collection_names = collection_names
+
+    def command(self, *args, **kwargs):
+        raise OperationFailure("command %s not supported" % repr(args[:1]))
@@ -23,6 +23,9 @@ import inspect
 import types
 import gzip
 import glob
+import struct
+import queue
+import threading
 from datetime import date, datetime, timezone
 from functools import partial
 # from json serial, catching special type
@@ -156,6 +159,8 @@ def anyfile(infile, mode='r'):
     e.g., ('a.zip', 'aa.txt')
 
     '''
+    if isinstance(infile, FileRange):
+        return infile.open(mode)
     if isinstance(infile, tuple):
         infile, rawfile = infile[:2]
     else:
@@ -174,6 +179,167 @@ def anyfile(infile, mode='r'):
         in_f = open(infile, mode)
     return in_f
 
+class FileRange(object):
+    '''
+    A line-aligned part of a flat file, as returned by split_file().
+    Accepted by anyfile()/open_anyfile() (so by tabfile_feeder too)
+    like a file name: reading it yields the file's header lines, if
+    any, followed by the lines of the range.
+    length bytes are read from offset, or for a BGZF compressed file,
+    from the block at offset after skipping skip decompressed bytes.
+    '''
+
+    def __init__(self, path, offset, length, skip=0, header=0, compressed=False):
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.skip = skip
+        self.header = header
+        self.compressed = compressed
+
+    def __repr__(self):
+        return "<FileRange %s offset=%s skip=%s length=%s>" % \
+            (self.path, self.offset, self.skip, self.length)
+
+    def open(self, mode='r'):
+        reader = io.BufferedReader(_FileRangeReader(self))
+        if 'b' in mode:
+            return reader
+        return io.TextIOWrapper(reader)
+
+
+class _FileRangeReader(io.RawIOBase):
+
+    def __init__(self, frange):
+        self._range = frange
+        self._file = open(frange.path, 'rb')
+        self._pending = b''
+        if frange.header and (frange.offset or frange.skip):
+            self._pending = b''.join(islice(self._open_stream(0), frange.header))
+        self._stream = self._open_stream(frange.offset)
+        skip = frange.skip
+        while skip:
+            skip -= len(self._stream.read(min(skip, 2 ** 20)))
+        self._remaining = frange.length
+
+    def _open_stream(self, offset):
+        self._file.seek(offset)
+        if self._range.compressed:
+            return gzip.GzipFile(fileobj=self._file)
+        return self._file
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        if self._pending:
+            n = min(len(buf), len(self._pending))
+            buf[:n], self._pending = self._pending[:n], self._pending[n:]
+            return n
+        data = self._stream.read(min(len(buf), self._remaining))
+        self._remaining -= len(data)
+        buf[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+
+def split_file(path, parts, header=0, min_size=2 ** 24):
+    '''
+    Split flat file path into at most parts FileRange, aligned on line
+    boundaries and at least min_size bytes long. Each range repeats the
+    first header lines of the file. Only uncompressed and BGZF compressed
+    (bgzip) files can be split, others are returned as a single element
+    list [path], as are files too small to be split.
+    '''
+    size = os.path.getsize(path)
+    parts = max(1, min(parts, size // min_size))
+    if parts == 1:
+        return [path]
+    blocks = _bgzf_blocks(path)
+    if blocks:
+        return _split_bgzf(path, blocks, parts, header)
+    if os.path.splitext(path)[1].lower() in ('.gz', '.zip', '.xz', '.bz2'):
+        return [path]
+    bounds = [0]
+    with open(path, 'rb') as in_f:
+        for i in range(1, parts):
+            # the line containing the byte before the split point ends the range
+            in_f.seek(size * i // parts - 1)
+            in_f.readline()
+            pos = in_f.tell()
+            if bounds[-1] < pos < size:
+                bounds.append(pos)
+    bounds.append(size)
+    return [FileRange(path, start, end - start, header=header)
+            for start, end in zip(bounds, bounds[1:])]
+
+
+def _bgzf_blocks(path):
+    '''Return the list of (offset, size, uncompressed size) of each
+    block of BGZF file path, or None if it's not a BGZF file.'''
+    blocks = []
+    with open(path, 'rb') as in_f:
+        offset = 0
+        while True:
+            head = in_f.read(18)
+            if not head:
+                return blocks
+            # gzip member with an extra "BC" subfield holding the block size
+            if len(head) < 18 or head[:4] != b'\x1f\x8b\x08\x04' or head[12:16] != b'BC\x02\x00':
+                return None
+            bsize = struct.unpack('<H', head[16:18])[0] + 1
+            in_f.seek(offset + bsize - 4)
+            isize = struct.unpack('<I', in_f.read(4))[0]
+            blocks.append((offset, bsize, isize))
+            offset += bsize
+            in_f.seek(offset)
+
+
+def _split_bgzf(path, blocks, parts, header):
+    csize = blocks[-1][0] + blocks[-1][1]
+    starts = [0]  # decompressed position of each block
+    for _, _, isize in blocks:
+        starts.append(starts[-1] + isize)
+
+    def block_data(idx):
+        offset, bsize, _ = blocks[idx]
+        in_f.seek(offset)
+        return gzip.decompress(in_f.read(bsize))
+
+    bounds = [(0, 0)]  # (block index, offset in decompressed block)
+    with open(path, 'rb') as in_f:
+        idx = 0
+        for i in range(1, parts):
+            while idx < len(blocks) and blocks[idx][0] < csize * i // parts:
+                idx += 1
+            if idx == len(blocks) or idx <= bounds[-1][0]:
+                continue
+            if block_data(idx - 1).endswith(b'\n'):
+                bounds.append((idx, 0))
+                continue
+            for cur in range(idx, len(blocks)):
+                pos = block_data(cur).find(b'\n')
+                if pos != -1:
+                    if pos + 1 == blocks[cur][2]:
+                        bounds.append((cur + 1, 0))
+                    else:
+                        bounds.append((cur, pos + 1))
+                    break
+    bounds.append((len(blocks), 0))
+
+    ranges = []
+    for (sidx, sskip), (eidx, eskip) in zip(bounds, bounds[1:]):
+        length = starts[eidx] + eskip - starts[sidx] - sskip
+        if length:
+            ranges.append(FileRange(path, blocks[sidx][0], length, skip=sskip,
+                                    header=header, compressed=True))
+    return ranges
+
+
 def is_filehandle(fh):
     '''return True/False if fh is a file-like object'''
     return hasattr(fh, 'read') and hasattr(fh, 'close')
@@ -328,6 +494,69 @@ def open_compressed_file(filename):
     return fobj
 
 
+class ThreadedReader(io.RawIOBase):
+    '''
+    Read binary file object fobj ahead in a separate thread, so reading
+    (typically decompressing, which releases the GIL) overlaps with
+    processing the data read. At most buffers chunks of chunk_size bytes
+    are read in advance. Closing the reader closes fobj.
+
+        with io.BufferedReader(ThreadedReader(open_compressed_file(f))) as in_f:
+            for line in in_f:
+                ...
+    '''
+
+    def __init__(self, fobj, chunk_size=2 ** 20, buffers=8):
+        self._fobj = fobj
+        self._chunks = queue.Queue(maxsize=buffers)
+        self._stop = threading.Event()
+        self._chunk = memoryview(b'')
+        self._eof = False
+        self._thread = threading.Thread(target=self._read_ahead, args=(chunk_size,),
+                                        daemon=True)
+        self._thread.start()
+
+    def _read_ahead(self, chunk_size):
+        try:
+            while not self._stop.is_set():
+                chunk = self._fobj.read(chunk_size)
+                self._put(chunk)
+                if not chunk:
+                    return
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        if not self._chunk and not self._eof:
+            chunk = self._chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            self._eof = not chunk
+            self._chunk = memoryview(chunk)
+        size = min(len(buf), len(self._chunk))
+        buf[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+            self._fobj.close()
+        super().close()
+
+
 def dump(obj, filename, protocol=2, compress='gzip'):
     '''Saves a compressed object to disk
        binary protocol 2 is compatible with py2, 3 and 4 are for py3
@@ -4,8 +4,9 @@ from functools import wraps
 from pymongo import MongoClient, DESCENDING
 from pymongo.collection import Collection
 from functools import partial
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 import bson
+from pymongo.errors import OperationFailure
 
 from biothings.utils.common import timesofar, get_random_string, iter_n, \
                                    open_compressed_file, get_compressed_outfile, \
@@ -253,6 +254,121 @@ def doc_feeder(collection, step=1000, s=None, e=None, inbatch=False, query=None,
         cur.close()
 
 
+def id_sort_key(_id):
+    """
+    Key sorting _ids the way MongoDB does (values are compared within the
+    same BSON type, types are sorted numbers < strings < objects < ...),
+    so cursors sorted on _id can be merged together (see heapq.merge)
+    """
+    if _id is None:
+        return (1, 0)
+    if isinstance(_id, bool):
+        return (8, _id)
+    if isinstance(_id, (int, float)):
+        return (2, _id)
+    if isinstance(_id, str):
+        return (3, _id)
+    if isinstance(_id, bson.ObjectId):
+        return (7, _id)
+    if isinstance(_id, datetime.datetime):
+        return (9, _id)
+    return (4, repr(_id))
+
+
+# _id range, min included, max excluded, None meaning unbounded
+IdRange = namedtuple("IdRange", ["min", "max"])
+
+
+def get_split_points(col, parts):
+    """
+    Return at most parts - 1 sorted _ids splitting collection "col" in
+    parts of about the same size. The splitVector command is used if
+    allowed (it reads the _id index), otherwise _ids are picked
+    while reading all _ids once, in order (slower).
+    """
+    total = col.count()
+    if parts < 2 or total < parts:
+        return []
+    try:
+        stats = col.database.command("collstats", col.name)
+        res = col.database.command(
+            "splitVector", "%s.%s" % (col.database.name, col.name),
+            keyPattern={"_id": 1},
+            maxChunkSizeBytes=max(1, stats["size"] // parts))
+        keys = [k["_id"] for k in res["splitKeys"]]
+        # splitVector returns chunks of at most maxChunkSizeBytes, more
+        # than needed, keep the keys ending evenly spaced chunks
+        # (len(keys) + 1 chunks)
+        idxs = sorted({max(0, (len(keys) + 1) * i // parts - 1) for i in range(1, parts)})
+        return [keys[idx] for idx in idxs] if keys else []
+    except OperationFailure as e:
+        logging.debug("Can't use splitVector on '%s' (%s), sampling _ids" % (col.name, e))
+    positions = [total * i // parts for i in range(1, parts)]
+    points = []
+    cur = col.find({}, {"_id": 1}).sort("_id", 1).batch_size(10000)
+    try:
+        for pos, doc in enumerate(cur):
+            if pos == positions[len(points)]:
+                points.append(doc["_id"])
+                if len(points) == len(positions):
+                    break
+    finally:
+        cur.close()
+    return points
+
+
+def get_id_ranges(cols, parts):
+    """
+    Split the _ids of collections "cols" into at most "parts" ranges,
+    as IdRange(min, max) tuples, usable with id_range_query().
+    Boundaries are split points of the largest collection (see
+    get_split_points()). Ranges are only computed for string _ids
+    (Mongo compares values of the same type only), otherwise one range
+    covering everything is returned, callers should then fall back to
+    lists of _ids if they need several parts.
+    """
+    cols = [c.target_collection if isinstance(c, DocMongoBackend) else c for c in cols]
+    for col in cols:
+        for direction in (1, -1):
+            doc = col.find_one({}, {"_id": 1}, sort=[("_id", direction)])
+            if doc and not isinstance(doc["_id"], str):
+                return [IdRange(None, None)]
+    largest = max(cols, key=lambda c: c.count())
+    bounds = []
+    for point in get_split_points(largest, parts):
+        if not bounds or point > bounds[-1]:
+            bounds.append(point)
+    bounds = [None] + bounds + [None]
+    return [IdRange(lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+
+def ids_query(ids):
+    """
+    Return a query selecting documents from a list of _ids, or from
+    an IdRange (see get_id_ranges())
+    """
+    if isinstance(ids, IdRange):
+        return id_range_query(ids)
+    return {"_id": {"$in": ids}}
+
+
+def id_range_query(id_range, query=None):
+    """
+    Return a query selecting _ids within id_range (min, max), see
+    get_id_ranges(), and matching optional "query"
+    """
+    lo, hi = id_range
+    cond = {}
+    if lo is not None:
+        cond["$gte"] = lo
+    if hi is not None:
+        cond["$lt"] = hi
+    rquery = cond and {"_id": cond} or {}
+    if query and rquery:
+        return {"$and": [query, rquery]}
+    return query or rquery
+
+
 def get_cache_filename(col_name):
     cache_folder = getattr(config,"CACHE_FOLDER",None)
     if not cache_folder:
@@ -0,0 +1,226 @@
+"""
+    Caches for the web query pipeline.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    A least-recently-used cache with optional expiration.
+
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache.get('a') -> 1
+        cache['c'] = 3      # evicts 'b'
+        cache.get('b') -> None
+
+    maxsize: maximum number of entries, non-positive disables the cache.
+    ttl: seconds an entry stays valid, None for no expiration.
+    """
+
+    def __init__(self, maxsize=128, ttl=None):
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expire, value)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __setitem__(self, key, value):
+
+        if self.maxsize <= 0:
+            return
+
+        expire = time.monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (expire, value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get(self, key, default=None):
+
+        try:
+            expire, value = self._data[key]
+        except KeyError:
+            return default
+
+        if expire is not None and expire < time.monotonic():
+            del self._data[key]
+            return default
+
+        self._data.move_to_end(key)
+        return value
+
+    def get_many(self, keys):
+        """
+        Return a dict of the entries found for keys.
+        """
+        found = {}
+        for key in keys:
+            value = self.get(key, self)
+            if value is not self:
+                found[key] = value
+        return found
+
+    def set_many(self, entries):
+        for key, value in entries.items():
+            self[key] = value
+
+    def pop(self, key, default=None):
+
+        value = self.get(key, default)
+        self._data.pop(key, None)
+        return value
+
+    def clear(self):
+        self._data.clear()
+
+
+class SQLiteCache:
+    """
+    A cache kept in a local sqlite database file. Processes on
+    the same host opening the same file share the cache entries,
+    for example the forked workers of a web server.
+
+    Keys and values are strings. When more than maxsize entries
+    are stored, the earliest stored entries are evicted first.
+    Errors accessing the file are logged and treated as misses.
+
+    Calls block on file access, run them in an executor from
+    an event loop, get_many() and set_many() batch entries.
+    """
+    BLOCKING = True
+    PRUNE_INTERVAL = 1000  # writes
+    BATCH_SIZE = 500  # keys per statement
+
+    def __init__(self, path='cache.sqlite3', maxsize=100000, ttl=None):
+
+        self.path = os.path.abspath(path)
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.logger = logging.getLogger(__name__)
+
+        self._conn = None
+        self._pid = None  # connections are not shared across forks
+        self._lock = threading.RLock()  # but are across threads
+        self._writes = 0
+
+    @property
+    def conn(self):
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(
+                self.path, timeout=1, isolation_level=None,
+                check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(key TEXT PRIMARY KEY, expire REAL, value TEXT)")
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __setitem__(self, key, value):
+        self.set_many({key: value})
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys):
+        """
+        Return a dict of the entries found for keys.
+        """
+        keys = list(keys)
+        rows = []
+        try:
+            with self._lock:
+                for start in range(0, len(keys), self.BATCH_SIZE):
+                    batch = keys[start:start + self.BATCH_SIZE]
+                    rows.extend(self.conn.execute(
+                        "SELECT key, expire, value FROM cache WHERE key IN (%s)"
+                        % ", ".join("?" * len(batch)), batch).fetchall())
+        except sqlite3.Error:
+            self.logger.exception("Error reading from cache %s.", self.path)
+            return {}
+
+        now = time.time()
+        expired = [row[0] for row in rows if row[1] is not None and row[1] < now]
+        if expired:
+            self._delete(expired)
+        return {row[0]: row[2] for row in rows if row[0] not in expired}
+
+    def set_many(self, entries):
+
+        if self.maxsize <= 0 or not entries:
+            return
+
+        expire = time.time() + self.ttl if self.ttl else None
+        try:
+            with self._lock:
+                conn = self.conn
+                conn.execute("BEGIN")
+                try:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+                        ((key, expire, value) for key, value in entries.items()))
+                except sqlite3.Error:
+                    conn.execute("ROLLBACK")
+                    raise
+                conn.execute("COMMIT")
+                writes = self._writes
+                self._writes += len(entries)
+        except sqlite3.Error:
+            self.logger.exception("Error writing to cache %s.", self.path)
+        else:
+            if writes // self.PRUNE_INTERVAL != self._writes // self.PRUNE_INTERVAL:
+                self.prune()
+
+    def pop(self, key, default=None):
+
+        value = self.get(key, default)
+        self._delete([key])
+        return value
+
+    def _delete(self, keys):
+        try:
+            with self._lock:
+                self.conn.executemany(
+                    "DELETE FROM cache WHERE key = ?", ((key,) for key in keys))
+        except sqlite3.Error:
+            self.logger.exception("Error writing to cache %s.", self.path)
+
+    def prune(self):
+        """
+        Remove the expired entries and the earliest entries over maxsize.
+        """
+        try:
+            with self._lock:
+                self.conn.execute("DELETE FROM cache WHERE expire < ?", (time.time(),))
+                count = self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+                if count > self.maxsize:
+                    self.conn.execute(
+                        "DELETE FROM cache WHERE rowid IN "
+                        "(SELECT rowid FROM cache ORDER BY rowid LIMIT ?)",
+                        (count - self.maxsize,))
+        except sqlite3.Error:
+            self.logger.exception("Error pruning cache %s.", self.path)
+
+    def clear(self):
+        try:
+            with self._lock:
+                self.conn.execute("DELETE FROM cache")
+        except sqlite3.Error:
+            self.logger.exception("Error clearing cache %s.", self.path)
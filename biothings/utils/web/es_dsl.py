@@ -1,6 +1,8 @@
 """
     Override of elasticsearch-dsl modules to support async operations.
 """
+import copy
+import json
 
 from elasticsearch import NotFoundError, RequestError, TransportError
 from elasticsearch_dsl import A, MultiSearch, Q, Search
@@ -9,6 +11,45 @@ from elasticsearch_dsl.response import Response
 
 
 class AsyncMultiSearch(MultiSearch):
+    """
+    Identical searches, for example repeated terms in a batch query,
+    are sent to elasticsearch once. Their responses are copied back to
+    every position, so the results are the same as sending all of them.
+    """
+
+    def _unique_searches(self):
+        """
+        Return the header and body pairs of the unique searches,
+        and the position of the unique search for every search.
+        """
+        lines, positions, seen = [], [], {}
+        for s in self._searches:
+            meta = {}
+            if s._index:
+                meta['index'] = s._index
+            meta.update(s._params)
+            body = s.to_dict()
+            key = json.dumps((meta, body), sort_keys=True, default=str)
+            if key not in seen:
+                seen[key] = len(seen)
+                lines.append(meta)
+                lines.append(body)
+            positions.append(seen[key])
+        return lines, positions
+
+    @staticmethod
+    def _expand_responses(responses, positions):
+        """
+        Return the responses in the order of every search.
+        """
+        out, used = [], set()
+        for pos in positions:
+            r = responses[pos]
+            if pos in used:  # results are modified in place later
+                r = copy.deepcopy(r)
+            used.add(pos)
+            out.append(r)
+        return out
 
     async def execute(self, ignore_cache=False, raise_on_error=True):
         """
@@ -16,15 +57,18 @@ class AsyncMultiSearch(MultiSearch):
         """
         if ignore_cache or not hasattr(self, '_response'):
             es = get_connection(self._using)
+            lines, positions = self._unique_searches()
 
             responses = await es.msearch(
                 index=self._index,
-                body=self.to_dict(),
+                body=lines,
                 **self._params
             )
+            responses = self._expand_responses(
+                responses['responses'], positions)
 
             out = []
-            for s, r in zip(self._searches, responses['responses']):
+            for s, r in zip(self._searches, responses):
                 if r.get('error', False):
                     if raise_on_error:
                         raise TransportError('N/A', r['error']['type'], r['error'])
@@ -37,6 +81,34 @@ class AsyncMultiSearch(MultiSearch):
 
         return self._response
 
+    async def execute_raw(self, raise_on_error=True):
+        """
+        Execute the multi search request and return a list of the
+        decoded responses, without wrapping them in ``Response`` objects.
+        The request body is serialized directly into NDJSON.
+        """
+        es = get_connection(self._using)
+        dumps = es.transport.serializer.dumps
+        lines, positions = self._unique_searches()
+
+        responses = await es.msearch(
+            index=self._index,
+            body='\n'.join(map(dumps, lines)) + '\n',
+            **self._params
+        )
+        responses = self._expand_responses(
+            responses['responses'], positions)
+
+        out = []
+        for r in responses:
+            if r.get('error', False):
+                if raise_on_error:
+                    raise TransportError('N/A', r['error']['type'], r['error'])
+                r = None
+            out.append(r)
+
+        return out
+
 class AsyncSearch(Search):
 
     async def execute(self, ignore_cache=False):
@@ -59,3 +131,16 @@ class AsyncSearch(Search):
                 )
             )
         return self._response
+
+    async def execute_raw(self):
+        """
+        Execute the search and return the decoded response
+        as it is, without wrapping it in a ``Response`` object.
+        """
+        es = get_connection(self._using)
+
+        return await es.search(
+            index=self._index,
+            body=self.to_dict(),
+            **self._params
+        )
@@ -49,17 +49,26 @@
 
     4. explicitly specify None or '' to use default.
 
+    When started with start(), the server warms up before it
+    reports available on /status: connections to elasticsearch
+    are opened, index metadata is loaded, and the requests
+    listed in the WARMUP_QUERIES setting are sent to itself.
+    When using get_server(), call warmup() after listening,
+    otherwise /status does not wait for warm-up requests.
+
     See below for additional configurations like
     using an external asyncio event loop.
 """
 
 import logging
 
+import tornado.httpclient
 import tornado.httpserver
 import tornado.ioloop
 import tornado.web
 
 from biothings import get_version
+from biothings.web.handlers.api import WARMUP_HEADER
 from biothings.web.settings import BiothingESWebSettings
 
 
@@ -130,6 +139,34 @@ class BiothingsAPI():
         server = tornado.httpserver.HTTPServer(webapp, xheaders=True)
         return server
 
+    async def warmup(self, port):
+        """
+        Replay the WARMUP_QUERIES of each web settings against
+        the server listening on port, then report it ready.
+        Failed requests are logged and do not prevent it.
+        """
+        logger = logging.getLogger('biothings.web')
+        client = tornado.httpclient.AsyncHTTPClient()
+
+        configs = [self.config] + self.config.children
+        for config in configs:
+            if config.WARMUP_QUERIES:
+                config.ready.clear()
+
+        for config in configs:
+            await config.initialized.wait()
+            for path in config.WARMUP_QUERIES:
+                url = f'http://{self.host or "127.0.0.1"}:{port}{path}'
+                try:
+                    res = await client.fetch(url, raise_error=False,
+                                             headers={WARMUP_HEADER: '1'})
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception('Warm-up request %s failed.', path)
+                else:
+                    logger.info('Warm-up request %s: %s (%.3fs)',
+                                path, res.code, res.request_time)
+            config.ready.set()
+
     def start(self, port=8000):
         """
         Run API in the default event loop.
@@ -144,6 +181,7 @@ class BiothingsAPI():
                     self.host or '0.0.0.0', port)
 
         loop = tornado.ioloop.IOLoop.instance()
+        loop.add_callback(self.warmup, port)
         loop.start()
 
 
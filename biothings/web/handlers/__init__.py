@@ -105,6 +105,16 @@ class StatusHandler(BaseHandler):
         status = None  # green, red, yellow
         res = None  # additional doc check
 
+        # while warm-up requests are replayed
+        if not self.web_settings.ready.is_set():
+            self.set_status(503)
+            return {
+                "code": self.get_status(),
+                "status": "initializing",
+                "payload": payload,
+                "response": res
+            }
+
         try:
             health = await client.cluster.health()
             status = health['status']
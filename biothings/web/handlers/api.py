@@ -15,13 +15,16 @@ Biothings Web API Handlers
 """
 
 import datetime
+import functools
+import importlib
 import json
+import os
 from collections import OrderedDict
 from pprint import pformat
 from urllib.parse import (parse_qs, unquote_plus, urlencode, urlparse,
                           urlunparse)
 
-from tornado.escape import json_decode
+from tornado.escape import json_decode, json_encode, utf8
 from tornado.web import HTTPError
 
 from biothings.utils.common import DateTimeJSONEncoder
@@ -32,32 +35,32 @@ from biothings.web.options import OptionArgError
 from . import BaseHandler
 from .exceptions import BadRequest
 
-try:
-    import msgpack
-
-    def msgpack_encode_datetime(obj):
-        if isinstance(obj, datetime.datetime):
-            return {'__datetime__': True,
-                    'as_str': obj.strftime("%Y%m%dT%H:%M:%S.%f")}
-        return obj
-except ImportError:
-    SUPPORT_MSGPACK = False
-else:
-    SUPPORT_MSGPACK = True
-
-
-try:
-    import yaml
-except ImportError:
-    SUPPORT_YAML = False
-else:
-    SUPPORT_YAML = True
+def msgpack_encode_datetime(obj):
+    if isinstance(obj, datetime.datetime):
+        return {'__datetime__': True,
+                'as_str': obj.strftime("%Y%m%dT%H:%M:%S.%f")}
+    return obj
+
+@functools.lru_cache()
+def import_formatter(name):
+    """
+    Import an optional output format dependency upon first use,
+    like 'yaml' or 'msgpack'. Return None if it is not installed.
+    """
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
 
 __all__ = [
     'BaseAPIHandler',
     'APISpecificationHandler'
 ]
 
+# sent with the requests replaying WARMUP_QUERIES,
+# which are not reported to analytics.
+WARMUP_HEADER = 'X-Biothings-Warmup'
+
 class BaseAPIHandler(BaseHandler, GAMixIn, StandaloneTrackingMixin):
 
     name = ''
@@ -66,10 +69,16 @@ class BaseAPIHandler(BaseHandler, GAMixIn, StandaloneTrackingMixin):
     kwarg_methods = ()
     format = 'json'
 
+    # cProfile measures the whole process,
+    # one request is profiled at a time.
+    _profiling = False
+
     def initialize(self):
 
         self.args = {}  # processed args will be available here
         self.args_json = {}  # applicatoin/json type body
+        self.profiler = None  # when profiling is requested
+        self.bytes_written = 0  # response body, before compression
         self.event = {
             'category': '{}_api'.format(self.web_settings.API_VERSION),
             'action': self.request.method,  # 'query_get', 'fetch_all', etc.
@@ -89,6 +98,8 @@ class BaseAPIHandler(BaseHandler, GAMixIn, StandaloneTrackingMixin):
 
         Extend to add more customizations.
         """
+        self.profiler = self._start_profiler()
+
         if self.request.headers.get('Content-Type', '').startswith('application/json'):
             if not self.request.body:
                 raise HTTPError(400, reason=(
@@ -131,11 +142,11 @@ class BaseAPIHandler(BaseHandler, GAMixIn, StandaloneTrackingMixin):
         Override to write output basing on the specified format.
         """
         if isinstance(chunk, dict) and self.format not in ('json', ''):
-            if self.format == 'yaml' and SUPPORT_YAML:
+            if self.format == 'yaml' and import_formatter('yaml'):
                 self.set_header("Content-Type", "text/x-yaml; charset=UTF-8")
                 chunk = self._format_yaml(chunk)
 
-            elif self.format == 'msgpack' and SUPPORT_MSGPACK:
+            elif self.format == 'msgpack' and import_formatter('msgpack'):
                 self.set_header("Content-Type", "application/x-msgpack")
                 chunk = self._format_msgpack(chunk)
 
@@ -151,10 +162,104 @@ class BaseAPIHandler(BaseHandler, GAMixIn, StandaloneTrackingMixin):
             self.set_header("Content-Type", "application/json; charset=UTF-8")
             chunk = json.dumps(chunk, cls=DateTimeJSONEncoder)
 
+        if isinstance(chunk, dict):
+            self.set_header("Content-Type", "application/json; charset=UTF-8")
+            chunk = json_encode(chunk)
+
+        chunk = utf8(chunk)  # encoded once, counted before compression
+        self.bytes_written += len(chunk)
         super().write(chunk)
 
+    def finish(self, chunk=None):
+        """
+        Report profiling results before the response is sent.
+        """
+        if self.profiler:
+            if chunk is not None:
+                self.write(chunk)
+                chunk = None
+            self._stop_profiler()
+        return super().finish(chunk)
+
+    def _start_profiler(self):
+        """
+        Profile this request if it is requested with the
+        X-Profile-Token header by an authorized client:
+        the header value matches the PROFILE_TOKEN setting,
+        or the client address is in PROFILE_ALLOWED_IPS.
+        Other requests served concurrently by this process
+        are included in the measurement.
+        """
+        token = self.request.headers.get('X-Profile-Token')
+        if token is None:
+            return None
+
+        if not (self.web_settings.PROFILE_TOKEN and token == self.web_settings.PROFILE_TOKEN or
+                self.request.remote_ip in self.web_settings.PROFILE_ALLOWED_IPS):
+            return None
+
+        if BaseAPIHandler._profiling:
+            self.logger.warning("Profiler busy, skip profiling %s.", self.request.uri)
+            return None
+
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:  # profiling enabled outside of the handlers
+            self.logger.warning("Profiler busy, skip profiling %s.", self.request.uri)
+            return None
+        BaseAPIHandler._profiling = True
+        return profiler
+
+    def _disable_profiler(self):
+        """
+        Stop profiling this request, if it is profiled.
+        Return the profiler, or None.
+        """
+        profiler, self.profiler = self.profiler, None
+        if profiler:
+            profiler.disable()
+            BaseAPIHandler._profiling = False
+        return profiler
+
+    def _stop_profiler(self):
+        """
+        Report the functions taking the most cumulative time in
+        the X-Profile header as [function, calls, milliseconds],
+        and save the full profile under PROFILE_DIR if it is set.
+        """
+        import pstats
+
+        profiler = self._disable_profiler()
+
+        stats = pstats.Stats(profiler)
+        stats.sort_stats('cumulative')
+        top = []
+        for func in stats.fcn_list[:self.web_settings.PROFILE_TOP_N]:
+            _, calls, _, cumtime, _ = stats.stats[func]
+            top.append([pstats.func_std_string(func), calls, round(cumtime * 1000, 3)])
+
+        if self.web_settings.PROFILE_DIR:
+            filename = '{}_{}_{}.prof'.format(
+                datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f'),
+                self.name or self.__class__.__name__, self.request.method)
+            path = os.path.join(self.web_settings.PROFILE_DIR, filename)
+            try:
+                os.makedirs(self.web_settings.PROFILE_DIR, exist_ok=True)
+                stats.dump_stats(path)
+            except OSError:
+                self.logger.exception("Error saving profile %s.", path)
+            else:
+                self.logger.info("Profile saved to %s.", path)
+
+        if not self._headers_written:  # pylint: disable=protected-access
+            self.set_header("X-Profile", json.dumps(top))
+
     def _format_yaml(self, data):
 
+        yaml = import_formatter('yaml')
+
         def ordered_dump(data, stream=None, Dumper=yaml.Dumper, **kwds):
             class OrderedDumper(Dumper):
                 pass
@@ -171,6 +276,7 @@ class BaseAPIHandler(BaseHandler, GAMixIn, StandaloneTrackingMixin):
 
     def _format_msgpack(self, data):
 
+        msgpack = import_formatter('msgpack')
         return msgpack.packb(
             data, use_bin_type=True, default=msgpack_encode_datetime)
 
@@ -198,10 +304,20 @@ class BaseAPIHandler(BaseHandler, GAMixIn, StandaloneTrackingMixin):
         This is a tornado lifecycle hook.
         Override to provide tracking features.
         """
+        self._disable_profiler()  # not finished normally
         self.logger.debug("Event: %s", self.event)
+        if WARMUP_HEADER in self.request.headers:
+            return
         self.ga_track(self.event)
         self.self_track(self.event)
 
+    def on_connection_close(self):
+        """
+        Stop profiling when the client goes away.
+        """
+        self._disable_profiler()
+        super().on_connection_close()
+
     def write_error(self, status_code, **kwargs):
 
         reason = kwargs.pop('reason', self._reason)
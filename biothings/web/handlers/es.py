@@ -26,11 +26,17 @@ biothings.web.handlers.ESRequestHandler
     Subclasses:
     - biothings.web.handlers.BiothingHandler
     - biothings.web.handlers.QueryHandler
+    - biothings.web.handlers.ExportHandler
 
 """
+import json
+import time
+import zlib
 
-from tornado.web import Finish
+from tornado.iostream import StreamClosedError
+from tornado.web import Finish, HTTPError
 
+from biothings.utils.common import DateTimeJSONEncoder
 from biothings.utils.version import get_software_info
 from biothings.utils.web.es import get_es_versions
 
@@ -43,7 +49,8 @@ __all__ = [
     'MetadataFieldHandler',
     'ESRequestHandler',
     'BiothingHandler',
-    'QueryHandler'
+    'QueryHandler',
+    'ExportHandler'
 ]
 
 
@@ -159,6 +166,12 @@ class MetadataFieldHandler(BaseESRequestHandler):
         if self.args.raw:
             raise Finish(mapping)
 
+        # unfiltered, serialized once per mapping
+        if not self.args.prefix and not self.args.search and self.format == 'json':
+            fields = self.pipeline.get_field_index(mapping)
+            self.set_header("Content-Type", "application/json; charset=UTF-8")
+            raise Finish(fields.to_json())
+
         # reformat
         result = self.pipeline.transform_mapping(
             mapping, self.args.prefix, self.args.search)
@@ -174,6 +187,15 @@ class ESRequestHandler(BaseESRequestHandler):
     kwarg_groups = ('control', 'esqb', 'es', 'transform')
     kwarg_methods = ('get', 'post')
 
+    def initialize(self, biothing_type=None):
+
+        super().initialize(biothing_type)
+
+        # for the slow query log
+        self._query = None
+        self._timings = {}  # stage -> seconds
+        self._es_stats = {}  # took, total hits
+
     async def get(self, *args, **kwargs):
         return await self.execute_pipeline(*args, **kwargs)
 
@@ -188,24 +210,70 @@ class ESRequestHandler(BaseESRequestHandler):
         #                   Build query
         ###################################################
 
+        start = time.perf_counter()
         self._query = self.pipeline.build(options.esqb.q, options.esqb)
         self._query = self.pre_query_hook(options, self._query)
+        self._timings['build'] = time.perf_counter() - start
 
         ###################################################
         #                   Execute query
         ###################################################
 
+        start = time.perf_counter()
         self._res = await self.pipeline.execute(self._query, options.es)
+        self._timings['execute'] = time.perf_counter() - start
+        self._es_stats = self._read_es_stats(self._res)
         self._res = self.pre_transform_hook(options, self._res)
 
         ###################################################
         #                 Transform result
         ###################################################
 
+        start = time.perf_counter()
         res = self.pipeline.transform(self._res, options.transform)
         res = self.pre_finish_hook(options, res)
+        self._timings['transform'] = time.perf_counter() - start
 
+        start = time.perf_counter()
         self.finish(res)
+        self._timings['write'] = time.perf_counter() - start
+
+    @staticmethod
+    def _read_es_stats(res):
+        """
+        Return the es processing time in milliseconds and
+        the total number of hits of one or more es responses.
+        """
+        took, total = 0, 0
+        for _res in res if isinstance(res, list) else [res]:
+            if isinstance(_res, dict):
+                took += _res.get('took', 0)
+                _total = _res.get('hits', {}).get('total', 0)
+                if isinstance(_total, dict):  # es7
+                    _total = _total.get('value', 0)
+                total += _total
+        return {'took': took, 'total': total}
+
+    def on_finish(self):
+        """
+        Log the details of slow requests.
+        """
+        super().on_finish()
+
+        duration = self.request.request_time()
+        if self.web_settings.slowquery.should_log(duration):
+            try:
+                self.web_settings.slowquery.log(
+                    endpoint=f'{self.request.method} {self.request.path}',
+                    duration=duration,
+                    options=self.args,
+                    query=self._query.to_dict() if self._query else None,
+                    status=self.get_status(),
+                    es=self._es_stats,
+                    stages={key: round(val, 4) for key, val in self._timings.items()},
+                    size=self.bytes_written)
+            except Exception:  # pylint: disable=broad-except
+                self.logger.exception('Error logging slow query.')
 
     def pre_query_builder_hook(self, options):
         """
@@ -358,3 +426,65 @@ class QueryHandler(ESRequestHandler):
             self.clear_header('Cache-Control')
 
         return res
+
+
+class ExportHandler(ESRequestHandler):
+    '''
+    Biothings Export Endpoint
+
+    URL pattern examples:
+
+        /{pre}/{ver}/{typ}/export/?
+        /{pre}/{ver}//export/?
+
+        GET -> gzip compressed {...}\n{...}\n...
+
+    Stream every matching document, one per line, in no particular order.
+    '''
+    name = 'export'
+    kwarg_methods = ('get',)
+
+    async def post(self, *args, **kwargs):
+        raise HTTPError(405)
+
+    async def execute_pipeline(self, *args, **kwargs):
+
+        options = self.pre_query_builder_hook(self.args)
+
+        self._query = self.pipeline.build(options.esqb.q, options.esqb)
+        self._query = self.pre_query_hook(options, self._query)
+
+        self.set_header("Content-Type", "application/x-ndjson")
+        self.set_header("Content-Encoding", "gzip")
+        self.clear_header("Cache-Control")
+
+        compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+        pages = self.pipeline.export(self._query, options.es)
+        try:
+            async for page in pages:
+                page = self.pipeline.transform(page, options.transform)
+                lines = (json.dumps(hit, cls=DateTimeJSONEncoder) + '\n'
+                         for hit in page.get('hits', ()))
+                self.write(compressor.compress(''.join(lines).encode()))
+                await self.flush()  # wait for the client to receive it
+                self.event['total'] += len(page.get('hits', ()))
+        except StreamClosedError:
+            self.logger.info("Export aborted by client.")
+            return
+        finally:
+            await pages.aclose()
+
+        self.finish(compressor.flush())
+
+    def pre_query_builder_hook(self, options):
+
+        options = super().pre_query_builder_hook(options)
+
+        # GA
+        self.event['total'] = 0
+
+        # scrolled in index order
+        options.esqb.pop('sort', None)
+        options.esqb.pop('size', None)
+
+        return options
@@ -2,10 +2,16 @@
     Elasticsearch Query Execution
 """
 import asyncio
+import copy
+import json
+import re
+import time
 
+from biothings.utils.web.cache import LRUCache
 from biothings.web.handlers.exceptions import BadRequest, EndRequest
 from elasticsearch import (ConnectionError, ConnectionTimeout, NotFoundError,
                            RequestError, TransportError)
+from elasticsearch_dsl import MultiSearch, Search
 from tornado.web import HTTPError
 
 
@@ -27,6 +33,23 @@ class ESQueryBackend(object):
         self.scroll_time = web_settings.ES_SCROLL_TIME
         self.scroll_size = web_settings.ES_SCROLL_SIZE
 
+        # skip elasticsearch_dsl response objects
+        self.raw_response = web_settings.ES_RAW_RESPONSE
+
+        # for aggregation results
+        self.metadata = web_settings.metadata
+        self.metadata_refresh = web_settings.ES_CACHE_METADATA_REFRESH
+        self.metadata_refreshed = {}  # biothing_type -> time.monotonic()
+        self.aggs_cache = LRUCache(
+            web_settings.ES_AGGS_CACHE_SIZE,
+            web_settings.ES_AGGS_CACHE_TTL)
+
+        # for _id lookups
+        self.doc_cache = None
+        if web_settings.ES_DOC_CACHE:
+            self.doc_cache = web_settings.load_class(
+                web_settings.ES_DOC_CACHE)(**web_settings.ES_DOC_CACHE_KWARGS)
+
     async def execute(self, query, options):
         '''
         Execute the corresponding query. Must return an awaitable.
@@ -37,6 +60,7 @@ class ESQueryBackend(object):
             Optional:
                 fetch_all: also return a scroll_id for this query (default: false)
                 biothing_type: which type's corresponding indices to query (default in config.py)
+                aggs_cache: reuse aggregations of an identical query (default: true)
         '''
         if options.scroll_id:
             try:
@@ -59,24 +83,349 @@ class ESQueryBackend(object):
             if options.get('fetch_all', False):
                 query = query.params(scroll=self.scroll_time)
                 query = query.extra(size=self.scroll_size)
-            try:
-                res = await query.using(self.client).execute()
-            except (ConnectionError, ConnectionTimeout):
+
+            if self.doc_cache is not None or self.aggs_cache.maxsize > 0:
+                await self._refresh_metadata(options)
+
+            aggs, aggs_key = None, self._aggs_cache_key(query, options)
+            if aggs_key:
+                aggs = self.aggs_cache.get(aggs_key)
+                if aggs is not None:  # only retrieve hits
+                    query = self._without_aggs(query)
+
+            if self.doc_cache is not None and not options.get('fetch_all', False):
+                res = await self._execute_doc_cached(query, options)
+            else:  # all from elasticsearch
+                res = await self._execute(query)
+
+            if isinstance(res, dict):
+                if aggs is not None:
+                    res['aggregations'] = copy.deepcopy(aggs)
+                elif aggs_key and 'aggregations' in res:
+                    if self._is_complete(res):
+                        self.aggs_cache[aggs_key] = copy.deepcopy(res['aggregations'])
+            return res
+
+        return asyncio.sleep(0, {})
+
+    async def _execute(self, query):
+        """
+        Send a search or a multi search to elasticsearch,
+        return its decoded response, or a list of them.
+        Searches of other types than AsyncSearch and AsyncMultiSearch,
+        for example from a custom query builder, are always executed
+        with elasticsearch_dsl responses.
+        """
+        raw = self.raw_response and hasattr(query, 'execute_raw')
+        try:
+            query = query.using(self.client)
+            if raw:
+                res = await query.execute_raw()
+            else:  # wrapped in elasticsearch_dsl responses
+                res = await query.execute()
+        except (ConnectionError, ConnectionTimeout):
+            raise HTTPError(503)
+        except RequestError as exc:
+            raise BadRequest(_es_error=exc)
+        except TransportError as exc:
+            if exc.error == 'search_phase_execution_exception':
+                raise EndRequest(500, reason=exc.info)
+            elif exc.error == 'index_not_found_exception':
+                raise HTTPError(500, reason=exc.error)
+            elif exc.status_code == 'N/A':
                 raise HTTPError(503)
-            except RequestError as exc:
-                raise BadRequest(_es_error=exc)
-            except TransportError as exc:
-                if exc.error == 'search_phase_execution_exception':
-                    raise EndRequest(500, reason=exc.info)
-                elif exc.error == 'index_not_found_exception':
-                    raise HTTPError(500, reason=exc.error)
-                elif exc.status_code == 'N/A':
-                    raise HTTPError(503)
-                else:  # unexpected
-                    raise
-            else:  # format to {} or [{}...]
+            else:  # unexpected
+                raise
+        else:  # format to {} or [{}...]
+            if not raw:
                 if isinstance(res, list):
                     return [res_.to_dict() for res_ in res]
                 return res.to_dict()
+            return res
+
+    async def _execute_doc_cached(self, query, options):
+        """
+        Serve the _id lookups of a search or a multi search from the
+        document cache, only send the other searches to elasticsearch.
+        Cache entries hold the complete documents of an _id, each
+        lookup selects its fields and hits from them.
+        """
+        if isinstance(query, MultiSearch):
+            searches = list(query._searches)
+        else:  # single search
+            searches = [query]
+
+        lookups = [self._doc_lookup(search, query, options) for search in searches]
+        keys = list({lookup.key for lookup in lookups if lookup})
+        cached = await self._doc_cache_call(self.doc_cache.get_many, keys) if keys else {}
+
+        results = [None] * len(searches)
+        for pos, lookup in enumerate(lookups):
+            if lookup and lookup.key in cached:
+                results[pos] = lookup.respond(json.loads(cached[lookup.key]))
+
+        misses = [pos for pos, res in enumerate(results) if res is None]
+        sent = [lookups[pos].search if lookups[pos] else searches[pos] for pos in misses]
+        if misses and isinstance(query, MultiSearch):
+            query = query._clone()
+            query._searches = sent
+            responses = await self._execute(query)
+        elif misses:  # single search
+            responses = [await self._execute(sent[0])]
+        else:  # all cached
+            responses = []
+
+        entries = {}
+        for pos, res in zip(misses, responses):
+            lookup = lookups[pos]
+            if lookup and self._is_complete(res):
+                entries[lookup.key] = json.dumps(res)
+                res = lookup.respond(res)
+            results[pos] = res
+        if entries:
+            await self._doc_cache_call(self.doc_cache.set_many, entries)
+
+        if isinstance(query, MultiSearch):
+            return results
+        return results[0]
+
+    async def _doc_cache_call(self, func, *args):
+        """
+        Call a document cache method, in the default executor
+        for caches doing blocking I/O, like SQLiteCache.
+        """
+        if getattr(self.doc_cache, 'BLOCKING', False):
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(None, func, *args)
+        return func(*args)
+
+    def _doc_lookup(self, search, query, options):
+        """
+        Return a DocLookup if the search is an _id lookup which
+        can be served from the document cache, otherwise None.
+        The cache key is made of the index build version and
+        the _id, so lookups selecting different fields share it.
+        """
+        if not isinstance(search, Search):
+            return None
+
+        body = search.to_dict()
+        match = body.get('query', {}).get('multi_match', {})
+        if match.get('fields') != ['_id'] or set(body) - DocLookup.OPTIONS:
+            return None
+        if not isinstance(body.get('_source', True), (bool, str, list)):
+            return None  # includes and excludes
+
+        build = self._build_version(options)
+        if not build:
+            return None
+
+        index = search._index or query._index or ()
+        key = json.dumps((list(index), build, match.get('query')), sort_keys=True)
+        return DocLookup(key, search, body)
+
+    async def _refresh_metadata(self, options):
+        """
+        Reload the metadata of the queried biothing type at most every
+        ES_CACHE_METADATA_REFRESH seconds, so that the build version
+        in the cache keys follows the index rebuilt in the meantime.
+        """
+        if not self.metadata_refresh:
+            return
+        biothing_type = options.get('biothing_type', None) or self.default_type
+        now = time.monotonic()
+        refreshed = self.metadata_refreshed.setdefault(biothing_type, now)
+        if now - refreshed < self.metadata_refresh:
+            return  # loaded at startup or recently
+        self.metadata_refreshed[biothing_type] = now
+        await self.metadata.refresh(biothing_type)
+
+    def _build_version(self, options):
+        """
+        Return the build version and date of the queried data,
+        or None if the metadata is not available.
+        """
+        biothing_type = options.get('biothing_type', None) or self.default_type
+        metadata = self.metadata.biothing_metadata[biothing_type]
+        build = (metadata.get('build_version'), metadata.get('build_date'))
+        if not any(build):
+            return None
+        return build
+
+    @staticmethod
+    def _is_complete(res):
+        """
+        Return True if a response is a complete search result.
+        """
+        return isinstance(res, dict) and not res.get('timed_out') and \
+            not res.get('_shards', {}).get('failed')
+
+    async def export(self, query, options):
+        """
+        Iterate over every hit of a query with sliced scrolls.
+        Slices are scrolled concurrently and their pages are yielded
+        as they arrive, so the order of the pages is not determined.
+        At most one page per slice is buffered, a slow consumer
+        holds back the scrolls instead of growing the buffer.
+
+        Options:
+            slices: number of scrolls to run in parallel (default: 1)
+            biothing_type: which type's corresponding indices to query (default in config.py)
+        """
+        biothing_type = options.get('biothing_type', None) or self.default_type
+        index = self.indices.get(biothing_type, self.default_index)
+        slices = options.get('slices', None) or 1
+        body = query.sort('_doc').to_dict()
+        pages = asyncio.Queue(maxsize=slices)
+
+        async def _scroll(slice_id):
+            scroll_id = None
+            try:
+                _body = dict(body)
+                if slices > 1:  # es requires max > 1
+                    _body['slice'] = {'id': slice_id, 'max': slices}
+                res = await self.client.search(
+                    index=index, body=_body,
+                    scroll=self.scroll_time, size=self.scroll_size)
+                scroll_id = res.get('_scroll_id')
+                while res['hits']['hits']:
+                    await pages.put(res)
+                    res = await self.client.scroll(
+                        scroll_id=scroll_id, scroll=self.scroll_time)
+                    scroll_id = res.get('_scroll_id')
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:  # pylint: disable=broad-except
+                await pages.put(exc)
+            else:
+                await pages.put(None)
+            finally:
+                if scroll_id:
+                    try:
+                        await self.client.clear_scroll(scroll_id=scroll_id)
+                    except TransportError:
+                        pass  # expires after scroll time
+
+        tasks = [asyncio.ensure_future(_scroll(n)) for n in range(slices)]
+        try:
+            remaining = slices
+            while remaining:
+                page = await pages.get()
+                if page is None:
+                    remaining -= 1
+                elif isinstance(page, (ConnectionError, ConnectionTimeout)):
+                    raise HTTPError(503)
+                elif isinstance(page, RequestError):
+                    raise BadRequest(_es_error=page)
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    yield page
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _aggs_cache_key(self, query, options):
+        """
+        Return a key identifying the aggregation results of a query.
+        Aggregations only depend on the query conditions and the data,
+        so paging, sorting and field selection are left out of the key,
+        and the index build version stands in for the data.
+        Return None if the aggregations should not be cached.
+        """
+        if not isinstance(query, Search) or not query.aggs.aggs:
+            return None
+        if not options.get('aggs_cache', True) or options.get('fetch_all', False):
+            return None
+
+        build = self._build_version(options)
+        if not build:
+            return None
+
+        body = query.to_dict()
+        for key in ('from', 'size', 'sort', '_source', 'explain', 'version', 'highlight'):
+            body.pop(key, None)
+
+        return (tuple(query._index or ()), build, json.dumps(body, sort_keys=True))
+
+    @staticmethod
+    def _without_aggs(query):
+        """
+        Return a copy of a search without its aggregations.
+        """
+        body = query.to_dict()
+        body.pop('aggs', None)
+        search = query.__class__.from_dict(body)
+        search = search.index(*(query._index or ()))
+        return search.params(**query._params)
+
+
+class DocLookup(object):
+    """
+    An _id lookup served from the document cache. Its cache entry
+    is the response to the same search returning complete documents,
+    and their version, fields and hits are selected for each lookup.
+    """
+    OPTIONS = {'query', '_source', 'size', 'version'}
+
+    def __init__(self, key, search, body):
+        self.key = key
+        self.size = body.get('size', 10)  # es default
+        self.source = body.get('_source', True)
+        self.version = body.get('version', False)
+        # what is sent to elasticsearch on a miss
+        self.search = search.source(True).extra(version=True)
+
+    def respond(self, entry):
+        """
+        Return the response to this lookup from a cache entry,
+        or None if the entry holds fewer hits than requested.
+        """
+        total = entry['hits']['total']
+        total = total['value'] if isinstance(total, dict) else total
+        hits = entry['hits']['hits']
+        if len(hits) < min(self.size, total):
+            return None
+
+        res = dict(entry, took=0)
+        res['hits'] = dict(entry['hits'], hits=[])
+        for hit in hits[:self.size]:
+            hit = dict(hit)
+            if not self.version:
+                hit.pop('_version', None)
+            if self.source is False:
+                hit.pop('_source', None)
+            elif self.source is not True:
+                hit['_source'] = filter_source(hit.get('_source', {}), self.source)
+            res['hits']['hits'].append(hit)
+        return res
+
+
+def filter_source(source, fields):
+    """
+    Select the fields of a document _source the way elasticsearch
+    source filtering does. Fields are dotfield paths or patterns
+    with '*' wildcards, a matching object is kept with its content.
+    """
+    if isinstance(fields, str):
+        fields = [fields]
+    patterns = [re.compile(re.escape(field).replace(r'\*', '.*') + r'\Z') for field in fields]
+
+    def _filter(value, path):
+        if isinstance(value, list):  # objects of an array are filtered
+            items = [_filter(item, path) for item in value if isinstance(item, dict)]
+            return [item for item in items if item]
+        result = {}
+        for key, val in value.items():
+            _path = path + key
+            if any(pattern.match(_path) for pattern in patterns):
+                result[key] = val
+            elif isinstance(val, (dict, list)) and any(
+                    '*' in field or field.startswith(_path + '.') for field in fields):
+                val = _filter(val, _path + '.')
+                if val:
+                    result[key] = val
+        return result
+
+    return _filter(source, '')
 
-        return asyncio.sleep(0, {})
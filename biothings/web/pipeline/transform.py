@@ -1,9 +1,13 @@
 """
     Elasticsearch Query Result Transform
 """
+import copy
+import json
+from bisect import bisect_left
 from collections import defaultdict
 
-from biothings.utils.common import dotdict
+from biothings.utils.common import DateTimeJSONEncoder, dotdict
+from biothings.utils.web.cache import LRUCache
 
 
 class ResultTransformException(Exception):
@@ -24,6 +28,7 @@ class ESResultTransform(object):
         # mapping transform
         self.field_notes = web_settings.fieldnote.get_field_notes()
         self.excluded_keys = web_settings.AVAILABLE_FIELDS_EXCLUDED
+        self._field_indices = LRUCache(16)  # id(mapping) -> (mapping, FieldIndex)
 
     @classmethod
     def traverse(cls, obj, leaf_node=False):
@@ -305,7 +310,28 @@ class ESResultTransform(object):
         assert isinstance(prefix, str) or prefix is None
         assert isinstance(search, str) or search is None
 
-        result = {}
+        return self.get_field_index(mapping).select(prefix, search)
+
+    def get_field_index(self, mapping):
+        """
+        Return the field index of a mapping. The index is built once
+        and reused as long as the same mapping object is provided.
+        """
+        cached = self._field_indices.get(id(mapping))
+        if cached and cached[0] is mapping:
+            return cached[1]
+
+        index = FieldIndex(self.flatten_mapping(mapping))
+        self._field_indices[id(mapping)] = (mapping, index)
+        return index
+
+    def flatten_mapping(self, mapping):
+        """
+        Flatten a mapping definition into (key, value, is_field) entries.
+        Each field is represented by its dotfield path and definition.
+        Field notes are recorded as non-field entries in between.
+        """
+        entries = []
         todo = list(mapping.items())
         todo.reverse()
 
@@ -316,7 +342,7 @@ class ESResultTransform(object):
             dic.pop('normalizer', None)
 
             if key in self.field_notes:
-                result['notes'] = self.field_notes[key]
+                entries.append(('notes', self.field_notes[key], False))
 
             if 'copy_to' in dic:
                 if 'all' in dic['copy_to']:
@@ -335,9 +361,105 @@ class ESResultTransform(object):
                 todo.extend(reversed(list(subs)))
                 del dic['properties']
 
-            if all((not self.excluded_keys or key not in self.excluded_keys,
-                    not prefix or key.startswith(prefix),
-                    not search or search in key)):
-                result[key] = dict(sorted(dic.items()))
+            if not self.excluded_keys or key not in self.excluded_keys:
+                entries.append((key, dict(sorted(dic.items())), True))
+
+        return entries
+
+
+class FieldIndex():
+    """
+    Flattened field definitions of a mapping, looked up by
+    field name prefix or substring without visiting every field.
+
+    Fields are kept in their mapping order, sorted field names
+    are bisected for prefix lookups, and field names are indexed
+    by their trigrams to narrow down substring lookups.
+    Returned field definitions are copies, callers may modify them.
+    """
+
+    def __init__(self, entries):
+
+        self.entries = entries  # [(key, value, is_field), ...]
+        self.notes = [pos for pos, entry in enumerate(entries) if not entry[2]]
+        self.fields = [pos for pos, entry in enumerate(entries) if entry[2]]
+
+        # prefix lookups
+        fields = sorted((entries[pos][0], pos) for pos in self.fields)
+        self.sorted_keys = [key for key, _ in fields]
+        self.sorted_positions = [pos for _, pos in fields]
+
+        # substring lookups
+        self.trigrams = defaultdict(set)
+        for pos in self.fields:
+            key = entries[pos][0]
+            for start in range(len(key) - 2):
+                self.trigrams[key[start: start + 3]].add(pos)
+
+        self._serialized = None
 
+    def match_prefix(self, prefix):
+        """
+        Return the positions of the fields starting with prefix.
+        """
+        start = bisect_left(self.sorted_keys, prefix)
+        end = start
+        while end < len(self.sorted_keys) and \
+                self.sorted_keys[end].startswith(prefix):
+            end += 1
+        return self.sorted_positions[start: end]
+
+    def match_search(self, search, positions=None):
+        """
+        Return the positions of the fields containing search,
+        optionally among the provided field positions only.
+        """
+        if len(search) >= 3:
+            candidates = None
+            for start in range(len(search) - 2):
+                matches = self.trigrams.get(search[start: start + 3], set())
+                candidates = matches if candidates is None else candidates & matches
+                if not candidates:
+                    return []
+            if positions is not None:
+                candidates = candidates.intersection(positions)
+        else:  # too short to use the index
+            candidates = self.fields if positions is None else positions
+        return [pos for pos in candidates if search in self.entries[pos][0]]
+
+    def select(self, prefix=None, search=None):
+        """
+        Return the field definitions in mapping order,
+        only including the fields matching the filters.
+        """
+        if not prefix and not search:
+            return self.to_dict()
+
+        positions = None
+        if prefix:
+            positions = self.match_prefix(prefix)
+        if search:
+            positions = self.match_search(search, positions)
+
+        return self._build(sorted(self.notes + list(positions)))
+
+    def to_dict(self):
+        """
+        Return all field definitions.
+        """
+        return self._build(range(len(self.entries)))
+
+    def to_json(self):
+        """
+        Return all field definitions serialized in JSON.
+        """
+        if self._serialized is None:
+            self._serialized = json.dumps(self.to_dict(), cls=DateTimeJSONEncoder)
+        return self._serialized
+
+    def _build(self, positions):
+        result = {}
+        for pos in positions:
+            key, value, _ = self.entries[pos]
+            result[key] = copy.deepcopy(value)
         return result
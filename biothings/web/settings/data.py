@@ -4,6 +4,7 @@
     Typically one instance of each per settings class.
 """
 
+import asyncio
 from collections import defaultdict
 from datetime import datetime
 from functools import reduce
@@ -81,6 +82,17 @@ class DataConnections:
                 self.settings.logger.error(
                     "ES Python Version Mismatch.")
 
+    async def warmup(self, num_connections):
+        """
+        Open connections to the elasticsearch hosts ahead of the
+        first requests, and keep them in the connection pool.
+        """
+        if num_connections:
+            await asyncio.gather(*(
+                self.async_client.ping()
+                for _ in range(num_connections)
+            ), return_exceptions=True)  # logged by the client
+
     def get_connection(self, connection):
         return self._connections.get_connection(connection)
 
@@ -114,12 +126,18 @@ class DataPipeline:
     def execute(self, *args, **kwargs):
         return self.query_backend.execute(*args, **kwargs)
 
+    def export(self, *args, **kwargs):
+        return self.query_backend.export(*args, **kwargs)
+
     def transform(self, *args, **kwargs):
         return self.result_transform.transform(*args, **kwargs)
 
     def transform_mapping(self, *args, **kwargs):
         return self.result_transform.transform_mapping(*args, **kwargs)
 
+    def get_field_index(self, *args, **kwargs):
+        return self.result_transform.get_field_index(*args, **kwargs)
+
 class DataMetadata:
 
     def __init__(self, settings):
@@ -158,9 +176,14 @@ class DataMetadata:
 
         reader = BiothingMetadataReader(biothing_type, info, count)
         self.biothing_metadata[biothing_type] = reader.get_metadata()
-        self.biothing_mappings[biothing_type] = reader.get_mappings()
         self.biothing_licenses[biothing_type] = reader.get_licenses()
 
+        # keep the same object when unchanged, so that
+        # results derived from the mappings can be reused.
+        mappings = reader.get_mappings()
+        if mappings != self.biothing_mappings.get(biothing_type):
+            self.biothing_mappings[biothing_type] = mappings
+
         return info  # raw index info
 
 
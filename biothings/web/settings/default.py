@@ -52,11 +52,13 @@ APP_LIST = [
     (r"/{pre}/{ver}/{typ}/metadata/fields/?", 'biothings.web.handlers.MetadataFieldHandler'),
     (r"/{pre}/{ver}/{typ}/metadata/?", 'biothings.web.handlers.MetadataSourceHandler'),
     (r"/{pre}/{ver}/{typ}/query/?", 'biothings.web.handlers.QueryHandler'),
+    (r"/{pre}/{ver}/{typ}/export/?", 'biothings.web.handlers.ExportHandler'),
     (r"/{pre}/{ver}/{typ}/([^\/]+)/?", 'biothings.web.handlers.BiothingHandler'),
     (r"/{pre}/{ver}/{typ}/?", 'biothings.web.handlers.BiothingHandler'),
     (r"/{pre}/{ver}/metadata/fields/?", 'biothings.web.handlers.MetadataFieldHandler'),
     (r"/{pre}/{ver}/metadata/?", 'biothings.web.handlers.MetadataSourceHandler'),
     (r"/{pre}/{ver}/query/?", 'biothings.web.handlers.QueryHandler'),
+    (r"/{pre}/{ver}/export/?", 'biothings.web.handlers.ExportHandler'),
 ]
 
 # string used in headers to support CORS
@@ -86,6 +88,13 @@ APP_GIT_REPOSITORY = '.'
 # (from where app is launched)
 STATIC_PATH = "static"
 
+# Number of connections to open to elasticsearch at startup
+WARMUP_ES_CONNECTIONS = 4
+# Requests sent to the server itself after it starts listening,
+# for example '/v1/query?q=cdk2', /status reports unavailable
+# until they complete. See biothings.web.BiothingsAPI.warmup.
+WARMUP_QUERIES = []
+
 # color support is provided by tornado.log
 LOGGING_FORMAT = "%(color)s[%(levelname)s %(name)s %(module)s:%(lineno)d]%(end_color)s %(message)s"
 
@@ -120,10 +129,17 @@ QUERY_KWARGS = {
             'sort': {'type': list, 'group': 'esqb', 'max': 1000},
             'explain': {'type': bool, 'group': 'esqb'},
             'fetch_all': {'type': bool, 'group': 'es'},
-            'scroll_id': {'type': str, 'group': 'es'}},
+            'scroll_id': {'type': str, 'group': 'es'},
+            'aggs_cache': {'type': bool, 'default': True, 'group': 'es'}},
     'POST': {'q': {'type': list, 'required': True, 'group': 'esqb'},
              'scopes': {'type': list, 'default': ['_id'], 'group': 'esqb', 'max': 1000}}
 }
+EXPORT_KWARGS = {
+    '*': {key: val for key, val in COMMON_KWARGS.items() if key != 'size'},
+    'GET': {'q': {'type': str, 'default': '__all__', 'group': 'esqb'},
+            'userquery': {'type': str, 'group': 'esqb', 'alias': ['userfilter']},
+            'slices': {'type': int, 'default': 4, 'max': 8, 'group': 'es'}}
+}
 # *****************************************************************************
 # Elasticsearch Query Pipeline
 # *****************************************************************************
@@ -136,6 +152,26 @@ ALLOW_RANDOM_QUERY = False
 ALLOW_NESTED_AGGS = False
 
 ES_QUERY_BACKEND = 'biothings.web.pipeline.ESQueryBackend'
+# Cache the documents of _id lookups for each index build version,
+# lookups selecting different fields share them, and only the
+# lookups missing from the cache are sent to elasticsearch.
+# 'biothings.utils.web.cache.LRUCache' is kept in each process, and
+# 'biothings.utils.web.cache.SQLiteCache' is shared by the processes
+# using the same local file, configure it with a 'path' keyword.
+ES_DOC_CACHE = ''  # disabled
+ES_DOC_CACHE_KWARGS = {'maxsize': 100000, 'ttl': 86400}
+# Return the decoded search responses as they are from the
+# low-level client, skip elasticsearch-dsl response objects.
+ES_RAW_RESPONSE = False
+# Cache aggregation results per query and index build version,
+# number of entries to keep, set to 0 to disable the cache.
+ES_AGGS_CACHE_SIZE = 1000
+# Seconds an aggregation result stays cached, None for no expiration.
+ES_AGGS_CACHE_TTL = 86400
+# Seconds between reloads of the index metadata when the document or
+# the aggregation cache is enabled, their entries are kept per build
+# version, a new index build is picked up after this delay at most.
+ES_CACHE_METADATA_REFRESH = 60
 ES_RESULT_TRANSFORM = 'biothings.web.pipeline.ESResultTransform'
 
 # A list of fields to exclude from metadata/fields endpoint
@@ -148,6 +184,32 @@ LICENSE_TRANSFORM = {
     # "dot.field" :  "datasource"
 }
 
+# *****************************************************************************
+# Slow Query Log
+# *****************************************************************************
+# Log requests taking longer than this number of seconds, 0 to disable
+SLOW_QUERY_THRESHOLD = 0
+# Fraction of the slow requests to log
+SLOW_QUERY_SAMPLE_RATE = 1.0
+# Option names whose values are not logged, at any level
+SLOW_QUERY_REDACTED = []
+# Maximum number of characters of the logged elasticsearch query
+SLOW_QUERY_DSL_MAX_LENGTH = 4000
+# Also write to a rotating log file at this path
+SLOW_QUERY_LOG_FILE = ''
+
+# *****************************************************************************
+# Request Profiling
+# *****************************************************************************
+# Requests with an 'X-Profile-Token' header are profiled when the
+# header matches this token, or when the client ip is allowed.
+PROFILE_TOKEN = ''
+PROFILE_ALLOWED_IPS = []
+# Number of functions to report in the X-Profile response header
+PROFILE_TOP_N = 20
+# Save the full profiles in this folder, loadable by pstats
+PROFILE_DIR = ''
+
 # *****************************************************************************
 # Analytics Settings
 # *****************************************************************************
@@ -162,6 +224,7 @@ GA_ACTION_QUERY_GET = 'query_get'
 GA_ACTION_QUERY_POST = 'query_post'
 GA_ACTION_ANNOTATION_GET = 'biothing_get'
 GA_ACTION_ANNOTATION_POST = 'biothing_post'
+GA_ACTION_EXPORT_GET = 'export'
 
 # for standalone instance tracking
 STANDALONE_TRACKING_URL = ''
@@ -23,6 +23,12 @@ KWARG_DESCRIPTIONS = {
     'aggs': {
         'name': 'facets',
         'text_template': 'a comma-separated list of fields to return facets on.  In addition to query hits, the fields notated in "facets" will be aggregated by value and bucklet counts will be displayed in the "facets" field of the response object.{param_type}{param_default_value}{param_max}'},
+    'aggs_cache': {
+        'name': 'aggs_cache',
+        'text_template': 'reuse the facets computed for an identical query on the same data release. Pass "false" to recompute them.{param_type}{param_default_value}{param_max}'},
+    'slices': {
+        'name': 'slices',
+        'text_template': 'the number of parallel scrolls used to export the matching {biothing_object} hits.{param_type}{param_default_value}{param_max}'},
     'facet_size': {
         'name': 'facet_size',
         'text_template': 'the number of facet buckets to return in the response.{param_type}{param_default_value}{param_max}'},
@@ -10,12 +10,13 @@ from pydoc import locate
 
 import tornado.log
 from tornado.ioloop import IOLoop
+from tornado.locks import Event
 from tornado.web import Application
 
 from biothings.utils.web.userquery import ESUserQuery
 from biothings.web.handlers import BaseAPIHandler, BaseESRequestHandler
 from biothings.web.options import OptionSets
-from biothings.web.utils import DevInfo, FieldNote
+from biothings.web.utils import DevInfo, FieldNote, SlowQueryLog
 
 from . import default as web_default
 from .data import DataConnections, DataMetadata, DataPipeline
@@ -77,12 +78,19 @@ class BiothingWebSettings():
 
         self.fieldnote = FieldNote(self.AVAILABLE_FIELDS_NOTES_PATH)
         self.devinfo = DevInfo(self.APP_GIT_REPOSITORY)
+        self.slowquery = SlowQueryLog(
+            threshold=self.SLOW_QUERY_THRESHOLD,
+            sample_rate=self.SLOW_QUERY_SAMPLE_RATE,
+            redacted=self.SLOW_QUERY_REDACTED,
+            max_length=self.SLOW_QUERY_DSL_MAX_LENGTH,
+            path=self.SLOW_QUERY_LOG_FILE)
 
         # initialize payload for standalone tracking batch
         self.tracking_payload = []
 
         self.optionsets = OptionSets()
         self.handlers = {}
+        self.children = []  # settings of the modules in a config package
 
     @staticmethod
     def load_module(config, default=None):
@@ -216,6 +224,7 @@ class BiothingWebSettings():
             confs = [attr for attr in attrs if isinstance(attr, types.ModuleType)]
             _settings = [self.__class__(_attr, self._user) for _attr in confs]
             _handlers = [(f'/{c.API_PREFIX}/.*', c.get_app(settings)) for c in _settings]
+            self.children = _settings
             _handlers += handlers or []  # second level front pages won't be exposed
         else:  # config module
             _handlers = self._generate_app_handlers(handlers)
@@ -263,6 +272,13 @@ class BiothingESWebSettings(BiothingWebSettings):
         self.metadata = DataMetadata(self)
         self.pipeline = DataPipeline(self)
 
+        # set after connections and metadata are loaded
+        self.initialized = Event()
+        # cleared while WARMUP_QUERIES are replayed, see
+        # biothings.web.BiothingsAPI.warmup
+        self.ready = Event()
+        self.ready.set()
+
         IOLoop.current().add_callback(self._initialize)
 
     async def _initialize(self):
@@ -271,6 +287,7 @@ class BiothingESWebSettings(BiothingWebSettings):
         logging.getLogger('elasticsearch.trace').propagate = False
 
         await self.connections.log_versions()
+        await self.connections.warmup(self.WARMUP_ES_CONNECTIONS)
 
         # populate source mappings
         for biothing_type in self.ES_INDICES:
@@ -279,6 +296,8 @@ class BiothingESWebSettings(BiothingWebSettings):
         # resume normal log flow
         logging.getLogger('elasticsearch.trace').propagate = True
 
+        self.initialized.set()
+
     def validate(self):
         '''
         Additional ES settings to validate.
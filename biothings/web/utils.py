@@ -1,6 +1,9 @@
 
 import json
+import logging
 import os
+import random
+from logging.handlers import RotatingFileHandler
 
 from biothings.utils.version import get_software_info
 from biothings.utils.web.es import get_es_versions
@@ -36,3 +39,87 @@ class DevInfo:
     def get_git_repo_path(self):
 
         return self._git_repo_path
+
+class SlowQueryLog:
+    """
+    Record the details of requests slower than a threshold.
+    Written to the 'biothings.web.slowquery' logger, and
+    to a rotating log file when a path is provided.
+
+    Redacted option values can be copied anywhere in the
+    query, so the query is left out when any is present.
+    """
+    REDACTED = '<redacted>'
+
+    def __init__(self, threshold=0, sample_rate=1.0, redacted=(),
+                 max_length=4000, path='', max_bytes=10485760, backups=5):
+
+        self.threshold = threshold  # seconds, disabled if 0
+        self.sample_rate = sample_rate
+        self.redacted = set(redacted or ())
+        self.max_length = max_length
+        self.logger = logging.getLogger('biothings.web.slowquery')
+
+        if path and threshold:
+            path = os.path.abspath(path)
+            for handler in self.logger.handlers:
+                if getattr(handler, 'baseFilename', None) == path:
+                    break
+            else:  # one file handler per path
+                handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups)
+                handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+                self.logger.addHandler(handler)
+
+    def should_log(self, duration):
+        '''
+        Return True if a request taking duration seconds should be logged.
+        '''
+        if not self.threshold or duration < self.threshold:
+            return False
+        return random.random() < self.sample_rate
+
+    def redact(self, obj):
+        '''
+        Replace the values of the redacted fields, at any level.
+        '''
+        if isinstance(obj, dict):
+            return {
+                key: self.REDACTED if key in self.redacted else self.redact(val)
+                for key, val in obj.items()
+            }
+        if isinstance(obj, (list, tuple)):
+            return [self.redact(item) for item in obj]
+        return obj
+
+    def is_redacted(self, obj):
+        '''
+        Return True if a redacted field has a value, at any level.
+        '''
+        if isinstance(obj, dict):
+            return any(
+                key in self.redacted and val not in (None, '') or self.is_redacted(val)
+                for key, val in obj.items())
+        if isinstance(obj, (list, tuple)):
+            return any(self.is_redacted(item) for item in obj)
+        return False
+
+    def truncate(self, text):
+
+        if self.max_length and len(text) > self.max_length:
+            return text[:self.max_length] + '...'
+        return text
+
+    def log(self, endpoint, duration, options=None, query=None, **stats):
+        '''
+        Log a request with its options and elasticsearch query.
+        Additional keyword arguments are logged as they are.
+        '''
+        record = {
+            'endpoint': endpoint,
+            'duration': round(duration, 4),
+            'options': self.redact(options or {}),
+            'query': self.REDACTED if self.is_redacted(options or {}) else
+                     self.truncate(json.dumps(self.redact(query or {}), default=str, sort_keys=True))
+        }
+        record.update(stats)
+        self.logger.warning(json.dumps(record, default=str))
@@ -280,6 +280,24 @@ class TestAnnotationPOST(BiothingsTestCase):
         assert res[1]['query'] == '11'
         assert res[1]['notfound']
 
+    def test_04_ids_repeated(self):
+        """ POST /v1/gene
+        {
+            "ids": ["1017", "11", "1017", 1017]
+        }
+        [
+            {"query": "1017", "_id": "1017", ...},
+            {"query": "11", "notfound": true},
+            {"query": "1017", "_id": "1017", ...},
+            {"query": 1017, "_id": "1017", ...}
+        ]
+        """
+        res = self.request('/v1/gene', json={"ids": ["1017", "11", "1017", 1017]}).json()
+        assert [hit['query'] for hit in res] == ["1017", "11", "1017", 1017]
+        assert res[0] == res[2]
+        assert res[1]['notfound']
+        assert res[3]['_id'] == '1017'
+
     def test_10_form_encoded(self):
         """ POST /v1/gene
         ids=1017%2C11
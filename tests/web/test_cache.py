@@ -0,0 +1,295 @@
+'''
+    Test Caches and the Document and Aggregation Caches of ESQueryBackend
+
+    No elasticsearch needed, searches are answered from memory.
+
+'''
+import asyncio
+import os
+import tempfile
+import threading
+from types import SimpleNamespace
+from unittest import mock
+
+from biothings.utils.common import dotdict
+from biothings.utils.web.cache import LRUCache, SQLiteCache
+from biothings.utils.web.es_dsl import AsyncMultiSearch, AsyncSearch
+from biothings.web.pipeline.execute import ESQueryBackend, filter_source
+
+DOCS = {
+    '1': {'a': 1, 'b': {'c': 1, 'd': 1}},
+    '2': {'a': 2, 'b': [{'c': 2}, {'d': 2}]},
+    '3': {'a': 3},
+}
+
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=2)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache.get('a') == 1
+    cache['c'] = 3  # evicts 'b', least recently used
+    assert 'b' not in cache
+    assert cache.get_many(['a', 'b', 'c']) == {'a': 1, 'c': 3}
+    cache.set_many({'d': 4})
+    assert len(cache) == 2
+    assert cache.pop('d') == 4
+    assert 'd' not in cache
+
+    cache = LRUCache(maxsize=0)
+    cache['a'] = 1
+    assert cache.get('a') is None
+
+
+def test_lru_cache_ttl():
+    cache = LRUCache(ttl=10)
+    with mock.patch('time.monotonic', return_value=100):
+        cache['a'] = 1
+    with mock.patch('time.monotonic', return_value=105):
+        assert cache.get('a') == 1
+    with mock.patch('time.monotonic', return_value=111):
+        assert cache.get('a') is None
+        assert len(cache) == 0
+
+
+def test_sqlite_cache():
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'cache.sqlite3')
+        cache = SQLiteCache(path, maxsize=3, ttl=10)
+        cache.BATCH_SIZE = 2
+        cache['a'] = '1'
+        cache.set_many({'b': '2', 'c': '3'})
+        assert cache.get('a') == '1'
+        assert cache.get_many(['a', 'b', 'c', 'd']) == {'a': '1', 'b': '2', 'c': '3'}
+        # shared by instances using the same file
+        assert SQLiteCache(path).get('b') == '2'
+        # and usable from executor threads
+        results = []
+        thread = threading.Thread(target=lambda: results.append(cache.get('c')))
+        thread.start()
+        thread.join()
+        assert results == ['3']
+        # earliest entries evicted
+        cache.set_many({'d': '4', 'e': '5'})
+        cache.prune()
+        assert cache.get_many(['a', 'b', 'c', 'd', 'e']) == {'c': '3', 'd': '4', 'e': '5'}
+        # expired
+        with mock.patch('time.time', return_value=cache.conn.execute(
+                "SELECT MAX(expire) FROM cache").fetchone()[0] + 1):
+            assert cache.get('e') is None
+        assert cache.pop('d') == '4'
+        assert 'd' not in cache
+        cache.clear()
+        assert cache.get('c') is None
+
+
+def test_sqlite_cache_errors():
+    with tempfile.TemporaryDirectory() as folder:
+        cache = SQLiteCache(folder)  # a directory, can't be opened
+        cache['a'] = '1'
+        assert cache.get('a') is None
+        assert cache.get_many(['a']) == {}
+        cache.prune()
+        cache.clear()
+
+
+def test_filter_source():
+    doc = {'a': 1, 'b': {'c': 1, 'd': {'e': 1}}, 'f': [{'c': 1}, {'g': 1}, 2]}
+    assert filter_source(doc, ['a']) == {'a': 1}
+    assert filter_source(doc, 'b') == {'b': {'c': 1, 'd': {'e': 1}}}
+    assert filter_source(doc, ['b.d.e', 'a']) == {'a': 1, 'b': {'d': {'e': 1}}}
+    assert filter_source(doc, ['f.c']) == {'f': [{'c': 1}]}
+    assert filter_source(doc, ['*.c']) == {'b': {'c': 1}, 'f': [{'c': 1}]}
+    assert filter_source(doc, ['x']) == {}
+
+
+class MemoryBackend(ESQueryBackend):
+    """
+    Answer _id lookups from DOCS, as elasticsearch would.
+    """
+
+    def __init__(self, doc_cache):
+        web_settings = SimpleNamespace(
+            connections=SimpleNamespace(async_client=None),
+            ES_INDICES={}, ES_INDEX='test', ES_DOC_TYPE='gene',
+            ES_SCROLL_TIME='1m', ES_SCROLL_SIZE=10, ES_RAW_RESPONSE=True,
+            metadata=SimpleNamespace(biothing_metadata={'gene': {'build_version': '1'}}),
+            ES_AGGS_CACHE_SIZE=0, ES_AGGS_CACHE_TTL=None, ES_DOC_CACHE='',
+            ES_CACHE_METADATA_REFRESH=None)
+        super().__init__(web_settings)
+        self.doc_cache = doc_cache
+        self.sent = []
+
+    async def _execute(self, query):
+        if isinstance(query, AsyncMultiSearch):
+            return [self._search(search) for search in query._searches]
+        return self._search(query)
+
+    def _search(self, search):
+        body = search.to_dict()
+        self.sent.append(body)
+        _id = body['query'].get('multi_match', {}).get('query')
+        hits = []
+        if _id in DOCS:
+            hit = {'_index': 'test', '_id': _id, '_score': 1.0}
+            if body.get('version'):
+                hit['_version'] = 1
+            source = body.get('_source', True)
+            if source is not False:
+                hit['_source'] = DOCS[_id] if source is True else filter_source(DOCS[_id], source)
+            hits.append(hit)
+        res = {'took': 1, 'timed_out': False,
+               '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+               'hits': {'total': {'value': len(hits), 'relation': 'eq'},
+                        'max_score': 1.0 if hits else None, 'hits': hits}}
+        if 'aggs' in body:  # tells the searches apart
+            res['aggregations'] = {name: {'buckets': [{'key': 'a', 'doc_count': len(self.sent)}]}
+                                   for name in body['aggs']}
+        return res
+
+
+def lookup(_id, fields=None, version=False):
+    search = AsyncSearch().query(
+        'multi_match', query=_id, operator='and', fields=['_id'], lenient=True)
+    if fields:
+        search = search.source(fields)
+    if version:
+        search = search.extra(version=True)
+    return search
+
+
+def lookups(ids, fields=None):
+    search = AsyncMultiSearch()
+    for _id in ids:
+        search = search.add(lookup(_id, fields))
+    return search
+
+
+def sources(res):
+    return [[hit.get('_source') for hit in _res['hits']['hits']] for _res in res]
+
+
+def run(backend, query):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(backend.execute(query, dotdict()))
+    finally:
+        loop.close()
+
+
+def check_doc_cache(doc_cache):
+    backend = MemoryBackend(doc_cache)
+    res = run(backend, lookups(['1', '2', '0'], ['a']))
+    assert sources(res) == [[{'a': 1}], [{'a': 2}], []]
+    # complete documents fetched to be cached
+    assert [body['_source'] for body in backend.sent] == [True] * 3
+
+    # other fields served from the same entries, only misses sent
+    backend.sent = []
+    res = run(backend, lookups(['2', '3', '1'], ['b.c']))
+    assert sources(res) == [[{'b': [{'c': 2}]}], [{}], [{'b': {'c': 1}}]]
+    assert [body['query']['multi_match']['query'] for body in backend.sent] == ['3']
+
+    # single search, version only when requested
+    backend.sent = []
+    res = run(backend, lookup('1'))
+    assert res['hits']['hits'] == [{'_index': 'test', '_id': '1', '_score': 1.0, '_source': DOCS['1']}]
+    res = run(backend, lookup('1', version=True))
+    assert res['hits']['hits'][0]['_version'] == 1
+    assert not backend.sent
+
+    # other searches are sent as they are
+    res = run(backend, AsyncSearch().query('query_string', query='a:1').source(['a']))
+    assert backend.sent == [{'query': {'query_string': {'query': 'a:1'}}, '_source': ['a']}]
+
+    # a new build, new entries
+    backend.sent = []
+    backend.metadata.biothing_metadata['gene']['build_version'] = '2'
+    run(backend, lookup('1', ['a']))
+    assert len(backend.sent) == 1
+
+
+def test_doc_cache_lru():
+    check_doc_cache(LRUCache())
+
+
+def test_doc_cache_sqlite():
+    with tempfile.TemporaryDirectory() as folder:
+        cache = SQLiteCache(os.path.join(folder, 'cache.sqlite3'))
+        with mock.patch.object(cache, 'get_many', wraps=cache.get_many) as get_many:
+            check_doc_cache(cache)
+        # one batched lookup per query
+        assert get_many.call_count == 5
+        assert get_many.call_args_list[0][0][0].__len__() == 3
+
+
+def test_doc_cache_incomplete():
+    backend = MemoryBackend(LRUCache())
+    search = backend._search
+
+    def timed_out(search_):
+        res = search(search_)
+        res['timed_out'] = True
+        return res
+    backend._search = timed_out
+    run(backend, lookup('1'))
+    assert len(backend.doc_cache) == 0
+
+
+def aggs_search(size):
+    search = AsyncSearch().query('match_all').extra(size=size)
+    search.aggs.bucket('a', 'terms', field='a')
+    return search
+
+
+def test_aggs_cache():
+    backend = MemoryBackend(None)
+    backend.aggs_cache = LRUCache()
+    res1 = run(backend, aggs_search(3))
+    res2 = run(backend, aggs_search(5))
+    assert res1['aggregations'] == res2['aggregations']
+    # only hits retrieved the second time
+    assert 'aggs' in backend.sent[0]
+    assert backend.sent[1] == {'query': {'match_all': {}}, 'size': 5}
+
+    # a new build, new entries
+    backend.metadata.biothing_metadata['gene']['build_version'] = '2'
+    res3 = run(backend, aggs_search(3))
+    assert 'aggs' in backend.sent[2]
+    assert res3['aggregations'] != res1['aggregations']
+
+
+def test_without_aggs():
+    search = aggs_search(3).index('test').params(routing='1')
+    hits = ESQueryBackend._without_aggs(search)
+    assert isinstance(hits, AsyncSearch)
+    assert hits.to_dict() == {'query': {'match_all': {}}, 'size': 3}
+    assert hits._index == ['test']
+    assert hits._params == {'routing': '1'}
+    # the search is unchanged
+    assert 'aggs' in search.to_dict()
+
+
+def test_metadata_refresh():
+    backend = MemoryBackend(None)
+    backend.aggs_cache = LRUCache()
+    backend.metadata_refresh = 60
+    builds = iter(['2', '3'])
+
+    async def refresh(biothing_type):
+        backend.metadata.biothing_metadata[biothing_type]['build_version'] = next(builds)
+    backend.metadata.refresh = refresh
+
+    with mock.patch('time.monotonic', return_value=100):
+        run(backend, aggs_search(3))
+    with mock.patch('time.monotonic', return_value=150):
+        run(backend, aggs_search(3))
+    # loaded at startup, recent enough
+    assert backend.metadata.biothing_metadata['gene']['build_version'] == '1'
+    assert 'aggs' not in backend.sent[1]
+
+    # the index was rebuilt in the meantime
+    with mock.patch('time.monotonic', return_value=161):
+        run(backend, aggs_search(3))
+    assert backend.metadata.biothing_metadata['gene']['build_version'] == '2'
+    assert 'aggs' in backend.sent[2]
@@ -0,0 +1,94 @@
+'''
+    Test ESQueryBackend Raw and elasticsearch_dsl Responses
+
+    No elasticsearch needed, searches are answered from memory.
+
+'''
+import asyncio
+import json
+from types import SimpleNamespace
+
+from elasticsearch.serializer import JSONSerializer
+from elasticsearch_dsl import Search
+
+from biothings.utils.common import dotdict
+from biothings.utils.web.es_dsl import AsyncMultiSearch, AsyncSearch
+from biothings.web.pipeline.execute import ESQueryBackend
+
+
+class MemoryClient:
+    """
+    Answer searches with their bodies, as an async elasticsearch client.
+    """
+
+    def __init__(self):
+        self.transport = SimpleNamespace(serializer=JSONSerializer())
+
+    async def search(self, index=None, body=None, **params):
+        return {'took': 1, 'timed_out': False,
+                'hits': {'total': {'value': 1, 'relation': 'eq'}, 'max_score': 1.0,
+                         'hits': [{'_index': index, '_id': '1', '_score': 1.0,
+                                   '_source': {'body': body, 'params': params}}]},
+                'aggregations': {'a': {'buckets': [{'key': 'a', 'doc_count': 1}]}}}
+
+    async def msearch(self, index=None, body=None, **params):
+        if isinstance(body, str):  # serialized by execute_raw
+            body = [json.loads(line) for line in body.splitlines()]
+        return {'responses': [await self.search(head.get('index', index), search)
+                              for head, search in zip(body[::2], body[1::2])]}
+
+
+class CustomSearch(Search):
+    """
+    A search type of a custom query builder, without execute_raw.
+    """
+    execute = AsyncSearch.execute
+
+
+def backend(raw_response):
+    web_settings = SimpleNamespace(
+        connections=SimpleNamespace(async_client=MemoryClient()),
+        ES_INDICES={}, ES_INDEX='test', ES_DOC_TYPE='gene',
+        ES_SCROLL_TIME='1m', ES_SCROLL_SIZE=10, ES_RAW_RESPONSE=raw_response,
+        metadata=SimpleNamespace(biothing_metadata={'gene': {}}),
+        ES_AGGS_CACHE_SIZE=0, ES_AGGS_CACHE_TTL=None, ES_DOC_CACHE='',
+        ES_CACHE_METADATA_REFRESH=None)
+    return ESQueryBackend(web_settings)
+
+
+def run(query, raw_response):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(backend(raw_response).execute(query, dotdict()))
+    finally:
+        loop.close()
+
+
+def search(search_class=AsyncSearch):
+    query = search_class().query('match', a='b').extra(size=3)
+    query.aggs.bucket('a', 'terms', field='a')
+    return query
+
+
+def check_responses(query):
+    res = run(query, False)
+    assert run(query, True) == res
+    return res
+
+
+def test_search():
+    res = check_responses(search())
+    assert res['hits']['hits'][0]['_source']['body'] == search().to_dict()
+
+
+def test_multi_search():
+    query = AsyncMultiSearch().add(search()).add(AsyncSearch().query('match', a='c'))
+    res = check_responses(query)
+    assert len(res) == 2
+    assert res[1]['hits']['hits'][0]['_source']['body'] == {'query': {'match': {'a': 'c'}}}
+
+
+def test_custom_search():
+    # executed with elasticsearch_dsl responses
+    res = check_responses(search(CustomSearch))
+    assert res['hits']['hits'][0]['_source']['body'] == search().to_dict()
@@ -0,0 +1,51 @@
+'''
+    Test Export Endpoint
+
+    GET /v1/export
+
+'''
+import json
+
+from biothings.tests.web import BiothingsTestCase
+from setup import setup_es  # pylint: disable=unused-import
+
+
+class TestExport(BiothingsTestCase):
+
+    def test_00_all(self):
+        """ GET /v1/export?q=__all__&slices=2
+        {"_id": "1017", "_score": 1.0, ...}
+        {"_id": "12566", "_score": 1.0, ...}
+        ...
+        """
+        res = self.request('/v1/export?q=__all__&slices=2')
+        assert res.headers['Content-Encoding'] == 'gzip'
+        hits = [json.loads(line) for line in res.text.splitlines()]
+        assert len(hits) == 100
+        assert len({hit['_id'] for hit in hits}) == 100
+
+    def test_01_fields(self):
+        """ GET /v1/export?q=cdk2&fields=symbol&dotfield
+        {"_id": "1017", "_score": 1.0, "symbol": "CDK2"}
+        ...
+        """
+        res = self.request('/v1/export?q=cdk2&fields=symbol&dotfield')
+        hits = [json.loads(line) for line in res.text.splitlines()]
+        assert hits
+        for hit in hits:
+            assert set(hit) <= {'_id', '_score', 'symbol'}
+
+    def test_02_slices_max(self):
+        """ GET /v1/export?slices=100
+        {
+            "success": false,
+            "code": 400,
+            ...
+        }
+        """
+        self.request('/v1/export?slices=100', expect=400)
+
+    def test_03_post(self):
+        """ POST /v1/export
+        """
+        self.request('/v1/export', method='POST', expect=405)
@@ -0,0 +1,275 @@
+'''
+    Test BaseAPIHandler, StatusHandler, Warm-up and the Slow Query Log
+
+    No elasticsearch needed, handlers are served by a local application.
+
+'''
+import asyncio
+import json
+import sys
+from types import SimpleNamespace
+from unittest import mock
+
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.httputil import HTTPHeaders, HTTPServerRequest
+from tornado.locks import Event
+from tornado.testing import bind_unused_port
+from tornado.web import Application
+
+from biothings.web import BiothingsAPI
+from biothings.web.handlers import BaseAPIHandler, StatusHandler
+from biothings.web.handlers.api import WARMUP_HEADER
+from biothings.web.settings import default
+from biothings.web.utils import SlowQueryLog
+
+SETTINGS = {key: val for key, val in vars(default).items() if key.isupper()}
+
+
+def test_slow_query_log(caplog):
+    log = SlowQueryLog(threshold=1, redacted=['token'])
+    assert not log.should_log(0.5)
+    assert log.should_log(1.5)
+
+    log.log('query', 1.5, {'q': 'cdk2', 'size': 10}, {'query': {'match': {'_all': 'cdk2'}}})
+    record = json.loads(caplog.records[-1].getMessage())
+    assert record['options'] == {'q': 'cdk2', 'size': 10}
+    assert json.loads(record['query']) == {'query': {'match': {'_all': 'cdk2'}}}
+
+
+def test_slow_query_log_redacted(caplog):
+    log = SlowQueryLog(threshold=1, redacted=['q', 'token'], max_length=20)
+
+    # the values of redacted options are copied into the query
+    log.log('query', 1.5, {'q': 'secret', 'size': 10}, {'query': {'match': {'_all': 'secret'}}})
+    record = json.loads(caplog.records[-1].getMessage())
+    assert record['options'] == {'q': log.REDACTED, 'size': 10}
+    assert record['query'] == log.REDACTED
+    assert 'secret' not in caplog.records[-1].getMessage()
+
+    log.log('query', 1.5, {'esqb': {'token': ['secret']}}, {'size': 10})
+    assert 'secret' not in caplog.records[-1].getMessage()
+
+    # not provided, the query is logged, truncated
+    log.log('query', 1.5, {'q': None, 'size': 10}, {'size': 10, 'sort': ['_score', '_id']})
+    record = json.loads(caplog.records[-1].getMessage())
+    assert record['query'] == '{"size": 10, "sort":...'
+
+
+class SizeHandler(BaseAPIHandler):
+
+    sizes = []
+
+    def get(self, kind):
+        if kind == 'dict':
+            self.finish({'a': 'b' * 2000})
+        elif kind == 'list':
+            self.write(['a', 1])
+            self.write('text')
+        elif kind == 'yaml':
+            self.format = 'yaml'
+            self.finish({'a': 1})
+        elif kind == 'unknown':
+            self.format = 'unknown'
+            self.finish({'a': 1})
+        else:
+            self.write(b'\x00\x01')
+            self.flush()
+            self.write('é')
+
+    def on_finish(self):
+        super().on_finish()
+        self.sizes.append(self.bytes_written)
+
+
+def serve(app, func):
+    """
+    Serve app on a local port and return the result of
+    func(client, port), a coroutine function.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    sock, port = bind_unused_port()
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+    client = AsyncHTTPClient(force_instance=True)
+    try:
+        return loop.run_until_complete(func(client, port))
+    finally:
+        client.close()
+        server.stop()
+        loop.close()
+
+
+def fetch_all(handler, requests, settings=None):
+    """
+    Serve handler on a local port and return the responses
+    to requests, a list of (path, fetch kwargs), sent concurrently.
+    """
+    app = Application([(r'/(\w+)', handler)], compress_response=True,
+                      biothings=SimpleNamespace(**dict(SETTINGS, **(settings or {}))))
+    return serve(app, lambda client, port: asyncio.gather(*(
+        client.fetch(f'http://127.0.0.1:{port}{path}', raise_error=False, **kwargs)
+        for path, kwargs in requests)))
+
+
+def fetch(handler, path, settings=None, **kwargs):
+    return fetch_all(handler, [(path, kwargs)], settings)[0]
+
+
+def check_size(path, code=200):
+    SizeHandler.sizes = []
+    response = fetch(SizeHandler, path)
+    assert response.code == code
+    assert SizeHandler.sizes == [len(response.body)]
+    return response
+
+
+def test_response_size():
+    check_size('/dict')
+    check_size('/list')
+    check_size('/bytes')
+    check_size('/yaml')
+    # error payload, a dict written by tornado
+    response = check_size('/unknown', 400)
+    assert response.headers['Content-Type'] == 'application/json; charset=UTF-8'
+    assert json.loads(response.body)['code'] == 400
+
+
+def test_response_size_compressed():
+    SizeHandler.sizes = []
+    response = fetch(SizeHandler, '/dict', headers={'Accept-Encoding': 'gzip'},
+                     decompress_response=False)
+    assert response.headers.get('Content-Encoding') == 'gzip'
+    assert SizeHandler.sizes == [len(json.dumps({'a': 'b' * 2000}))]
+
+
+class ProfileHandler(BaseAPIHandler):
+
+    async def get(self, kind):
+        await asyncio.sleep(0.05)
+        if kind == 'error':
+            raise ValueError()
+        self.finish({'profiling': BaseAPIHandler._profiling})
+
+
+def profiled(response):
+    return json.loads(response.headers.get('X-Profile', 'null'))
+
+
+def test_profile():
+    settings = {'PROFILE_TOKEN': 'secret'}
+    response = fetch(ProfileHandler, '/ok', settings, headers={'X-Profile-Token': 'secret'})
+    assert json.loads(response.body) == {'profiling': True}
+    assert profiled(response)
+    assert not BaseAPIHandler._profiling
+    assert sys.getprofile() is None
+
+    # not authorized
+    assert not profiled(fetch(ProfileHandler, '/ok', settings, headers={'X-Profile-Token': 'other'}))
+    assert not profiled(fetch(ProfileHandler, '/ok?profile=secret', settings))
+    assert not profiled(fetch(ProfileHandler, '/ok', headers={'X-Profile-Token': ''}))
+    # allowed client
+    assert profiled(fetch(ProfileHandler, '/ok', {'PROFILE_ALLOWED_IPS': ['127.0.0.1']},
+                          headers={'X-Profile-Token': ''}))
+
+    # errors
+    response = fetch(ProfileHandler, '/error', settings, headers={'X-Profile-Token': 'secret'})
+    assert response.code == 500
+    assert not BaseAPIHandler._profiling
+    assert sys.getprofile() is None
+
+
+def test_profile_concurrent():
+    headers = {'X-Profile-Token': 'secret'}
+    responses = fetch_all(ProfileHandler, [('/ok', {'headers': headers})] * 3,
+                          {'PROFILE_TOKEN': 'secret'})
+    assert all(response.code == 200 for response in responses)
+    assert [bool(profiled(response)) for response in responses].count(True) == 1
+    assert not BaseAPIHandler._profiling
+    assert sys.getprofile() is None
+
+
+def test_profile_connection_close():
+    app = Application(biothings=SimpleNamespace(**dict(SETTINGS, PROFILE_TOKEN='secret')))
+    request = HTTPServerRequest(
+        'GET', '/ok', headers=HTTPHeaders({'X-Profile-Token': 'secret'}),
+        connection=mock.Mock())
+    handler = ProfileHandler(app, request)
+    handler.prepare()
+    assert handler.profiler and BaseAPIHandler._profiling
+    handler.on_connection_close()
+    assert handler.profiler is None
+    assert not BaseAPIHandler._profiling
+    assert sys.getprofile() is None
+
+
+class TrackHandler(BaseAPIHandler):
+
+    events = []
+
+    def get(self, kind):
+        self.events.append((kind, self.web_settings.ready.is_set()))
+        self.finish({})
+
+    def ga_track(self, event=None):
+        self.events.append(('ga', event['action']))
+
+    def self_track(self, data=None):
+        self.events.append(('self', data['action']))
+
+
+def web_settings(warmup_queries=(), ready=True):
+
+    async def health():
+        return {'status': 'green'}
+
+    settings = SimpleNamespace(**dict(
+        SETTINGS, WARMUP_QUERIES=list(warmup_queries), STATUS_CHECK={}, children=[],
+        connections=SimpleNamespace(async_client=SimpleNamespace(
+            cluster=SimpleNamespace(health=health))),
+        initialized=Event(), ready=Event()))
+    settings.initialized.set()
+    if ready:
+        settings.ready.set()
+    return settings
+
+
+def test_status():
+    app = Application([(r'/status', StatusHandler)], biothings=web_settings())
+    response = serve(app, lambda client, port: client.fetch(
+        f'http://127.0.0.1:{port}/status', raise_error=False))
+    assert json.loads(response.body)['status'] == 'green'
+
+    # not warmed up yet
+    app = Application([(r'/status', StatusHandler)],
+                      biothings=web_settings(['/warm'], ready=False))
+    response = serve(app, lambda client, port: client.fetch(
+        f'http://127.0.0.1:{port}/status', raise_error=False))
+    assert response.code == 503
+    assert json.loads(response.body)['status'] == 'initializing'
+
+
+def test_warmup():
+    TrackHandler.events = []
+    # ready before the warm-up requests are replayed,
+    # when served with get_server() and no warmup()
+    settings = web_settings(['/warm', '/warm'])
+    api = SimpleNamespace(config=settings, host=None)
+    app = Application([(r'/status', StatusHandler), (r'/(\w+)', TrackHandler)],
+                      biothings=settings)
+
+    async def warmup(client, port):
+        status = await client.fetch(f'http://127.0.0.1:{port}/status')
+        await BiothingsAPI.warmup(api, port)
+        await client.fetch(f'http://127.0.0.1:{port}/user')
+        return status
+
+    assert serve(app, warmup).code == 200
+    assert settings.ready.is_set()
+    # warm-up requests served before reporting ready,
+    # only the user request is tracked
+    assert TrackHandler.events == [
+        ('warm', False), ('warm', False),
+        ('user', True), ('ga', 'GET'), ('self', 'GET')]
+
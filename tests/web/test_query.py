@@ -128,6 +128,25 @@ class TestQueryKeywords(BiothingsTestCase):
         assert res['facets']['symbol']['terms']
         assert res['facets']['symbol']['terms'][0]["alias"]
 
+    def test_05_facet_cache(self):
+        """ GET /v1/query?q=__all__&aggs=type_of_gene&size=3
+            GET /v1/query?q=__all__&aggs=type_of_gene&size=5
+            GET /v1/query?q=__all__&aggs=type_of_gene&aggs_cache=false
+        {
+            "facets": {
+                "type_of_gene": { ... }
+            },
+            "hits": [ ... ],
+            ...
+        }
+        """
+        res1 = self.request('/v1/query?q=__all__&aggs=type_of_gene&size=3').json()
+        res2 = self.request('/v1/query?q=__all__&aggs=type_of_gene&size=5').json()
+        res3 = self.request('/v1/query?q=__all__&aggs=type_of_gene&aggs_cache=false').json()
+        assert res1['facets'] == res2['facets'] == res3['facets']
+        assert len(res1['hits']) == 3
+        assert len(res2['hits']) == 5
+
     def test_10_from(self):
         """ GET /v1/query?q=__all__&from=99
         {
@@ -0,0 +1,84 @@
+'''
+    Test Mapping Transformations of ESResultTransform
+
+    No elasticsearch needed.
+
+'''
+import json
+from types import SimpleNamespace
+
+from biothings.web.pipeline.transform import ESResultTransform, FieldIndex
+
+MAPPING = {
+    'name': {'type': 'text', 'copy_to': ['all']},
+    'symbol': {'type': 'keyword', 'normalizer': 'keyword_lowercase_normalizer'},
+    'all': {'type': 'text'},
+    'refseq': {'properties': {
+        'genomic': {'type': 'keyword'},
+        'rna': {'type': 'keyword', 'index': False}}},
+    'ensembl': {'dynamic': False, 'properties': {
+        'gene': {'type': 'keyword', 'fields': {'raw': {'type': 'keyword'}}}}},
+    'other': {'enabled': False},
+}
+
+FIELDS = [
+    ('name', {'index': True, 'searched_by_default': True, 'type': 'text'}, True),
+    ('symbol', {'index': True, 'type': 'keyword'}, True),
+    ('notes', 'RefSeq accession numbers', False),
+    ('refseq', {'index': True, 'type': 'object'}, True),
+    ('refseq.genomic', {'index': True, 'type': 'keyword'}, True),
+    ('refseq.rna', {'index': False, 'type': 'keyword'}, True),
+    ('ensembl', {'index': True, 'type': 'object'}, True),
+    ('ensembl.gene', {'fields': {'raw': {'type': 'keyword'}},
+                      'index': True, 'type': 'keyword'}, True),
+    ('other', {'index': False}, True),
+]
+
+
+def transform():
+    web_settings = SimpleNamespace(
+        metadata=SimpleNamespace(biothing_licenses={}), LICENSE_TRANSFORM={},
+        fieldnote=SimpleNamespace(get_field_notes=lambda: {'refseq': 'RefSeq accession numbers'}),
+        AVAILABLE_FIELDS_EXCLUDED=['all'])
+    return ESResultTransform(web_settings)
+
+
+def test_flatten_mapping():
+    assert transform().flatten_mapping(MAPPING) == FIELDS
+
+
+def test_field_index_select():
+    index = FieldIndex(FIELDS)
+    for prefix in (None, '', 're', 'refseq.', 'ensembl', 'x'):
+        for search in (None, '', 'e', 'ge', 'gen', 'omic', 'seq.r', 'zzz'):
+            # same as visiting every field, in mapping order
+            expected = [(key, value) for key, value, is_field in FIELDS if not is_field or
+                        key.startswith(prefix or '') and (search or '') in key]
+            assert list(index.select(prefix, search).items()) == expected, (prefix, search)
+
+    assert list(index.select('re', 'omi')) == ['notes', 'refseq.genomic']
+    assert json.loads(index.to_json()) == {key: value for key, value, _ in FIELDS}
+
+
+def test_field_index_copies():
+    index = FieldIndex(FIELDS)
+    fields = index.select()
+    fields['name']['type'] = 'keyword'
+    del fields['symbol']
+    index.select('ensembl')['ensembl.gene']['fields']['raw']['type'] = 'text'
+    assert index.select() == {key: value for key, value, _ in FIELDS}
+    assert index.to_dict() == index.select()
+    assert json.loads(index.to_json()) == index.select()
+
+
+def test_transform_mapping():
+    transformer = transform()
+    mapping = dict(MAPPING)
+    assert transformer.transform_mapping(mapping, 'refseq.', None) == {
+        'notes': 'RefSeq accession numbers',
+        'refseq.genomic': {'index': True, 'type': 'keyword'},
+        'refseq.rna': {'index': False, 'type': 'keyword'}}
+    # built once per mapping object
+    index = transformer.get_field_index(mapping)
+    assert transformer.get_field_index(mapping) is index
+    assert transformer.get_field_index(dict(MAPPING)) is not index